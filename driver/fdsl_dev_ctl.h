@@ -8,6 +8,16 @@
 #define FDSL_IOC_SET_UDP_PROXY_SUBNET _IOW(FDSL_IOC_MAGIC,1,int)
 // 设置隧道IP
 #define FDSL_IOC_SET_TUNNEL_IP _IOW(FDSL_IOC_MAGIC,2,int)
+// 设置队列大小,会清空队列中的数据包
+#define FDSL_IOC_SET_QUEUE_SIZE _IOW(FDSL_IOC_MAGIC,3,int)
+// 开启或者关闭批量读取,开启之后一次read返回多个数据包,每个数据包前面有2字节网络序的长度
+#define FDSL_IOC_SET_BATCH _IOW(FDSL_IOC_MAGIC,4,int)
+// 获取队列统计
+#define FDSL_IOC_GET_STATS _IOR(FDSL_IOC_MAGIC,5,int)
+
+// 队列大小的范围
+#define FDSL_MIN_QUEUE_SIZE 8
+#define FDSL_MAX_QUEUE_SIZE 16384
 
 struct fdsl_subnet{
     char address[16];
@@ -20,4 +30,15 @@ struct fdsl_address{
     char is_ipv6;
 };
 
+struct fdsl_stats{
+    // 放入队列的数据包个数
+    unsigned long long pushed;
+    // 队列已满时丢弃的数据包个数
+    unsigned long long overflow;
+    // 超过FDSL_MTU而没有放入队列的数据包个数
+    unsigned long long oversize;
+    unsigned int queue_size;
+    unsigned int have;
+};
+
 #endif
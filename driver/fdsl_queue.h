@@ -27,44 +27,37 @@
 struct fdsl_queue_data{
 	ssize_t size;
 	char data[FDSL_MTU];
-	struct fdsl_queue_data *next;
-	struct fdsl_queue_data *previous;
 };
 
+// 环形队列,所有的槽位一次分配,写入位置为(begin+have)%total_size
 struct fdsl_queue{
-    // 总共能够存储的数据大小
+    // 总共能够存储的数据包个数
 	size_t total_size;
-	// 已经使用的数据大小
+	// 已经使用的数据包个数
 	size_t have;
 	//数据开始位置
-	struct fdsl_queue_data *begin;
-	// 数据结束位置
-	struct fdsl_queue_data *end;
-	// 列表对象
+	size_t begin;
+	// 槽位数组
 	struct fdsl_queue_data *list;
 };
 
 struct fdsl_queue *fdsl_queue_init(size_t qsize)
 {
-	struct fdsl_queue *queue=MALLOC(sizeof(struct fdsl_queue));
-	struct fdsl_queue_data *tmp_pre=NULL,*tmp=NULL;
+	struct fdsl_queue *queue;
 
-	memset(queue,0,sizeof(struct fdsl_queue));
+	if(0==qsize) return NULL;
+
+	queue=MALLOC(sizeof(struct fdsl_queue));
+	if(NULL==queue) return NULL;
 
-    for(int n=0;n<qsize;n++){
-        tmp=MALLOC(sizeof(struct fdsl_queue_data));
-        memset(tmp,0,sizeof(struct fdsl_queue_data));
-        if(0==n) queue->list=tmp;
-        else{
-           tmp_pre->next=tmp;
-           tmp->previous=tmp_pre;
-        }
+	memset(queue,0,sizeof(struct fdsl_queue));
 
-        tmp_pre=tmp;
-    }
+	queue->list=MALLOC(sizeof(struct fdsl_queue_data) * qsize);
+	if(NULL==queue->list){
+		FREE(queue);
+		return NULL;
+	}
 
-    queue->list->previous=tmp;
-    tmp->next=queue->list;
     queue->total_size=qsize;
 
 	return queue;
@@ -77,32 +70,30 @@ int fdsl_queue_push(struct fdsl_queue *queue,char *data,size_t size)
 	if(size > FDSL_MTU) return -1;
 	if(queue->total_size==queue->have) return -2;
 
-    if(0==queue->have){
-        tmp=queue->list;
-        tmp->size=size;
-        memcpy(tmp->data,data,size);
-        queue->begin=tmp;
-    }else{
-        tmp=queue->end;
-        tmp=tmp->next;
-        tmp->size=size;
-        memcpy(tmp->data,data,size);
-    }
-
-    queue->end=tmp;
+	tmp=&queue->list[(queue->begin+queue->have) % queue->total_size];
+	tmp->size=size;
+	memcpy(tmp->data,data,size);
+
     queue->have+=1;
 
 	return 0;
 }
 
+// 返回队列开头的数据包但是不移除,生产者不会写入这个槽位,可以在不加锁时读取
+struct fdsl_queue_data *fdsl_queue_front(struct fdsl_queue *queue)
+{
+	if(0==queue->have) return NULL;
+
+	return &queue->list[queue->begin];
+}
 
 struct fdsl_queue_data *fdsl_queue_pop(struct fdsl_queue *queue)
 {
 	struct fdsl_queue_data *tmp=NULL;
 	if(0==queue->have) return tmp;
 
-    tmp=queue->begin;
-    queue->begin=tmp->next;
+    tmp=&queue->list[queue->begin];
+    queue->begin=(queue->begin+1) % queue->total_size;
 	queue->have-=1;
 
 	return tmp;
@@ -111,19 +102,12 @@ struct fdsl_queue_data *fdsl_queue_pop(struct fdsl_queue *queue)
 void fdsl_queue_reset(struct fdsl_queue *queue)
 {
     queue->have=0;
+    queue->begin=0;
 }
 
 void fdsl_queue_release(struct fdsl_queue *queue)
 {
-	struct fdsl_queue_data *tmp_a=NULL,*tmp_b=NULL;
-	size_t qsize=queue->total_size;
-
-    for(int n=0;n<qsize;n++){
-        if(0==n) tmp_a=queue->list;
-        tmp_b=tmp_a->next;
-        FREE(tmp_a);
-        tmp_a=tmp_b;
-    }
+	FREE(queue->list);
 	FREE(queue);
 }
 
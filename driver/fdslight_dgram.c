@@ -18,12 +18,15 @@
 #include<linux/slab.h>
 #include<linux/errno.h>
 #include<linux/version.h>
+#include<linux/spinlock.h>
+#include<linux/mutex.h>
 #include "fdsl_queue.h"
 #include "fdsl_dev_ctl.h"
 
 #define DEV_NAME FDSL_DEV_NAME
 #define DEV_CLASS FDSL_DEV_NAME
-#define QUEUE_SIZE 10
+// 默认队列大小,可以通过FDSL_IOC_SET_QUEUE_SIZE修改
+#define QUEUE_SIZE 1024
 
 struct fdsl_poll{
 	struct fdsl_queue *r_queue;
@@ -39,6 +42,14 @@ struct class *dev_class;
 static struct file_operations chr_ops;
 
 static struct fdsl_queue *r_queue;
+// 保护队列,netfilter钩子在软中断中写入队列
+static DEFINE_SPINLOCK(queue_lock);
+// 读取与修改队列大小互斥,读取时复制数据到用户空间不持有自旋锁
+static DEFINE_MUTEX(read_mutex);
+
+static struct fdsl_stats stats;
+// 是否一次read返回多个数据包
+static char batch_mode=0;
 
 struct fdsl_poll *poll;
 
@@ -157,6 +168,60 @@ static int fdsl_is_subnet(char *ipaddress,char is_ipv6)
 	return !memcmp(buf,t->address,n);
 }
 
+static int fdsl_set_queue_size(unsigned long arg)
+{
+	int qsize;
+	struct fdsl_queue *new_queue,*old_queue;
+
+	if(copy_from_user(&qsize,(int *)arg,sizeof(int))) return -EINVAL;
+	if(qsize<FDSL_MIN_QUEUE_SIZE || qsize>FDSL_MAX_QUEUE_SIZE) return -EINVAL;
+
+	new_queue=fdsl_queue_init(qsize);
+	if(NULL==new_queue) return -ENOMEM;
+
+	mutex_lock(&read_mutex);
+	spin_lock_bh(&queue_lock);
+
+	old_queue=r_queue;
+	r_queue=new_queue;
+	poll->r_queue=new_queue;
+
+	spin_unlock_bh(&queue_lock);
+	mutex_unlock(&read_mutex);
+
+	fdsl_queue_release(old_queue);
+
+	return 0;
+}
+
+static int fdsl_set_batch(unsigned long arg)
+{
+	int enable;
+
+	if(copy_from_user(&enable,(int *)arg,sizeof(int))) return -EINVAL;
+
+	mutex_lock(&read_mutex);
+	batch_mode=enable ? 1 : 0;
+	mutex_unlock(&read_mutex);
+
+	return 0;
+}
+
+static int fdsl_get_stats(unsigned long arg)
+{
+	struct fdsl_stats tmp;
+
+	spin_lock_bh(&queue_lock);
+	stats.queue_size=r_queue->total_size;
+	stats.have=r_queue->have;
+	memcpy(&tmp,&stats,sizeof(struct fdsl_stats));
+	spin_unlock_bh(&queue_lock);
+
+	if(copy_to_user((struct fdsl_stats *)arg,&tmp,sizeof(struct fdsl_stats))) return -EFAULT;
+
+	return 0;
+}
+
 static long chr_ioctl(struct file *f,unsigned int cmd,unsigned long arg)
 {
 	int ret=0;
@@ -169,6 +234,15 @@ static long chr_ioctl(struct file *f,unsigned int cmd,unsigned long arg)
 		case FDSL_IOC_SET_TUNNEL_IP:
 			ret=fdsl_set_tunnel(arg);
 			break;
+		case FDSL_IOC_SET_QUEUE_SIZE:
+			ret=fdsl_set_queue_size(arg);
+			break;
+		case FDSL_IOC_SET_BATCH:
+			ret=fdsl_set_batch(arg);
+			break;
+		case FDSL_IOC_GET_STATS:
+			ret=fdsl_get_stats(arg);
+			break;
 		default:
 			ret=-EINVAL;
 			break;
@@ -178,21 +252,71 @@ static long chr_ioctl(struct file *f,unsigned int cmd,unsigned long arg)
 }
 
 static ssize_t chr_read(struct file *f,char __user *u,size_t size,loff_t *loff)
+// 批量模式下复制尽可能多的数据包,每个数据包前面有2字节网络序的长度
 {
 	struct fdsl_queue_data *tmp;
-	tmp=fdsl_queue_pop(r_queue);
+	ssize_t n=0,ret=0;
+	unsigned char hdr[2];
+
+	mutex_lock(&read_mutex);
+
+	while(1){
+		spin_lock_bh(&queue_lock);
+		tmp=fdsl_queue_front(r_queue);
+		spin_unlock_bh(&queue_lock);
+
+		if(NULL==tmp) break;
+
+		if(!batch_mode){
+			if(tmp->size>size){
+				ret=-EINVAL;
+				break;
+			}
+			if(0!=copy_to_user(u,tmp->data,tmp->size)){
+				ret=-EFAULT;
+				break;
+			}
+			n=tmp->size;
+		}else{
+			if(n+2+tmp->size>size){
+				if(0==n) ret=-EINVAL;
+				break;
+			}
+			hdr[0]=(tmp->size >> 8) & 0xff;
+			hdr[1]=tmp->size & 0xff;
+			if(0!=copy_to_user(u+n,hdr,2) || 0!=copy_to_user(u+n+2,tmp->data,tmp->size)){
+				ret=-EFAULT;
+				break;
+			}
+			n+=2+tmp->size;
+		}
+
+		spin_lock_bh(&queue_lock);
+		fdsl_queue_pop(r_queue);
+		spin_unlock_bh(&queue_lock);
+
+		if(!batch_mode) break;
+	}
 
-	if (NULL==tmp) return -EAGAIN;
+	mutex_unlock(&read_mutex);
 
-	if(0!=copy_to_user(u,tmp->data,tmp->size)) return -EFAULT;
+	if(n>0) return n;
+	if(ret) return ret;
 
-	return tmp->size;
+	return -EAGAIN;
 }
 
 static int chr_release(struct inode *node,struct file *f)
 {
-	flock_flag=0;
+	mutex_lock(&read_mutex);
+	batch_mode=0;
+	mutex_unlock(&read_mutex);
+
+	spin_lock_bh(&queue_lock);
     fdsl_queue_reset(r_queue);
+	spin_unlock_bh(&queue_lock);
+
+	flock_flag=0;
 
 	return 0;
 }
@@ -210,28 +334,35 @@ static unsigned int chr_poll(struct file *f,struct poll_table_struct *wait)
 	return mask;
 }
 
-static unsigned int fdsl_push_ipv4_packet_to_user(struct iphdr *ip_header)
+static unsigned int fdsl_push_packet_to_user(char *data,size_t size)
 {
-    int err,tot_len;
-	tot_len=ntohs(ip_header->tot_len);
-	err=fdsl_queue_push(r_queue,(char *)ip_header,tot_len);
+	int err;
+
+	spin_lock_bh(&queue_lock);
+	err=fdsl_queue_push(r_queue,data,size);
+	if(0==err) stats.pushed+=1;
+	if(-1==err) stats.oversize+=1;
+	if(-2==err) stats.overflow+=1;
+	spin_unlock_bh(&queue_lock);
+
+	// 过大的数据包无法通过隧道发送,交给系统处理
+	if(-1==err) return NF_ACCEPT;
+	// 队列已满时丢弃,防止数据包绕过隧道直接发送出去
+	if(-2==err) return NF_DROP;
 
-	if(err) return NF_ACCEPT;
 	wake_up_interruptible(&poll->inq);
 
     return NF_DROP;
 }
 
-static unsigned int fdsl_push_ipv6_packet_to_user(struct ipv6hdr *ip6_header)
+static unsigned int fdsl_push_ipv4_packet_to_user(struct iphdr *ip_header)
 {
-	int err=0;
-	unsigned short data_len=ntohs(ip6_header->payload_len)+40;
-	err=fdsl_queue_push(r_queue,(char *)ip6_header,data_len);
-	if(err) return NF_ACCEPT;
-
-	wake_up_interruptible(&poll->inq);
+	return fdsl_push_packet_to_user((char *)ip_header,ntohs(ip_header->tot_len));
+}
 
-	return NF_DROP;
+static unsigned int fdsl_push_ipv6_packet_to_user(struct ipv6hdr *ip6_header)
+{
+	return fdsl_push_packet_to_user((char *)ip6_header,ntohs(ip6_header->payload_len)+40);
 }
 
 static unsigned int handle_ipv4_dgram_in(struct iphdr *ip_header)
@@ -368,14 +499,22 @@ static int fdsl_init(void)
 {
 	int ret=create_dev();
 	if(0!=ret) return ret;
-	nf_register_hook(&nf_ops);
-	nf_register_hook(&nf6_ops);
 
 	poll=kmalloc(sizeof(struct fdsl_poll),GFP_ATOMIC);
 	init_waitqueue_head(&poll->inq);
 
+	// 先分配队列再注册钩子,钩子可能立即被调用
 	r_queue=fdsl_queue_init(QUEUE_SIZE);
+	if(NULL==r_queue){
+		kfree(poll);
+		delete_dev();
+		return -ENOMEM;
+	}
 	poll->r_queue=r_queue;
+	memset(&stats,0,sizeof(struct fdsl_stats));
+
+	nf_register_hook(&nf_ops);
+	nf_register_hook(&nf6_ops);
 
 
 	return 0;
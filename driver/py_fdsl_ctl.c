@@ -41,9 +41,44 @@ fdsl_set_tunnel(PyObject *self,PyObject *args)
     return PyLong_FromLong(ioctl(fileno,FDSL_IOC_SET_TUNNEL_IP,&address));
 }
 
+static PyObject *
+fdsl_set_queue_size(PyObject *self,PyObject *args)
+{
+    int fileno,qsize;
+
+    if(!PyArg_ParseTuple(args,"ii",&fileno,&qsize)) return NULL;
+
+    return PyLong_FromLong(ioctl(fileno,FDSL_IOC_SET_QUEUE_SIZE,&qsize));
+}
+
+static PyObject *
+fdsl_set_batch(PyObject *self,PyObject *args)
+{
+    int fileno,enable;
+
+    if(!PyArg_ParseTuple(args,"ip",&fileno,&enable)) return NULL;
+
+    return PyLong_FromLong(ioctl(fileno,FDSL_IOC_SET_BATCH,&enable));
+}
+
+static PyObject *
+fdsl_get_stats(PyObject *self,PyObject *args)
+{
+    int fileno;
+    struct fdsl_stats stats;
+
+    if(!PyArg_ParseTuple(args,"i",&fileno)) return NULL;
+    if(ioctl(fileno,FDSL_IOC_GET_STATS,&stats)<0) Py_RETURN_NONE;
+
+    return Py_BuildValue("(KKKII)",stats.pushed,stats.overflow,stats.oversize,stats.queue_size,stats.have);
+}
+
 static PyMethodDef fdsl_ctl_methods[]={
     {"set_udp_proxy_subnet",fdsl_set_udp_proxy_subnet,METH_VARARGS,"set udp global proxy subnet"},
     {"set_tunnel",fdsl_set_tunnel,METH_VARARGS,"set tunnel"},
+    {"set_queue_size",fdsl_set_queue_size,METH_VARARGS,"set the size of packet queue"},
+    {"set_batch",fdsl_set_batch,METH_VARARGS,"read many packets in one call"},
+    {"get_stats",fdsl_get_stats,METH_VARARGS,"get (pushed,overflow,oversize,queue_size,have)"},
 	{NULL,NULL,0,NULL}
 };
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import sys, os, platform
+import sys, os, platform, time
 
 BASE_DIR = os.path.dirname(sys.argv[0])
 
@@ -16,10 +16,17 @@ import freenet.lib.base_proto.utils as proto_utils
 import freenet.lib.proc as proc
 import os, getopt, signal, importlib, socket
 import freenet.handlers.tunnelc as tunnelc
-import freenet.lib.file_parser as file_parser
 import freenet.lib.logging as logging
-import dns.resolver
 import freenet.lib.host_match as host_match
+import freenet.lib.ip_match as ip_match
+import freenet.lib.metrics as metrics
+import freenet.lib.dns_cache as dns_cache
+import freenet.lib.dns_upstream as dns_upstream
+import freenet.handlers.route_manager as route_manager
+import freenet.handlers.tunnel_manager as tunnel_manager
+import freenet.handlers.async_resolver as async_resolver
+import freenet.lib.nft_policy as nft_policy
+import freenet.lib.fec as fec
 
 _MODE_GW = 1
 _MODE_LOCAL = 2
@@ -106,6 +113,7 @@ class _fdslight_client(dispatcher.dispatcher):
     __dns_fileno = -1
 
     __dns_listen6 = -1
+    __dns_cache = None
     __tundev_fileno = -1
 
     __session_id = None
@@ -120,6 +128,8 @@ class _fdslight_client(dispatcher.dispatcher):
     __support_ip6_protocols = (6, 17, 58, 132, 136,)
 
     __dgram_fetch_fileno = -1
+    # UDP数据包捕获方式,kmod为内核模块,packet为AF_PACKET
+    __capture_backend = "kmod"
 
     # 是否开启IPV6流量
     __enable_ipv6_traffic = False
@@ -127,9 +137,33 @@ class _fdslight_client(dispatcher.dispatcher):
     __http_socks5_fileno = -1
 
     __host_match = None
+    __ip_match = None
 
     __only_http_socks5 = None
 
+    # 隧道断开之后保留代理的时间,在这段时间之内隧道恢复,代理可以继续使用
+    __session_grace = 60
+    # 主隧道断开的时间,0表示隧道正常
+    __tunnel_lost_time = 0
+
+    __metric_labels = None
+    __metric_pkts_in = None
+    __metric_bytes_in = None
+    __metric_pkts_out = None
+    __metric_bytes_out = None
+
+    __resolver_fileno = -1
+    __route_fileno = -1
+    __route_table = None
+
+    # 网关模式使用nftables集合与策略路由时的对象
+    __nft = None
+    __fwmark = None
+    __fwmark_table = None
+
+    # 收到SIGUSR1之后在事件循环中重新加载规则
+    __reload_host_rules = False
+
     def init_func(self, mode, debug, configs, only_http_socks5=False, no_http_socks5=False):
         self.create_poll()
 
@@ -139,10 +173,12 @@ class _fdslight_client(dispatcher.dispatcher):
         self.__routers = {}
         self.__configs = configs
         self.__host_match = host_match.host_match()
+        self.__ip_match = ip_match.ip_match()
         self.__debug = debug
         self.__set_host_rules(None, None)
 
         conn = configs["connection"]
+        self.__session_grace = int(conn.get("session_grace", 60))
 
         m = "freenet.lib.crypto.%s" % conn["crypto_module"]
         try:
@@ -165,6 +201,7 @@ class _fdslight_client(dispatcher.dispatcher):
             sys.exit(-1)
 
         self.__crypto_configs = crypto_configs
+        self.__init_metrics()
 
         if not no_http_socks5:
             if conn["tunnel_type"].lower() != "tcp":
@@ -174,17 +211,24 @@ class _fdslight_client(dispatcher.dispatcher):
             app_proxy_configs = configs["app_proxy"]
             listen_ip = app_proxy_configs["listen_ip"]
             port = int(app_proxy_configs["listen_port"])
+            resolver_threads = int(app_proxy_configs.get("resolver_threads", 4))
+
+            self.__resolver_fileno = self.create_handler(
+                -1, async_resolver.resolver, workers=resolver_threads
+            )
 
             self.__http_socks5_fileno = self.create_handler(
                 -1, http_socks5.http_socks5_listener, (listen_ip, port,),
-                self.__host_match, is_ipv6=False, debug=self.__debug
+                self.__host_match, is_ipv6=False, debug=self.__debug, ip_match=self.__ip_match
             )
 
-        signal.signal(signal.SIGUSR1, self.__set_host_rules)
+        signal.signal(signal.SIGUSR1, self.__request_host_rules)
 
         self.__only_http_socks5 = only_http_socks5
 
-        if only_http_socks5: return
+        if only_http_socks5:
+            self.__open_tunnel()
+            return
 
         import freenet.handlers.dns_proxy as dns_proxy
         import freenet.handlers.tundev as tundev
@@ -204,38 +248,63 @@ class _fdslight_client(dispatcher.dispatcher):
         gateway = configs["gateway"]
 
         self.__enable_ipv6_traffic = bool(int(public["enable_ipv6_traffic"]))
+        self.__route_table = int(public.get("route_table", 254))
+
+        self.__route_fileno = self.create_handler(
+            -1, route_manager.route_manager, self.__DEVNAME, table=self.__route_table
+        )
+
+        dns_servers = dns_upstream.parse_servers(public["remote_dns"])
+        dns_race = bool(int(public.get("dns_race", 0)))
 
-        is_ipv6 = utils.is_ipv6_address(public["remote_dns"])
+        dns_cache_size = int(public.get("dns_cache_size", 4096))
+        if dns_cache_size > 0:
+            self.__dns_cache = dns_cache.dns_cache(max_size=dns_cache_size, name="dnsc")
 
         if self.__mode == _MODE_GW:
+            # IPv4与IPv6的DNS代理共享隧道的DNS ID空间
+            tunnel_ids = dns_upstream.id_space()
             self.__dns_fileno = self.create_handler(
                 -1, dns_proxy.dnsc_proxy,
-                gateway["dnsserver_bind"], self.__host_match, debug=debug, server_side=True, is_ipv6=False
+                gateway["dnsserver_bind"], self.__host_match, debug=debug, server_side=True, is_ipv6=False,
+                cache=self.__dns_cache, tunnel_ids=tunnel_ids, ip_match=self.__ip_match
             )
-            self.get_handler(self.__dns_fileno).set_parent_dnsserver(public["remote_dns"], is_ipv6=is_ipv6)
+            self.get_handler(self.__dns_fileno).set_parent_dnsserver(dns_servers, race=dns_race)
 
             if self.__enable_ipv6_traffic:
                 self.__dns_listen6 = self.create_handler(
                     -1, dns_proxy.dnsc_proxy,
-                    gateway["dnsserver_bind6"], self.__host_match, debug=debug, server_side=True, is_ipv6=True
+                    gateway["dnsserver_bind6"], self.__host_match, debug=debug, server_side=True, is_ipv6=True,
+                    cache=self.__dns_cache, tunnel_ids=tunnel_ids, ip_match=self.__ip_match
                 )
-                self.get_handler(self.__dns_listen6).set_parent_dnsserver(public["remote_dns"], is_ipv6=is_ipv6)
+                self.get_handler(self.__dns_listen6).set_parent_dnsserver(dns_servers, race=dns_race)
         else:
             self.__dns_fileno = self.create_handler(
                 -1, dns_proxy.dnsc_proxy,
-                public["remote_dns"], self.__host_match, debug=debug, server_side=False
+                dns_servers, self.__host_match, debug=debug, server_side=False, cache=self.__dns_cache,
+                race=dns_race, ip_match=self.__ip_match
             )
 
         self.__set_host_rules(None, None)
 
         if self.__mode == _MODE_GW:
+            self.__capture_backend = gateway.get("capture_backend", "kmod")
+            if self.__capture_backend not in ("kmod", "packet",):
+                print("wrong capture_backend value %s" % self.__capture_backend)
+                sys.exit(-1)
             self.__load_kernel_mod()
+            if gateway.get("route_mode", "route") == "nftset": self.__init_nft_policy(gateway)
             udp_global = bool(int(gateway["dgram_global_proxy"]))
             if udp_global:
                 import freenet.handlers.traffic_pass as traffic_pass
 
+                if self.__capture_backend == "packet":
+                    handler_cls = traffic_pass.packet_read
+                else:
+                    handler_cls = traffic_pass.traffic_read
+
                 self.__dgram_fetch_fileno = self.create_handler(
-                    -1, traffic_pass.traffic_read,
+                    -1, handler_cls,
                     self.__configs["gateway"], enable_ipv6=self.__enable_ipv6_traffic
                 )
             ''''''
@@ -247,14 +316,79 @@ class _fdslight_client(dispatcher.dispatcher):
             self.set_router(vir_dns, is_ipv6=False, is_dynamic=False)
             if self.__enable_ipv6_traffic: self.set_router(vir_dns6, is_ipv6=True, is_dynamic=False)
 
+        self.__open_tunnel()
+
         if not debug:
             sys.stdout = open(LOG_FILE, "a+")
             sys.stderr = open(ERR_FILE, "a+")
         return
 
+    def __init_nft_policy(self, gateway):
+        """目标地址加入nftables集合,由一条fwmark策略路由转发到tun设备"""
+        self.__fwmark = int(gateway.get("fwmark", 100))
+        self.__fwmark_table = int(gateway.get("fwmark_table", 100))
+        self.__nft = nft_policy.nft_policy(
+            self.__fwmark, self.__ROUTER_TIMEOUT, enable_ipv6=self.__enable_ipv6_traffic
+        )
+
+        try:
+            self.__nft.setup()
+        except nft_policy.NftErr as e:
+            print("cannot set nftables rules:%s" % e)
+            sys.exit(-1)
+
+        route = self.get_handler(self.__route_fileno)
+        route.add_route("0.0.0.0", 0, table=self.__fwmark_table)
+        os.system("ip rule add fwmark %s table %s" % (self.__fwmark, self.__fwmark_table,))
+
+        if self.__enable_ipv6_traffic:
+            route.add_route("::", 0, is_ipv6=True, table=self.__fwmark_table)
+            os.system("ip -6 rule add fwmark %s table %s" % (self.__fwmark, self.__fwmark_table,))
+
+    def __del_nft_policy(self):
+        self.__nft.cleanup()
+        os.system("ip rule del fwmark %s table %s" % (self.__fwmark, self.__fwmark_table,))
+        if self.__enable_ipv6_traffic:
+            os.system("ip -6 rule del fwmark %s table %s" % (self.__fwmark, self.__fwmark_table,))
+
+    def __init_metrics(self):
+        """注册指标,如果配置开启,那么创建本地指标查询服务"""
+        conn = self.__configs["connection"]
+        self.__metric_labels = (conn["username"], conn["tunnel_type"].lower(),)
+
+        labelnames = ("user", "tunnel",)
+        self.__metric_pkts_in = metrics.new_counter("tunnel_packets_in_total", "packets received from tunnel",
+                                                    labelnames)
+        self.__metric_bytes_in = metrics.new_counter("tunnel_bytes_in_total", "bytes received from tunnel",
+                                                     labelnames)
+        self.__metric_pkts_out = metrics.new_counter("tunnel_packets_out_total", "packets sent to tunnel",
+                                                     labelnames)
+        self.__metric_bytes_out = metrics.new_counter("tunnel_bytes_out_total", "bytes sent to tunnel", labelnames)
+
+        metrics.new_gauge("routes", "number of dynamic routes").set_function(lambda: len(self.__routers))
+        metrics.new_gauge("tunnel_up", "whether the tunnel is established").set_function(
+            lambda: int(self.tunnel_ok())
+        )
+
+        metrics_configs = self.__configs.get("metrics", {})
+        if not bool(int(metrics_configs.get("enable", 0))): return
+
+        import freenet.handlers.metrics_http as metrics_http
+
+        unix_path = metrics_configs.get("unix_path", "")
+        if unix_path:
+            self.create_handler(-1, metrics_http.metrics_listener, unix_path, is_unix=True)
+            return
+
+        address = (metrics_configs.get("listen_ip", "127.0.0.1"), int(metrics_configs.get("listen_port", 8971)),)
+        self.create_handler(-1, metrics_http.metrics_listener, address)
+
     def __load_kernel_mod(self):
         import freenet.lib.fdsl_ctl as fdsl_ctl
 
+        self.__enable_forward()
+        if self.__capture_backend != "kmod": return
+
         ko_file = "%s/driver/fdslight_dgram.ko" % BASE_DIR
 
         if not os.path.isfile(ko_file):
@@ -279,6 +413,9 @@ class _fdslight_client(dispatcher.dispatcher):
         path = "/dev/%s" % fdsl_ctl.FDSL_DEV_NAME
         if os.path.exists(path): os.system("rmmod fdslight_dgram")
 
+        os.system("insmod %s" % ko_file)
+
+    def __enable_forward(self):
         # 开启ip forward
         os.system("echo 1 > /proc/sys/net/ipv4/ip_forward")
         # 禁止接收ICMP redirect 包,防止客户端机器选择最佳路由
@@ -287,8 +424,6 @@ class _fdslight_client(dispatcher.dispatcher):
         if self.__enable_ipv6_traffic:
             os.system("echo 1 >/proc/sys/net/ipv6/conf/all/forwarding")
 
-        os.system("insmod %s" % ko_file)
-
     def handle_msg_from_tundev(self, message):
         """处理来TUN设备的数据包
         :param message:
@@ -322,6 +457,10 @@ class _fdslight_client(dispatcher.dispatcher):
         if ip_ver == 4 and nexthdr not in self.__support_ip4_protocols: return
         if ip_ver == 6 and nexthdr not in self.__support_ip6_protocols: return
 
+        # IP规则的标志为2表示丢弃
+        is_match, flags = self.__ip_match.match_bytes(byte_daddr)
+        if is_match and flags == 2: return
+
         if self.__mode == _MODE_LOCAL:
             is_dns_req, saddr, daddr, sport, rs = self.__is_dns_request()
             if is_dns_req:
@@ -363,6 +502,9 @@ class _fdslight_client(dispatcher.dispatcher):
         if seession_id != self.session_id: return
         if action not in proto_utils.ACTS: return
 
+        self.__metric_pkts_in.inc(1, self.__metric_labels)
+        self.__metric_bytes_in.inc(len(message), self.__metric_labels)
+
         if action == proto_utils.ACT_DNS:
             self.get_handler(self.__dns_fileno).msg_from_tunnel(message)
             return
@@ -395,12 +537,15 @@ class _fdslight_client(dispatcher.dispatcher):
 
         self.send_message_to_handler(-1, fileno, message)
 
-    def send_msg_to_tunnel(self, action, message):
-        if not self.handler_exists(self.__tunnel_fileno):
-            self.__open_tunnel()
+    def resolve_host(self, fileno, host):
+        """异步解析域名,参见async_resolver.resolver.resolve"""
+        return self.get_handler(self.__resolver_fileno).resolve(fileno, host)
 
+    def send_msg_to_tunnel(self, action, message):
         handler = self.get_handler(self.__tunnel_fileno)
 
+        self.__metric_pkts_out.inc(1, self.__metric_labels)
+        self.__metric_bytes_out.inc(len(message), self.__metric_labels)
         handler.send_msg_to_tunnel(self.session_id, action, message)
 
     def send_msg_to_tun(self, message):
@@ -455,6 +600,10 @@ class _fdslight_client(dispatcher.dispatcher):
 
         return self.__session_id
 
+    def __request_host_rules(self, signum, frame):
+        """信号处理函数,规则在事件循环中重新加载"""
+        self.__reload_host_rules = True
+
     def __set_host_rules(self, signum, frame):
         fpath = "%s/fdslight_etc/host_rules.txt" % BASE_DIR
 
@@ -462,10 +611,24 @@ class _fdslight_client(dispatcher.dispatcher):
             print("cannot found host_rules.txt")
             self.__exit(signum, frame)
 
-        rules = file_parser.parse_host_file(fpath)
-        for rule in rules: self.__host_match.add_rule(rule)
+        # 在新的规则编译完成之后一次替换,替换过程中的查询仍然使用旧规则
+        rules = host_match.load_file(fpath, cache_path="%s/fdslight_etc/host_rules.cache" % BASE_DIR)
+        self.__host_match.set_rules(rules)
+
+        ip_rules_file = self.__configs["public"].get("ip_rules_file", "")
+        if ip_rules_file:
+            fpath = "%s/fdslight_etc/%s" % (BASE_DIR, ip_rules_file,)
+            try:
+                self.__ip_match.set_rules(ip_match.load_file(fpath))
+            except (OSError, ip_match.IPMatchErr) as e:
+                print("cannot load ip rules:%s" % e)
+            ''''''
+
+        # 规则改变之后,缓存的应答可能来自于不同的DNS服务器,需要清除
+        if self.__dns_cache: self.__dns_cache.clear()
 
     def __open_tunnel(self):
+        """创建隧道管理,隧道在启动时建立并且保持"""
         conn = self.__configs["connection"]
         host = conn["host"]
         port = int(conn["port"])
@@ -473,93 +636,140 @@ class _fdslight_client(dispatcher.dispatcher):
         conn_timeout = int(conn["conn_timeout"])
         tunnel_type = conn["tunnel_type"]
         redundancy = bool(int(conn.get("udp_tunnel_redundancy", 1)))
+        standby = bool(int(conn.get("tunnel_standby", 0)))
+        buffer_size = int(conn.get("tunnel_buffer_size", 256))
+        connections = int(conn.get("tunnel_connections", 1))
+        fec_k = int(conn.get("udp_fec", 0))
+        pmtu_probe = bool(int(conn.get("udp_pmtu_probe", 1)))
 
         if tunnel_type.lower() == "udp":
             handler = tunnelc.udp_tunnel
             crypto = self.__udp_crypto
+            # UDP隧道没有队头阻塞,不需要多个连接
+            connections = 1
         else:
             handler = tunnelc.tcp_tunnel
             crypto = self.__tcp_crypto
 
+        if connections < 1 or connections > proto_utils.MAX_TUNNEL_CONNECTIONS:
+            print("wrong tunnel_connections value")
+            sys.exit(-1)
+
         kwargs = {
             "conn_timeout": conn_timeout,
             "is_ipv6": enable_ipv6,
         }
 
-        if tunnel_type.lower() == "udp": kwargs["redundancy"] = redundancy
+        if fec_k < 0 or fec_k >= fec.MAX_SHARDS:
+            print("wrong udp_fec value")
+            sys.exit(-1)
+
+        if tunnel_type.lower() == "udp":
+            # 开启前向纠错时不再使用2+1冗余
+            kwargs["redundancy"] = redundancy and not fec_k
+            kwargs["fec_k"] = fec_k
+            kwargs["pmtu_probe"] = pmtu_probe
+
+        # 服务器地址通过远程DNS解析,不经过系统的解析配置,网关模式下系统的DNS可能指向本程序
+        server_resolver = self.create_handler(
+            -1, async_resolver.resolver, workers=1, cache_size=16,
+            nameservers=dns_upstream.parse_servers(self.__configs["public"]["remote_dns"]), name="server"
+        )
 
         self.__tunnel_fileno = self.create_handler(
-            -1, handler,
-            crypto, self.__crypto_configs, **kwargs
+            -1, tunnel_manager.tunnel_manager, (host, port,), server_resolver,
+            handler, (crypto, self.__crypto_configs,), kwargs,
+            is_ipv6=enable_ipv6, standby=standby, buffer_size=buffer_size, connections=connections
         )
 
-        self.get_handler(self.__tunnel_fileno).create_tunnel((host, port,))
+    def tell_tunnel_mtu(self, mtu):
+        """UDP隧道探测到路径MTU之后调整tun设备的MTU,使数据包不需要分块
+        IPv6要求MTU不小于1280,小于时由隧道分块
+        """
+        if not self.handler_exists(self.__tundev_fileno): return
+
+        mtu = max(1280, min(mtu, utils.MBUF_AREA_SIZE - 1))
+        if not self.get_handler(self.__tundev_fileno).set_mtu(mtu): print("cannot set the mtu of tun device to %s" % mtu)
 
     def tell_tunnel_close(self):
+        if self.__session_grace < 1:
+            self.__del_all_proxy()
+            return
+        # 切换网络时隧道会重新连接,服务端同样会保留代理
+        if not self.__tunnel_lost_time: self.__tunnel_lost_time = time.time()
+
+    def __del_all_proxy(self):
         if self.handler_exists(self.__http_socks5_fileno):
             self.get_handler(self.__http_socks5_fileno).del_all_proxy()
-        self.__tunnel_fileno = -1
+
+    def __check_tunnel_lost(self):
+        if self.tunnel_ok():
+            self.__tunnel_lost_time = 0
+            return
+        if time.time() - self.__tunnel_lost_time < self.__session_grace: return
+
+        self.__tunnel_lost_time = 0
+        self.__del_all_proxy()
 
     def tunnel_ok(self):
-        return self.handler_exists(self.__tunnel_fileno)
+        if not self.handler_exists(self.__tunnel_fileno): return False
 
-    def get_server_ip(self, host):
-        """获取服务器IP
-        :param host:
+        return self.get_handler(self.__tunnel_fileno).tunnel_ok()
+
+    def tell_server_ip(self, ip):
+        """隧道管理解析到新的服务器地址
+        :param ip:
         :return:
         """
-        if utils.is_ipv4_address(host): return host
-        if utils.is_ipv6_address(host): return host
-
-        enable_ipv6 = bool(int(self.__configs["connection"]["enable_ipv6"]))
-        resolver = dns.resolver.Resolver()
-        resolver.nameservers = [self.__configs["public"]["remote_dns"]]
-
-        if enable_ipv6:
-            rs = resolver.query(host, "AAAA")
-        else:
-            rs = resolver.query(host, "A")
+        if self.__mode == _MODE_GW: self.__set_tunnel_ip(ip)
 
-        for anwser in rs:
-            ipaddr = anwser.__str__()
-            break
-        if self.__mode == _MODE_GW: self.__set_tunnel_ip(ipaddr)
+    def myloop(self):
+        if self.__reload_host_rules:
+            self.__reload_host_rules = False
+            self.__set_host_rules(None, None)
 
-        return ipaddr
+        if self.__tunnel_lost_time: self.__check_tunnel_lost()
 
-    def myloop(self):
         names = self.__router_timer.get_timeout_names()
         for name in names: self.__del_router(name)
 
-    def set_router(self, host, timeout=None, is_ipv6=False, is_dynamic=True):
+        if self.__nft: self.__nft.flush()
+
+    def set_router(self, host, timeout=None, is_ipv6=False, is_dynamic=True, prefix=None):
+        """设置到tun设备的路由
+        :param host: 主机地址或者网络地址
+        :param prefix: 前缀长度,为None表示主机路由
+        """
         if host in self.__routers: return
 
         # 如果禁止了IPV6流量,那么不设置IPV6路由
         if not self.__enable_ipv6_traffic and is_ipv6: return
-        if is_ipv6:
-            cmd = "route add -A inet6 %s/128 dev %s" % (host, self.__DEVNAME)
-        else:
-            cmd = "route add -host %s dev %s" % (host, self.__DEVNAME)
+        if prefix is None:
+            if is_ipv6:
+                prefix = 128
+            else:
+                prefix = 32
+            ''''''
+        # 主机地址加入nftables集合,由内核负责超时删除
+        if self.__nft and is_dynamic and prefix in (32, 128,):
+            self.__nft.add(host, is_ipv6=is_ipv6, timeout=timeout)
+            return
 
-        os.system(cmd)
+        # 路由在事件循环中批量写入内核
+        self.get_handler(self.__route_fileno).add_route(host, prefix, is_ipv6=is_ipv6)
 
         if not is_dynamic: return
 
         if not timeout:
             timeout = self.__ROUTER_TIMEOUT
         self.__router_timer.set_timeout(host, timeout)
-        self.__routers[host] = is_ipv6
+        self.__routers[host] = prefix
 
     def __del_router(self, host):
         if host not in self.__routers: return
-        is_ipv6 = self.__routers[host]
+        prefix = self.__routers[host]
 
-        if is_ipv6:
-            cmd = "route del -A inet6 %s/128 dev %s" % (host, self.__DEVNAME)
-        else:
-            cmd = "route del -host %s dev %s" % (host, self.__DEVNAME)
-
-        os.system(cmd)
+        self.get_handler(self.__route_fileno).del_route(host, prefix)
         self.__router_timer.drop(host)
         del self.__routers[host]
 
@@ -579,10 +789,12 @@ class _fdslight_client(dispatcher.dispatcher):
             self.delete_handler(self.__dns_fileno)
 
         if self.__mode == _MODE_GW:
+            if self.__nft: self.__del_nft_policy()
             self.delete_handler(self.__dgram_fetch_fileno)
-            os.chdir("%s/driver" % BASE_DIR)
-            os.system("rmmod fdslight_dgram")
-            os.chdir("../")
+            if self.__capture_backend == "kmod":
+                os.chdir("%s/driver" % BASE_DIR)
+                os.system("rmmod fdslight_dgram")
+                os.chdir("../")
         sys.exit(0)
 
     def __set_tunnel_ip(self, ip):
@@ -590,7 +802,7 @@ class _fdslight_client(dispatcher.dispatcher):
         :param ip:
         :return:
         """
-        if self.__mode == _MODE_GW:
+        if self.__mode == _MODE_GW and self.handler_exists(self.__dgram_fetch_fileno):
             self.get_handler(self.__dgram_fetch_fileno).set_tunnel_ip(ip)
         return
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
-import sys, getopt, os, signal, importlib, socket
+import sys, getopt, os, signal, importlib, socket, time, struct
+from collections import deque
 
 BASE_DIR = os.path.dirname(sys.argv[0])
 
@@ -20,12 +21,19 @@ import pywind.lib.configfile as configfile
 import freenet.lib.base_proto.utils as proto_utils
 import freenet.lib.nat as nat
 import freenet.handlers.tunnels as tunnels
-import freenet.lib.ip6dgram as ip6dgram
+import freenet.lib.ipfrag as ipfrag
+import freenet.lib.udp_flow as udp_flow
 import freenet.handlers.traffic_pass as traffic_pass
 import freenet.lib.logging as logging
-import freenet.lib.fn_utils as fn_utils
+import freenet.lib.checksum as checksum
 import freenet.handlers.app_proxy as app_proxy
 import freenet.lib.base_proto.app_proxy as app_proxy_proto
+import freenet.lib.metrics as metrics
+import freenet.handlers.metrics_http as metrics_http
+import freenet.lib.dns_cache as dns_cache
+import freenet.lib.dns_upstream as dns_upstream
+import freenet.handlers.async_resolver as async_resolver
+import freenet.handlers.route_manager as route_manager
 
 
 class _fdslight_server(dispatcher.dispatcher):
@@ -45,6 +53,7 @@ class _fdslight_server(dispatcher.dispatcher):
     __tcp_fileno = -1
 
     __dns_fileno = -1
+    __dns_cache = None
 
     __tcp_crypto = None
     __udp_crypto = None
@@ -63,9 +72,19 @@ class _fdslight_server(dispatcher.dispatcher):
 
     __IP6_ROUTER_TIMEOUT = 900
 
-    __ip6_dgram = None
+    # UDP全锥形代理的分片重组
+    __dgram_reasm = None
 
-    __dgram_proxy = None
+    # UDP全锥形代理的流表
+    __dgram_flows = None
+    # 共享的代理套接字 (is_udplite,is_ipv6) -> [fileno,...]
+    __dgram_pools = None
+    # 共享套接字的个数,0表示每个流使用独占的套接字
+    __dgram_pool_size = 0
+    __dgram_expire_time = 0
+    # 检查流超时的时间间隔
+    __DGRAM_EXPIRE_INTERVAL = 10
+    __DGRAM_FLOW_TIMEOUT = 180
 
     __raw_fileno = None
 
@@ -75,18 +94,43 @@ class _fdslight_server(dispatcher.dispatcher):
 
     __enable_ipv6_app_proxy = None
 
+    __resolver_fileno = -1
+    __route_fileno = -1
+
+    # 使用多个TCP连接的会话 session_id -> [fileno,...],下标为客户端告知的连接序号,-1表示没有连接
+    __session_tunnels = None
+
+    # 隧道断开之后保留代理的时间,客户端在这段时间内重新连接可以继续使用代理
+    __session_grace = 60
+    # 隧道已经断开的会话 session_id -> 删除代理的时间
+    __lost_sessions = None
+    # 隧道断开期间等待发送的代理数据 session_id -> deque
+    __held_msgs = None
+    # 每个会话最多保留的代理数据个数,超过之后立即删除代理
+    __MAX_HELD_MSGS = 1024
+
+    __metric_pkts_in = None
+    __metric_bytes_in = None
+    __metric_pkts_out = None
+    __metric_bytes_out = None
+
     def init_func(self, debug, configs):
         self.create_poll()
 
         self.__configs = configs
         self.__debug = debug
 
-        self.__ip6_dgram = {}
-        self.__dgram_proxy = {}
+        self.__dgram_reasm = ipfrag.reassembler()
+        self.__dgram_flows = udp_flow.flow_table(timeout=self.__DGRAM_FLOW_TIMEOUT)
+        self.__dgram_pools = {}
         self.__app_proxy = {}
+        self.__session_tunnels = {}
+        self.__lost_sessions = {}
+        self.__held_msgs = {}
 
         app_proxy_configs = self.__configs["app_proxy"]
         self.__enable_ipv6_app_proxy = bool(int(app_proxy_configs["enable_ipv6"]))
+        resolver_threads = int(app_proxy_configs.get("resolver_threads", 4))
 
         signal.signal(signal.SIGINT, self.__exit)
 
@@ -128,6 +172,7 @@ class _fdslight_server(dispatcher.dispatcher):
         listen_port = int(conn_config["listen_port"])
 
         conn_timeout = int(conn_config["conn_timeout"])
+        self.__session_grace = int(conn_config.get("session_grace", 60))
 
         listen_ip = conn_config["listen_ip"]
         listen_ip6 = conn_config["listen_ip6"]
@@ -159,23 +204,33 @@ class _fdslight_server(dispatcher.dispatcher):
         )
 
         self.__raw_fileno = self.create_handler(
-            -1, traffic_pass.ip4_raw_send
+            -1, traffic_pass.raw_send
         )
 
-        self.__access = access.access(self)
+        self.__route_fileno = self.create_handler(
+            -1, route_manager.route_manager, self.__DEVNAME
+        )
+
+        self.__resolver_fileno = self.create_handler(
+            -1, async_resolver.resolver, workers=resolver_threads
+        )
+
+        self.__access = access.access(self, configs=conn_config)
+        signal.signal(signal.SIGUSR1, self.__reload_users)
 
         self.__mbuf = utils.mbuf()
 
         nat_config = configs["nat"]
 
-        dns_addr = nat_config["dns"]
-        if utils.is_ipv6_address(dns_addr):
-            is_ipv6 = True
-        else:
-            is_ipv6 = False
+        dns_servers = dns_upstream.parse_servers(nat_config["dns"])
+        dns_race = bool(int(nat_config.get("dns_race", 0)))
+
+        dns_cache_size = int(nat_config.get("dns_cache_size", 4096))
+        if dns_cache_size > 0:
+            self.__dns_cache = dns_cache.dns_cache(max_size=dns_cache_size, name="dnsd")
 
         self.__dns_fileno = self.create_handler(
-            -1, dns_proxy.dnsd_proxy, dns_addr, is_ipv6=is_ipv6
+            -1, dns_proxy.dnsd_proxy, dns_servers, cache=self.__dns_cache, race=dns_race
         )
 
         enable_ipv6 = bool(int(nat_config["enable_nat66"]))
@@ -183,6 +238,7 @@ class _fdslight_server(dispatcher.dispatcher):
         eth_name = nat_config["eth_name"]
         ip6_gw = nat_config["ip6_gw"]
         self.__ip6_udp_cone_nat = bool(int(nat_config.get("ip6_udp_cone_nat", 0)))
+        self.__dgram_pool_size = int(nat_config.get("udp_socket_pool", 0))
 
         if enable_ipv6:
             self.__nat6 = nat.nat((subnet, prefix,), is_ipv6=True)
@@ -193,31 +249,100 @@ class _fdslight_server(dispatcher.dispatcher):
         self.__nat4 = nat.nat((subnet, prefix,), is_ipv6=False)
         self.__config_gateway(subnet, prefix, eth_name)
 
+        self.__init_metrics()
+
         if not debug:
             sys.stdout = open(LOG_FILE, "a+")
             sys.stderr = open(ERR_FILE, "a+")
 
+    def __init_metrics(self):
+        """注册指标,如果配置开启,那么创建本地指标查询服务"""
+        labelnames = ("user", "tunnel",)
+        self.__metric_pkts_in = metrics.new_counter("tunnel_packets_in_total", "packets received from tunnel",
+                                                    labelnames)
+        self.__metric_bytes_in = metrics.new_counter("tunnel_bytes_in_total", "bytes received from tunnel",
+                                                     labelnames)
+        self.__metric_pkts_out = metrics.new_counter("tunnel_packets_out_total", "packets sent to tunnel",
+                                                     labelnames)
+        self.__metric_bytes_out = metrics.new_counter("tunnel_bytes_out_total", "bytes sent to tunnel", labelnames)
+
+        metrics.new_gauge("sessions", "number of sessions").set_function(self.__access.session_count)
+        metrics.new_gauge("nat_mappings", "number of nat mappings", ("family",)).set_function(self.__nat_mappings)
+        metrics.new_gauge("nat_addr_used", "number of allocated nat addresses", ("family",)).set_function(
+            self.__nat_addr_used
+        )
+        metrics.new_gauge("nat_addr_capacity", "number of nat addresses can be allocated", ("family",)).set_function(
+            self.__nat_addr_capacity
+        )
+        metrics.new_gauge("dgram_proxies", "number of udp full-cone proxies").set_function(
+            lambda: len(self.__dgram_flows)
+        )
+        metrics.new_gauge("app_proxies", "number of app proxies").set_function(
+            lambda: sum([len(pydict) for pydict in self.__app_proxy.values()])
+        )
+
+        metrics_configs = self.__configs.get("metrics", {})
+        if not bool(int(metrics_configs.get("enable", 0))): return
+
+        unix_path = metrics_configs.get("unix_path", "")
+        if unix_path:
+            self.create_handler(-1, metrics_http.metrics_listener, unix_path, is_unix=True)
+            return
+
+        address = (metrics_configs.get("listen_ip", "127.0.0.1"), int(metrics_configs.get("listen_port", 8970)),)
+        self.create_handler(-1, metrics_http.metrics_listener, address)
+
+    def __nat_mappings(self):
+        results = [(("ipv4",), self.__nat4.mapping_count(),)]
+        if self.__enable_nat6: results.append((("ipv6",), self.__nat6.mapping_count(),))
+        return results
+
+    def __nat_addr_used(self):
+        results = [(("ipv4",), self.__nat4.addr_used_count(),)]
+        if self.__enable_nat6: results.append((("ipv6",), self.__nat6.addr_used_count(),))
+        return results
+
+    def __nat_addr_capacity(self):
+        results = [(("ipv4",), self.__nat4.addr_capacity(),)]
+        if self.__enable_nat6: results.append((("ipv6",), self.__nat6.addr_capacity(),))
+        return results
+
+    def __count_traffic(self, is_recv, username, fileno, size):
+        if fileno in (self.__udp_fileno, self.__udp6_fileno,):
+            labels = (username, "udp",)
+        else:
+            labels = (username, "tcp",)
+
+        if is_recv:
+            self.__metric_pkts_in.inc(1, labels)
+            self.__metric_bytes_in.inc(size, labels)
+        else:
+            self.__metric_pkts_out.inc(1, labels)
+            self.__metric_bytes_out.inc(size, labels)
+
     def myloop(self):
         if self.__enable_nat6:
             self.__nat6.recycle()
         self.__nat4.recycle()
         self.__access.access_loop()
+        if self.__lost_sessions: self.__expire_lost_sessions()
+        self.__expire_dgram_flows()
+        self.__dgram_reasm.expire()
         return
 
     def handle_msg_from_tunnel(self, fileno, session_id, address, action, message):
         size = len(message)
-        # 删除旧的连接
-        if self.__access.session_exists(session_id):
-            session_info = self.__access.get_session_info(session_id)
-            old_fileno = session_info[0]
-            if old_fileno != fileno:
-                if old_fileno not in (self.__udp6_fileno, self.__udp_fileno,):
-                    self.delete_handler(old_fileno)
-                ''''''
-            ''''''
+        # 地址与连接的改变由access检查,参见tell_session_migrate
         b = self.__access.data_from_recv(fileno, session_id, address, size)
         if not b: return False
+        if session_id in self.__lost_sessions: self.__resume_session(session_id)
+
+        s = self.__access.get_session_info(session_id)
+        self.__count_traffic(True, s.username, fileno, size)
         if size > utils.MBUF_AREA_SIZE: return False
+        if action == proto_utils.ACT_TUNNEL:
+            self.__handle_tunnel_join(fileno, session_id, message)
+            return True
         if action not in proto_utils.ACTS: return False
 
         if action == proto_utils.ACT_IPDATA: self.__mbuf.copy2buf(message)
@@ -231,6 +356,54 @@ class _fdslight_server(dispatcher.dispatcher):
 
         return self.__handle_ipdata_from_tunnel(session_id)
 
+    def __handle_tunnel_join(self, fileno, session_id, message):
+        """客户端告知TCP连接在会话中的序号
+        :param fileno:
+        :param session_id:
+        :param message:
+        :return:
+        """
+        if fileno in (self.__udp6_fileno, self.__udp_fileno,): return
+        try:
+            index, count = proto_utils.parse_tunnel_join(message)
+        except proto_utils.ProtoError:
+            return
+        if count < 1 or count > proto_utils.MAX_TUNNEL_CONNECTIONS or index >= count: return
+
+        tunnels = self.__session_tunnels.get(session_id, [])
+        # 客户端改变了连接数
+        if len(tunnels) != count:
+            for fd in tunnels[count:]:
+                if fd >= 0 and fd != fileno: self.delete_handler(fd)
+            tunnels = tunnels[0:count] + [-1] * (count - len(tunnels))
+
+        old_fileno = tunnels[index]
+        tunnels = [-1 if fd == fileno else fd for fd in tunnels]
+        tunnels[index] = fileno
+        self.__session_tunnels[session_id] = tunnels
+
+        # 同一个序号的旧连接已经被客户端放弃
+        if old_fileno >= 0 and old_fileno != fileno: self.delete_handler(old_fileno)
+
+    def __select_tunnel(self, session_id, action, message):
+        """按照与客户端相同的五元组哈希选择连接,DNS与socks数据使用第一个连接
+        :return: 文件描述符,没有可用连接返回-1
+        """
+        tunnels = self.__session_tunnels[session_id]
+        n = len(tunnels)
+
+        if action == proto_utils.ACT_IPDATA:
+            i = utils.flow_hash(message) % n
+        else:
+            i = 0
+
+        for j in range(n):
+            fd = tunnels[(i + j) % n]
+            if fd >= 0: return fd
+        ''''''
+
+        return -1
+
     def __handle_ipdata_from_tunnel(self, session_id):
         ip_ver = self.__mbuf.ip_version()
 
@@ -255,14 +428,19 @@ class _fdslight_server(dispatcher.dispatcher):
 
         if nexthdr not in self.__support_ip6_protocols: return False
 
-        self.__mbuf.offset = 40
-        nexthdr = self.__mbuf.get_part(1)
+        if self.__ip6_udp_cone_nat:
+            self.__mbuf.offset = 0
+            ip6_pkt = self.__mbuf.get_data()
+            try:
+                nexthdr, _, _, _ = ipfrag.ip6_upper_layer(ip6_pkt)
+            except ipfrag.IPFragErr:
+                return False
 
-        if nexthdr in (17, 136,) and self.__ip6_udp_cone_nat:
-            is_udplite = False
-            if nexthdr == 136: is_udplite = True
-            self.__handle_ipv6_dgram_from_tunnel(session_id, is_udplite=is_udplite)
-            return True
+            if nexthdr in (17, 136,):
+                is_udplite = False
+                if nexthdr == 136: is_udplite = True
+                self.__handle_ipv6_dgram_from_tunnel(session_id, ip6_pkt, is_udplite=is_udplite)
+                return True
 
         b = self.__nat6.get_ippkt2sLan_from_cLan(session_id, self.__mbuf)
         if not b: return False
@@ -303,18 +481,22 @@ class _fdslight_server(dispatcher.dispatcher):
 
     def __handle_ipv4_dgram_from_tunnel(self, session_id, is_udplite=False):
         mbuf = self.__mbuf
-        mbuf.offset = 4
-
         mbuf.offset = 6
         frag_off = utils.bytes2number(mbuf.get_part(2))
 
-        df = 0x4000 >> 14
-        mf = 0x2000 >> 13
-        offset = frag_off & 0x1fff
+        # 分片重组之后通过流的代理套接字发送,由内核重新分片,不同会话的包ID不会冲突
+        if frag_off & 0x3fff:
+            mbuf.offset = 0
+            ip_pkt = self.__dgram_reasm.add(session_id, mbuf.get_data())
+            if not ip_pkt: return
+            hdrlen = (ip_pkt[0] & 0x0f) * 4
+            self.__send_dgram_by_flow(
+                session_id, ip_pkt, hdrlen, bytes(ip_pkt[12:16]), bytes(ip_pkt[16:20]), is_udplite, False
+            )
+            return
 
-        if offset == 0:
-            sts_saddr, sts_daddr, sport, dport = self.__get_ipv4_dgram_pkt_addr_info()
-            if dport == 0: return False
+        hdrlen, saddr, daddr, sport, dport = self.__get_ipv4_dgram_pkt_addr_info()
+        if dport == 0: return False
 
         # 把源地址和checksum设置为0
         mbuf.offset = 12
@@ -324,30 +506,15 @@ class _fdslight_server(dispatcher.dispatcher):
         mbuf.replace(b"\0\0")
         ##
 
-        if offset != 0:
-            mbuf.offset = 0
-            self.send_message_to_handler(-1, self.__raw_fileno, mbuf.get_data())
-            return
-
-        _id = "%s-%s" % (sts_saddr, sport,)
+        flw = self.__get_dgram_flow(session_id, saddr, sport, is_udplite, False)
+        peer = (daddr, dport,)
+        if peer not in flw.permits: self.__add_dgram_permit(flw, peer)
+        flw.update_time = time.time()
+        new_sport = flw.local_port
 
-        fileno = -1
-        if session_id in self.__dgram_proxy:
-            pydict = self.__dgram_proxy[session_id]
-            if _id in pydict: fileno = pydict[_id]
-
-        if fileno < 0:
-            fileno = self.create_handler(
-                -1, traffic_pass.p2p_proxy,
-                session_id, (sts_saddr, sport,), is_udplite=is_udplite, is_ipv6=False
-            )
-        self.get_handler(fileno).add_permit((sts_daddr, dport,))
-        _, new_sport = self.get_handler(fileno).getsockname()
-
-        hdrlen = self.__get_ip4_hdrlen()
         # 替换源端口
         mbuf.offset = hdrlen
-        mbuf.replace(utils.number2bytes(new_sport, 2))
+        mbuf.replace(struct.pack("!H", new_sport))
 
         mbuf.offset = hdrlen + 6
 
@@ -355,18 +522,70 @@ class _fdslight_server(dispatcher.dispatcher):
             mbuf.replace(b"\0\0")
         else:
             csum = utils.bytes2number(mbuf.get_part(2))
-            csum = fn_utils.calc_incre_csum(csum, sport, new_sport)
-            mbuf.replace(utils.number2bytes(csum, 2))
-
-        if session_id not in self.__dgram_proxy:
-            self.__dgram_proxy[session_id] = {}
-
-        pydict = self.__dgram_proxy[session_id]
-        pydict[_id] = fileno
+            csum = checksum.calc_incre_csum(csum, sport, new_sport)
+            mbuf.replace(struct.pack("!H", csum))
 
         mbuf.offset = 0
         self.send_message_to_handler(-1, self.__raw_fileno, mbuf.get_data())
 
+    def __new_dgram_socket(self, is_udplite, is_ipv6, is_shared=False):
+        return self.create_handler(
+            -1, traffic_pass.p2p_proxy, is_udplite=is_udplite, is_ipv6=is_ipv6, is_shared=is_shared
+        )
+
+    def __get_dgram_flow(self, session_id, byte_saddr, sport, is_udplite, is_ipv6):
+        """获取UDP全锥形代理的流,不存在时创建
+        :return: udp_flow.flow
+        """
+        flw = self.__dgram_flows.get((session_id, byte_saddr, sport,))
+        if flw: return flw
+
+        flw = udp_flow.flow(session_id, byte_saddr, sport, is_udplite=is_udplite, is_ipv6=is_ipv6)
+
+        if self.__dgram_pool_size > 0:
+            fileno = self.__get_pooled_dgram_socket(is_udplite, is_ipv6)
+        else:
+            fileno = self.__new_dgram_socket(is_udplite, is_ipv6)
+
+        self.get_handler(fileno).add_flow(flw)
+        self.__dgram_flows.add(flw)
+
+        return flw
+
+    def __get_pooled_dgram_socket(self, is_udplite, is_ipv6):
+        """套接字池没有满时创建新的共享套接字,否则选择流最少的共享套接字"""
+        pool = self.__dgram_pools.setdefault((is_udplite, is_ipv6,), [])
+        if len(pool) < self.__dgram_pool_size:
+            fileno = self.__new_dgram_socket(is_udplite, is_ipv6, is_shared=True)
+            pool.append(fileno)
+            return fileno
+
+        return min(pool, key=lambda fd: self.get_handler(fd).flow_count)
+
+    def __add_dgram_permit(self, flw, peer):
+        if self.get_handler(flw.fileno).add_permit(flw, peer): return
+
+        # 共享套接字中这个对端已经被其他的流使用,无法区分应答属于哪个流,这个流改为使用独占的套接字
+        self.get_handler(flw.fileno).remove_flow(flw)
+        fileno = self.__new_dgram_socket(flw.is_udplite, flw.is_ipv6)
+        self.get_handler(fileno).add_flow(flw)
+        self.get_handler(fileno).add_permit(flw, peer)
+
+    def __release_dgram_flow(self, flw):
+        self.__dgram_flows.remove(flw)
+        if not self.handler_exists(flw.fileno): return
+
+        h = self.get_handler(flw.fileno)
+        h.remove_flow(flw)
+        if not h.is_shared: self.delete_handler(flw.fileno)
+
+    def __expire_dgram_flows(self):
+        now = time.time()
+        if now - self.__dgram_expire_time < self.__DGRAM_EXPIRE_INTERVAL: return
+        self.__dgram_expire_time = now
+
+        for flw in self.__dgram_flows.expire(): self.__release_dgram_flow(flw)
+
     def __handle_socks_data_from_tunnel(self, session_id, message):
         try:
             cookie_id = (message[0] << 8) | message[1]
@@ -435,7 +654,8 @@ class _fdslight_server(dispatcher.dispatcher):
         return True
 
     def __send_msg_to_tunnel(self, session_id, action, message):
-        if not self.__access.session_exists(session_id): return
+        s = self.__access.get_session_info(session_id)
+        if not s: return
 
         if action == proto_utils.ACT_IPDATA:
             size = self.__mbuf.payload_size
@@ -443,12 +663,17 @@ class _fdslight_server(dispatcher.dispatcher):
             size = len(message)
         if not self.__access.data_for_send(session_id, size): return
 
-        session_info = self.__access.get_session_info(session_id)
-        fileno = session_info[0]
+        if session_id in self.__session_tunnels:
+            fileno = self.__select_tunnel(session_id, action, message)
+        else:
+            fileno = s.fileno
 
-        if not self.handler_exists(fileno): return
+        if not self.handler_exists(fileno):
+            if session_id in self.__lost_sessions: self.__hold_msg(session_id, action, message)
+            return
 
-        self.get_handler(fileno).send_msg(session_id, session_info[2], action, message)
+        self.__count_traffic(False, s.username, fileno, size)
+        self.get_handler(fileno).send_msg(session_id, s.address, action, message)
 
     def send_msg_to_tunnel_from_tun(self, message):
         if len(message) > utils.MBUF_AREA_SIZE: return
@@ -485,6 +710,10 @@ class _fdslight_server(dispatcher.dispatcher):
         resp_data = app_proxy_proto.build_udp_send_data(cookie_id, atyp, address, port, message)
         self.__send_msg_to_tunnel(session_id, proto_utils.ACT_SOCKS, resp_data)
 
+    def resolve_host(self, fileno, host):
+        """异步解析域名,参见async_resolver.resolver.resolve"""
+        return self.get_handler(self.__resolver_fileno).resolve(fileno, host)
+
     def response_socks_connstate(self, session_id, cookie_id, resp_code):
         resp_data = app_proxy_proto.build_respconn(cookie_id, resp_code)
         self.__send_msg_to_tunnel(session_id, proto_utils.ACT_SOCKS, resp_data)
@@ -504,8 +733,7 @@ class _fdslight_server(dispatcher.dispatcher):
         :return:
         """
         # 添加一条到tun设备的IPV4路由
-        cmd = "route add -net %s/%s dev %s" % (subnet, prefix, self.__DEVNAME)
-        os.system(cmd)
+        self.get_handler(self.__route_fileno).add_route(subnet, prefix)
         # 开启ip forward
         os.system("echo 1 > /proc/sys/net/ipv4/ip_forward")
         # 开启IPV4 NAT
@@ -519,13 +747,13 @@ class _fdslight_server(dispatcher.dispatcher):
         :param eth_name:
         :return:
         """
+        route = self.get_handler(self.__route_fileno)
         # 添加一条到tun设备的IPv6路由
-        cmd = "route add -A inet6 %s/%s dev %s" % (ip6_subnet, prefix, self.__DEVNAME)
-        os.system(cmd)
+        route.add_route(ip6_subnet, prefix, is_ipv6=True)
         # 开启IPV6流量重定向
         os.system("echo 1 >/proc/sys/net/ipv6/conf/all/forwarding")
 
-        os.system("ip -6 route add default via %s dev %s" % (ip6_gw, eth_name,))
+        route.add_route("::", 0, is_ipv6=True, gateway=ip6_gw, ifname=eth_name)
 
         os.system("ip6tables -t nat -A POSTROUTING -s %s/%s -o %s -j MASQUERADE" % (ip6_subnet, prefix, eth_name,))
         os.system("ip6tables -A FORWARD -s %s/%s -j ACCEPT" % (ip6_subnet, prefix))
@@ -538,58 +766,123 @@ class _fdslight_server(dispatcher.dispatcher):
 
     def __get_ipv4_dgram_pkt_addr_info(self):
         """获取数据包的地址信息
-        :param mbuf:
-        :return:
+        :return: (hdrlen,byte_saddr,byte_daddr,sport,dport,)
         """
         mbuf = self.__mbuf
 
         hdrlen = self.__get_ip4_hdrlen()
+        mbuf.offset = 0
+        hdr = mbuf.get_part(hdrlen + 4)
+        sport, dport = struct.unpack_from("!HH", hdr, hdrlen)
 
-        mbuf.offset = hdrlen + 2
-        dport = utils.bytes2number(mbuf.get_part(2))
-        mbuf.offset = hdrlen
-        sport = utils.bytes2number(mbuf.get_part(2))
-
-        mbuf.offset = 16
-        daddr = mbuf.get_part(4)
-        mbuf.offset = 12
-        saddr = mbuf.get_part(4)
-
-        return (socket.inet_ntoa(saddr), socket.inet_ntoa(daddr), sport, dport,)
+        return (hdrlen, hdr[12:16], hdr[16:20], sport, dport,)
 
-    def __handle_ipv6_dgram_from_tunnel(self, session_id, is_udplite=False):
+    def __handle_ipv6_dgram_from_tunnel(self, session_id, ip6_pkt, is_udplite=False):
         """处理IPV6 dgram数据报
         :return:
         """
-        dgram_proxy = self.__ip6_dgram[session_id]
+        ip6_pkt = self.__dgram_reasm.add(session_id, ip6_pkt)
+        if not ip6_pkt: return
+
+        # 重组之后的数据包已经没有分片头
+        try:
+            _, offset, frag_hdr_offset, _ = ipfrag.ip6_upper_layer(ip6_pkt)
+        except ipfrag.IPFragErr:
+            return
+        if frag_hdr_offset >= 0: return
 
-        dgram_proxy.add_frag(self.__mbuf)
+        self.__send_dgram_by_flow(
+            session_id, ip6_pkt, offset, bytes(ip6_pkt[8:24]), bytes(ip6_pkt[24:40]), is_udplite, True
+        )
 
-        data = dgram_proxy.get_data()
-        if not data: return
+    def __send_dgram_by_flow(self, session_id, ip_pkt, offset, byte_saddr, byte_daddr, is_udplite, is_ipv6):
+        """通过流的代理套接字发送完整的UDP或者UDPLite数据报
+        :param ip_pkt: 完整的IP数据包
+        :param offset: UDP头部的偏移
+        :return:
+        """
+        if len(ip_pkt) < offset + 8: return
 
-        saddr, daddr, sport, dport, msg = data
+        sport, dport = struct.unpack_from("!HH", ip_pkt, offset)
+        if dport == 0: return
 
-        if session_id not in self.__dgram_proxy:
-            self.__dgram_proxy[session_id] = {}
-        pydict = self.__dgram_proxy[session_id]
+        flw = self.__get_dgram_flow(session_id, byte_saddr, sport, is_udplite, is_ipv6)
+        peer = (byte_daddr, dport,)
+        if peer not in flw.permits: self.__add_dgram_permit(flw, peer)
+        flw.update_time = time.time()
 
-        dgram_id = "%s-%s" % (saddr, sport,)
-        if dgram_id not in pydict:
-            fileno = self.create_handler(
-                -1, traffic_pass.p2p_proxy,
-                session_id, (saddr, sport), is_udplite=is_udplite, is_ipv6=True
-            )
-            pydict[dgram_id] = fileno
-        fileno = pydict[dgram_id]
-        self.get_handler(fileno).send_msg(msg, (daddr, dport))
+        if is_ipv6:
+            address = socket.inet_ntop(socket.AF_INET6, byte_daddr)
+        else:
+            address = socket.inet_ntoa(byte_daddr)
+
+        self.get_handler(flw.fileno).send_msg(bytes(ip_pkt[offset + 8:]), (address, dport,))
 
     def tell_register_session(self, session_id):
         """告知注册session
         :param session_id:
         :return:
         """
-        self.__ip6_dgram[session_id] = ip6dgram.ip6_dgram_proxy()
+        pass
+
+    def tell_session_migrate(self, session_id, old_fileno, fileno, old_address, address):
+        """告知会话迁移,客户端改变了地址或者重新建立了隧道连接
+        :param session_id:
+        :param old_fileno:
+        :param fileno:
+        :param old_address:
+        :param address:
+        :return:
+        """
+        # 使用多个连接的会话由加入消息管理连接
+        if session_id in self.__session_tunnels: return
+        if old_address != address: logging.print_general("migrate_session", address)
+        if old_fileno == fileno: return
+        if old_fileno in (self.__udp6_fileno, self.__udp_fileno,): return
+
+        # 客户端已经使用新的连接,删除旧的TCP连接,此时会话的连接已经修改,不会触发代理的删除
+        if self.handler_exists(old_fileno): self.delete_handler(old_fileno)
+
+    def __tunnel_lost(self, session_id):
+        """会话的隧道断开,在保留时间之后删除代理"""
+        if self.__session_grace < 1:
+            self.tell_del_all_app_proxy(session_id)
+            return
+        if session_id not in self.__app_proxy: return
+
+        self.__lost_sessions[session_id] = time.time() + self.__session_grace
+
+    def __resume_session(self, session_id):
+        """客户端在保留时间之内重新连接,发送隧道断开期间的代理数据"""
+        del self.__lost_sessions[session_id]
+        msgs = self.__held_msgs.pop(session_id, None)
+        if not msgs: return
+
+        for action, message in msgs: self.__send_msg_to_tunnel(session_id, action, message)
+
+    def __hold_msg(self, session_id, action, message):
+        # 只有代理数据需要保证完整,其他数据由应用重传
+        if action != proto_utils.ACT_SOCKS: return
+
+        if session_id not in self.__held_msgs: self.__held_msgs[session_id] = deque()
+        msgs = self.__held_msgs[session_id]
+
+        if len(msgs) >= self.__MAX_HELD_MSGS:
+            del self.__lost_sessions[session_id]
+            del self.__held_msgs[session_id]
+            self.tell_del_all_app_proxy(session_id)
+            return
+        msgs.append((action, message,))
+
+    def __expire_lost_sessions(self):
+        now = time.time()
+        expired = [session_id for session_id, t in self.__lost_sessions.items() if t <= now]
+
+        for session_id in expired:
+            del self.__lost_sessions[session_id]
+            self.__held_msgs.pop(session_id, None)
+            self.tell_del_all_app_proxy(session_id)
+        ''''''
 
     def tell_unregister_session(self, session_id, fileno):
         """告知取消session注册
@@ -597,24 +890,31 @@ class _fdslight_server(dispatcher.dispatcher):
         :param fileno:
         :return:
         """
+        tunnels = self.__session_tunnels.pop(session_id, [])
+        for fd in tunnels:
+            if fd >= 0 and fd != fileno: self.delete_handler(fd)
+
         if fileno not in (self.__udp_fileno, self.__udp6_fileno):
             self.delete_handler(fileno)
-        del self.__ip6_dgram[session_id]
+        self.__dgram_reasm.remove_session(session_id)
 
-    def tell_del_dgram_proxy(self, session_id, saddr, sport):
-        """告知删除UDP代理
-        :param session_id:
-        :param saddr:
-        :param sport:
+        # 会话已经删除,不再等待客户端重新连接
+        if self.__lost_sessions.pop(session_id, None): self.tell_del_all_app_proxy(session_id)
+        self.__held_msgs.pop(session_id, None)
+
+        for flw in self.__dgram_flows.session_flows(session_id): self.__release_dgram_flow(flw)
+
+    def tell_del_dgram_proxy(self, fileno, flows):
+        """告知UDP代理套接字已经删除
+        :param fileno:
+        :param flows: 使用这个套接字的流
         :return:
         """
-        if session_id not in self.__dgram_proxy: return
-        pydict = self.__dgram_proxy[session_id]
-        key = "%s-%s" % (saddr, sport)
+        for flw in flows: self.__dgram_flows.remove(flw)
 
-        if key not in pydict: return
-        del pydict[key]
-        if not pydict: del self.__dgram_proxy[session_id]
+        for pool in self.__dgram_pools.values():
+            if fileno in pool: pool.remove(fileno)
+        ''''''
 
     def tell_del_app_proxy(self, session_id, cookie_id):
         if session_id not in self.__app_proxy: return
@@ -623,6 +923,33 @@ class _fdslight_server(dispatcher.dispatcher):
         del pydict[cookie_id]
         if not pydict: del self.__app_proxy[session_id]
 
+    def tell_tunnel_close(self, fileno, session_id):
+        """告知TCP隧道连接关闭
+        :param fileno:
+        :param session_id:
+        :return:
+        """
+        # 连接只记录最后一个会话,同一个连接上的其他会话通过索引找到
+        for sid in self.__access.fileno_sessions(fileno):
+            if sid != session_id and sid not in self.__session_tunnels: self.__tunnel_lost(sid)
+
+        if session_id not in self.__session_tunnels:
+            s = self.__access.get_session_info(session_id)
+            # 会话已经迁移到新的连接
+            if s and s.fileno != fileno: return
+            self.__tunnel_lost(session_id)
+            return
+
+        tunnels = self.__session_tunnels[session_id]
+        if fileno not in tunnels: return
+
+        # socks数据只通过第一个连接传送,这个连接关闭之后代理不再可用
+        is_primary = self.__select_tunnel(session_id, proto_utils.ACT_DNS, None) == fileno
+        tunnels[tunnels.index(fileno)] = -1
+
+        if tunnels.count(-1) == len(tunnels): del self.__session_tunnels[session_id]
+        if is_primary: self.__tunnel_lost(session_id)
+
     def tell_del_all_app_proxy(self, session_id):
         """删除用户的所有代理
         :param session_id:
@@ -635,6 +962,10 @@ class _fdslight_server(dispatcher.dispatcher):
         for fileno, is_tcp in seq: self.delete_handler(fileno)
         return
 
+    def __reload_users(self, signum, frame):
+        """重新加载用户,只删除已经不存在的用户的会话"""
+        self.__access.request_reload()
+
     def __exit(self, signum, frame):
         if self.handler_exists(self.__dns_fileno):
             self.delete_handler(self.__dns_fileno)
@@ -680,9 +1011,20 @@ def __stop_service():
     os.kill(pid, signal.SIGINT)
 
 
+def __update_users():
+    pid = proc.get_pid(PID_FILE)
+
+    if pid < 0:
+        print("cannot found fdslight server process")
+        return
+
+    os.kill(pid, signal.SIGUSR1)
+
+
 def main():
     help_doc = """
     -d      debug | start | stop    debug,start or stop application
+    -u      users                   reload users
     """
     try:
         opts, args = getopt.getopt(sys.argv[1:], "u:m:d:")
@@ -690,9 +1032,19 @@ def main():
         print(help_doc)
         return
     d = ""
+    u = ""
 
     for k, v in opts:
         if k == "-d": d = v
+        if k == "-u": u = v
+
+    if u and u != "users":
+        print(help_doc)
+        return
+    if u == "users":
+        __update_users()
+        return
+
     if not d:
         print(help_doc)
         return
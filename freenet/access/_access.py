@@ -1,24 +1,62 @@
 #!/usr/bin/env python3
-import pywind.lib.timer as timer
+import time
 import freenet.lib.base_proto.utils as proto_utils
 import freenet.lib.logging as logging
 
 
+class session(object):
+    """会话信息,get_session_info返回的是引用,不要修改fileno与address,请使用modify_session"""
+    __slots__ = ("session_id", "fileno", "username", "address", "priv_data", "update_time",)
+
+    def __init__(self, session_id, fileno, username, address, priv_data=None):
+        self.session_id = session_id
+        self.fileno = fileno
+        self.username = username
+        self.address = address
+        self.priv_data = priv_data
+        # 最后一次发送数据的时间
+        self.update_time = time.time()
+
+    def __getitem__(self, i):
+        """兼容以前的 (fileno,username,address,priv_data) 元组"""
+        return (self.fileno, self.username, self.address, self.priv_data,)[i]
+
+
 class access(object):
-    __timer = None
     __sessions = None
+    # 文件描述符到会话的索引 fileno -> {session_id,...}
+    __fileno_sessions = None
     # 会话超时时间
     __SESSION_TIMEOUT = 800
+    # 检查会话超时的时间间隔
+    __SWEEP_INTERVAL = 10
+    __sweep_time = 0
+    # 事件循环每次更新的时间,数据包只记录这个时间,不需要每次获取系统时间
+    __now = 0
 
     __dispatcher = None
+    __configs = None
+    # 是否需要重新加载用户
+    __reload = False
 
-    def __init__(self, dispatcher):
-        self.__timer = timer.timer()
+    def __init__(self, dispatcher, configs=None):
+        """
+        :param dispatcher:
+        :param configs: 配置文件的connection节
+        """
         self.__sessions = {}
+        self.__fileno_sessions = {}
+        self.__now = time.time()
+        self.__sweep_time = self.__now
         self.__dispatcher = dispatcher
+        self.__configs = configs or {}
 
         self.init()
 
+    @property
+    def configs(self):
+        return self.__configs
+
     def init(self):
         """初始化函数,重写这个方法"""
         pass
@@ -48,6 +86,18 @@ class access(object):
         """处理会话关闭"""
         pass
 
+    def handle_migrate(self, session_id, old_address, address):
+        """处理会话迁移,客户端地址或者隧道连接改变时调用,重写这个方法"""
+        pass
+
+    def handle_reload(self):
+        """重新加载用户,重写这个方法"""
+        pass
+
+    def request_reload(self):
+        """请求重新加载用户,可以在信号处理函数中调用,加载在事件循环中进行"""
+        self.__reload = True
+
     def add_session(self, fileno, username, session_id, address, priv_data=None):
         """加入会话
         :param fileno:文件描述符
@@ -59,15 +109,33 @@ class access(object):
         """
         if self.session_exists(session_id): return
 
-        self.__sessions[session_id] = [fileno, username, address, priv_data, ]
-        self.__timer.set_timeout(session_id, self.__SESSION_TIMEOUT)
+        self.__sessions[session_id] = session(session_id, fileno, username, address, priv_data=priv_data)
+        self.__index_fileno(fileno, session_id)
         self.__dispatcher.tell_register_session(session_id)
         logging.print_general("add_session:%s" % username, address)
 
+    def __index_fileno(self, fileno, session_id):
+        if fileno not in self.__fileno_sessions: self.__fileno_sessions[fileno] = set()
+        self.__fileno_sessions[fileno].add(session_id)
+
+    def __unindex_fileno(self, fileno, session_id):
+        seq = self.__fileno_sessions.get(fileno, None)
+        if seq is None: return
+
+        seq.discard(session_id)
+        if not seq: del self.__fileno_sessions[fileno]
+
     def get_session_info(self, session_id):
-        if session_id not in self.__sessions: return None
+        """
+        :return: session对象,会话不存在返回None
+        """
+        return self.__sessions.get(session_id, None)
 
-        return tuple(self.__sessions[session_id])
+    def fileno_sessions(self, fileno):
+        """使用这个文件描述符的会话
+        :return: [session_id,...]
+        """
+        return list(self.__fileno_sessions.get(fileno, ()))
 
     def del_session(self, session_id):
         """删除会话
@@ -76,30 +144,42 @@ class access(object):
         """
         if session_id not in self.__sessions: return
 
-        self.__timer.drop(session_id)
         self.handle_close(session_id)
-        fileno, username, address, priv_data = self.__sessions[session_id]
-        self.__dispatcher.tell_unregister_session(session_id,fileno)
+        s = self.__sessions[session_id]
+        self.__dispatcher.tell_unregister_session(session_id, s.fileno)
 
-        logging.print_general("del_session:%s" % username, address)
+        logging.print_general("del_session:%s" % s.username, s.address)
         del self.__sessions[session_id]
+        self.__unindex_fileno(s.fileno, session_id)
 
     def modify_session(self, session_id, fileno, address):
         """修改地址和文件描述符信息,如果没有变化则不修改
+        地址或者文件描述符改变时说明客户端已经漫游或者重新连接,通知会话迁移
         :param session_id:
         :param address:
         :return:
         """
-        a = "%s-%s" % address
-        b = "%s-%s" % (self.__sessions[session_id][2])
+        s = self.__sessions[session_id]
+        if s.fileno == fileno and s.address == address: return
 
-        if a != b:
-            self.__sessions[session_id][2] = address
-        self.__sessions[session_id][0] = fileno
+        old_fileno = s.fileno
+        old_address = s.address
+        s.fileno = fileno
+        s.address = address
+
+        if old_fileno != fileno:
+            self.__unindex_fileno(old_fileno, session_id)
+            self.__index_fileno(fileno, session_id)
+
+        self.handle_migrate(session_id, old_address, address)
+        self.__dispatcher.tell_session_migrate(session_id, old_fileno, fileno, old_address, address)
 
     def session_exists(self, session_id):
         return session_id in self.__sessions
 
+    def session_count(self):
+        return len(self.__sessions)
+
     def gen_session_id(self, username, password):
         """生成用户session id
         :param username:
@@ -108,16 +188,29 @@ class access(object):
         """
         return proto_utils.gen_session_id(username, password)
 
+    def __sweep(self):
+        t = self.__now - self.__SESSION_TIMEOUT
+        expired = [session_id for session_id, s in self.__sessions.items() if s.update_time < t]
+
+        for session_id in expired: self.del_session(session_id)
+
     def access_loop(self):
-        names = self.__timer.get_timeout_names()
-        for name in names:
-            if not self.__timer.exists(name): continue
-            self.del_session(name)
+        self.__now = time.time()
+        if self.__now - self.__sweep_time >= self.__SWEEP_INTERVAL:
+            self.__sweep_time = self.__now
+            self.__sweep()
+        if self.__reload:
+            self.__reload = False
+            self.handle_reload()
+        self.handle_access_loop()
         return
 
     def data_for_send(self, session_id, pkt_len):
         b = self.handle_send(session_id, pkt_len)
-        if b: self.__timer.set_timeout(session_id, self.__SESSION_TIMEOUT)
+        if not b: return b
+
+        s = self.__sessions.get(session_id, None)
+        if s: s.update_time = self.__now
 
         return b
 
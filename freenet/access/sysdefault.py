@@ -1,42 +1,94 @@
 #!/usr/bin/env python3
 
 import freenet.access._access as _access
-import os, json
+import freenet.lib.accounting as accounting
+import freenet.lib.auth_backend as auth_backend
+import os, sys, time
 
 
 class access(_access.access):
-    __users = None
+    """用户由auth_backend提供,默认为access.json
+    用户可以有以下可选项:
+    rate_limit: 每个方向每秒允许的字节数,0表示不限制
+    burst: 速率限制允许的突发字节数,默认为一秒的流量
+    monthly_quota: 每月两个方向合计的流量字节数,0表示不限制
+    """
+    __auth = None
+    __accounting = None
+
+    # 检查用户文件是否改变的时间间隔,0表示只在收到信号时重新加载
+    __watch_interval = 5
+    __watch_time = 0
 
     def init(self):
         my_dir = os.path.dirname(__file__)
-        config_path = "%s/../../fdslight_etc/access.json" % my_dir
+        etc_dir = "%s/../../fdslight_etc" % my_dir
+        configs = self.configs
+
+        name = configs.get("auth_backend", "json")
+        source = configs.get("auth_source", "access.json")
+        if name != "service": source = "%s/%s" % (etc_dir, source,)
+
+        self.__watch_interval = int(configs.get("auth_watch_interval", 5))
+        self.__watch_time = time.time()
 
-        self.__users = {}
+        # 用户流量记录文件
+        accounting_path = "%s/accounting.dat" % etc_dir
 
-        with open(config_path, "r") as f:
-            users_info = json.loads(f.read())
+        self.__accounting = accounting.accounting(accounting_path)
 
-        for dic in users_info:
-            username = dic["username"]
-            passwd = dic["password"]
+        try:
+            self.__auth = auth_backend.authenticator(auth_backend.create_backend(name, source), self.gen_session_id)
+            self.__auth.load()
+        except auth_backend.AuthErr as e:
+            print(e)
+            sys.exit(-1)
 
-            session_id = self.gen_session_id(username, passwd)
-            self.__users[session_id] = username
+    def __add_account(self, session_id, user):
+        self.__accounting.add_user(
+            session_id, user["username"], rate_limit=int(user.get("rate_limit", 0) or 0),
+            burst=int(user.get("burst", 0) or 0), monthly_quota=int(user.get("monthly_quota", 0) or 0)
+        )
 
     def handle_recv(self, fileno, session_id, address, data_len):
-        if session_id not in self.__users: return False
+        user = self.__auth.get(session_id)
+        if user is None: return False
         if not self.session_exists(session_id):
-            self.add_session(fileno, self.__users[session_id], session_id, address)
+            self.__add_account(session_id, user)
+            self.add_session(fileno, user["username"], session_id, address)
 
-        return True
+        return self.__accounting.recv(session_id, data_len)
 
     def handle_send(self, session_id, data_len):
         if not self.session_exists(session_id): return False
 
-        return True
+        return self.__accounting.send(session_id, data_len)
 
     def handle_close(self, session_id):
-        pass
+        self.__accounting.remove_user(session_id)
+
+    def handle_reload(self):
+        # 在工作线程中加载,结果在handle_access_loop中处理
+        self.__auth.reload()
+
+    def __users_reloaded(self, added, removed, changed):
+        # 只删除已经不存在的用户的会话,其他用户的隧道不受影响
+        for session_id in removed:
+            if self.session_exists(session_id): self.del_session(session_id)
+
+        for session_id, user in changed.items():
+            if self.session_exists(session_id): self.__add_account(session_id, user)
 
     def handle_access_loop(self):
-        pass
+        rs = self.__auth.poll()
+        if rs: self.__users_reloaded(*rs)
+
+        self.__accounting.loop()
+
+        if self.__watch_interval < 1: return
+
+        now = time.time()
+        if now - self.__watch_time < self.__watch_interval: return
+        self.__watch_time = now
+
+        if self.__auth.changed(): self.handle_reload()
@@ -1,12 +1,12 @@
 #!/usr/bin/env python3
 
 
-import pywind.evtframework.handlers.tcp_handler as tcp_handler
 import pywind.evtframework.handlers.udp_handler as udp_handler
+import freenet.handlers.tcp_connector as tcp_connector
 import time, socket
 
 
-class tcp_proxy(tcp_handler.tcp_handler):
+class tcp_proxy(tcp_connector.tcp_connector):
     __TIMEOUT = 600
     __update_time = 0
     __cookie_id = None
@@ -19,16 +19,9 @@ class tcp_proxy(tcp_handler.tcp_handler):
     __is_ipv6 = None
 
     def init_func(self, creator, session_id, cookie_id, address, is_ipv6=False, debug=True, reconn=False):
-        if is_ipv6:
-            fa = socket.AF_INET6
-        else:
-            fa = socket.AF_INET
-
         self.__cookie_id = cookie_id
         self.__session_id = session_id
 
-        s = socket.socket(fa, socket.SOCK_STREAM)
-        if is_ipv6: s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
         self.__cookie_id = cookie_id
         self.__debug = debug
         self.__reconnect = reconn
@@ -37,8 +30,9 @@ class tcp_proxy(tcp_handler.tcp_handler):
 
         if self.__debug: print(address, self.__cookie_id)
 
-        self.set_socket(s)
-        self.connect(address)
+        self.create_socket(is_ipv6)
+        # 域名在这里异步解析,不会阻塞事件循环
+        self.connect_host(address)
 
         return self.fileno
 
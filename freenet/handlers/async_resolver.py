@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""异步域名解析
+getaddrinfo是阻塞调用,放在工作线程中执行,结果通过管道唤醒事件循环之后再通知请求者
+解析结果有正向缓存与否定缓存,相同域名的并发请求只解析一次
+"""
+
+import os, socket, threading, queue, time
+from collections import OrderedDict, deque
+
+import pywind.evtframework.handlers.handler as handler
+import freenet.lib.utils as utils
+import freenet.lib.metrics as metrics
+
+try:
+    import fcntl
+except ImportError:
+    pass
+
+_resolve_total = metrics.new_counter("resolver_queries_total", "hostname resolutions", ("result",))
+
+
+def interleave_addrs(addrs):
+    """按照Happy Eyeballs的方式交替排列IPv6与IPv4地址,IPv6优先
+    :param addrs: [(family,ip),...]
+    :return: [(family,ip),...]
+    """
+    ip6s = [addr for addr in addrs if addr[0] == socket.AF_INET6]
+    ip4s = [addr for addr in addrs if addr[0] == socket.AF_INET]
+    results = []
+
+    for i in range(max(len(ip6s), len(ip4s))):
+        if i < len(ip6s): results.append(ip6s[i])
+        if i < len(ip4s): results.append(ip4s[i])
+    ''''''
+
+    return results
+
+
+def _getaddrinfo(host):
+    """在工作线程中执行
+    :return: [(family,ip),...],解析失败返回空列表
+    """
+    try:
+        rs = socket.getaddrinfo(host, None, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    except (socket.gaierror, UnicodeError, OSError):
+        return []
+
+    results = []
+    for family, socktype, proto, canonname, sockaddr in rs:
+        if family not in (socket.AF_INET, socket.AF_INET6,): continue
+        addr = (family, sockaddr[0],)
+        if addr in results: continue
+        results.append(addr)
+
+    return interleave_addrs(results)
+
+
+def _query_nameservers(host, nameservers):
+    """在工作线程中执行,向指定的DNS服务器查询,不经过系统的解析配置
+    :return: [(family,ip),...],解析失败返回空列表
+    """
+    import dns.resolver, dns.exception
+
+    r = dns.resolver.Resolver(configure=False)
+    r.nameservers = nameservers
+    r.lifetime = 5
+    results = []
+
+    for family, qtype in ((socket.AF_INET6, "AAAA",), (socket.AF_INET, "A",),):
+        try:
+            rs = r.query(host, qtype)
+        except dns.exception.DNSException:
+            continue
+        for answer in rs: results.append((family, answer.__str__(),))
+    ''''''
+
+    return interleave_addrs(results)
+
+
+class resolver(handler.handler):
+    # 正向缓存时间,getaddrinfo不返回TTL,因此使用固定时间
+    __POS_TTL = 300
+    # 否定缓存时间
+    __NEG_TTL = 30
+
+    __max_cache_size = None
+    # 域名映射到 [过期时间,地址列表]
+    __caches = None
+    # 域名映射到等待结果的文件描述符列表
+    __waiters = None
+
+    __requests = None
+    __results = None
+    __threads = None
+
+    __wakeup_w = None
+    __nameservers = None
+    __name = None
+
+    def init_func(self, creator_fd, workers=4, cache_size=4096, nameservers=None, name="default"):
+        """
+        :param creator_fd:
+        :param workers: 解析线程数
+        :param cache_size: 缓存的最大条目数
+        :param nameservers: DNS服务器列表,为None表示使用系统的getaddrinfo
+        :param name: 名称,用于指标
+        """
+        r, w = os.pipe()
+        for fd in (r, w,): fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        self.__wakeup_w = w
+        self.__nameservers = nameservers
+        self.__name = name
+        self.__max_cache_size = cache_size
+        self.__caches = OrderedDict()
+        self.__waiters = {}
+
+        self.__requests = queue.Queue()
+        # deque的append与popleft是线程安全的
+        self.__results = deque()
+        self.__threads = []
+
+        for i in range(workers):
+            t = threading.Thread(target=self.__worker, daemon=True)
+            t.start()
+            self.__threads.append(t)
+
+        metrics.new_gauge("resolver_pending", "hostname resolutions in progress", ("resolver",)).set_function(
+            lambda: [((name,), len(self.__waiters),)], key=name
+        )
+
+        self.set_fileno(r)
+        self.register(r)
+        self.add_evt_read(r)
+
+        return r
+
+    def __worker(self):
+        while 1:
+            host = self.__requests.get()
+            if host is None: break
+            if self.__nameservers:
+                addrs = _query_nameservers(host, self.__nameservers)
+            else:
+                addrs = _getaddrinfo(host)
+            self.__results.append((host, addrs,))
+
+            try:
+                os.write(self.__wakeup_w, b"\0")
+            except BlockingIOError:
+                # 管道已满说明事件循环已经被唤醒
+                pass
+            except OSError:
+                break
+            ''''''
+        return
+
+    def __cache_put(self, host, addrs):
+        if self.__max_cache_size < 1: return
+        if addrs:
+            ttl = self.__POS_TTL
+        else:
+            ttl = self.__NEG_TTL
+
+        if host in self.__caches: del self.__caches[host]
+        self.__caches[host] = [time.time() + ttl, addrs]
+
+        while len(self.__caches) > self.__max_cache_size: self.__caches.popitem(last=False)
+
+    def __cache_get(self, host):
+        if host not in self.__caches: return None
+
+        expire_time, addrs = self.__caches[host]
+        if time.time() >= expire_time:
+            del self.__caches[host]
+            return None
+
+        self.__caches.move_to_end(host)
+
+        return addrs
+
+    def resolve(self, fileno, host):
+        """解析域名
+        :param fileno: 请求者的文件描述符,结果通过handler_ctl的resolve_result命令通知
+        :param host:
+        :return: 有缓存时直接返回地址列表[(family,ip),...],空列表表示解析失败;None表示需要等待通知
+        """
+        if utils.is_ipv4_address(host): return [(socket.AF_INET, host,)]
+        if utils.is_ipv6_address(host): return [(socket.AF_INET6, host,)]
+
+        host = host.lower()
+        addrs = self.__cache_get(host)
+
+        if addrs is not None:
+            _resolve_total.inc(1, ("cache",))
+            return addrs
+
+        if host in self.__waiters:
+            if fileno not in self.__waiters[host]: self.__waiters[host].append(fileno)
+            return None
+
+        self.__waiters[host] = [fileno]
+        self.__requests.put(host)
+
+        return None
+
+    def evt_read(self):
+        while 1:
+            try:
+                os.read(self.fileno, 4096)
+            except BlockingIOError:
+                break
+            ''''''
+
+        while self.__results:
+            host, addrs = self.__results.popleft()
+            self.__cache_put(host, addrs)
+
+            if addrs:
+                _resolve_total.inc(1, ("ok",))
+            else:
+                _resolve_total.inc(1, ("fail",))
+
+            waiters = self.__waiters.pop(host, [])
+            for fd in waiters:
+                if not self.handler_exists(fd): continue
+                self.ctl_handler(self.fileno, fd, "resolve_result", host, addrs)
+            ''''''
+        return
+
+    def clear(self):
+        self.__caches = OrderedDict()
+
+    def delete(self):
+        metrics.new_gauge("resolver_pending", "hostname resolutions in progress", ("resolver",)).del_function(
+            key=self.__name
+        )
+        for t in self.__threads: self.__requests.put(None)
+
+        self.unregister(self.fileno)
+        os.close(self.fileno)
+        os.close(self.__wakeup_w)
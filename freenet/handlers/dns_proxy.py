@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 import pywind.evtframework.handlers.udp_handler as udp_handler
-import pywind.lib.timer as timer
-import socket, random, sys
+import socket, sys, time
+from collections import deque
 
 try:
     import dns.message
@@ -12,67 +12,327 @@ except ImportError:
 import freenet.lib.utils as utils
 import freenet.lib.base_proto.utils as proto_utils
 import freenet.lib.ippkts as ippkts
+import freenet.lib.metrics as metrics
+import freenet.lib.dns_cache as dns_cache
+import freenet.lib.dns_upstream as dns_upstream
+import freenet.lib.dns_wire as dns_wire
+
+_dns_queries = metrics.new_counter("dns_queries_total", "dns queries received", ("proxy",))
+_dns_responses = metrics.new_counter("dns_responses_total", "dns responses received from upstream", ("proxy",))
+_dns_timeouts = metrics.new_counter("dns_timeouts_total", "dns queries timeout", ("proxy",))
+_dns_drops = metrics.new_counter("dns_drops_total", "dns queries dropped", ("proxy",))
+
+
+class _query(object):
+    """发送到上游DNS服务器或者隧道的查询"""
+    seq = 0
+    # 查询所属的DNS代理的文件描述符
+    owner = -1
+    # 缓存键,None表示不能缓存
+    key = None
+    # 等待应答的请求者,相同的查询会合并
+    waiters = None
+    message = None
+    # 上游服务器 => (文件描述符,DNS ID,发送时间)
+    sent = None
+    last_send_time = 0
+    # 发送到隧道时使用的DNS ID
+    tunnel_id = -1
 
 
 class dns_base(udp_handler.udp_handler):
-    """DNS基本类"""
-    # 新的DNS ID映射到就的DNS ID
-    __dns_id_map = {}
-    __empty_ids = []
-    __cur_max_dns_id = 1
+    """DNS基本类
+    每个上游socket都有独立的16位DNS ID空间,ID随机分配
+    当某个上游服务器的ID空间用完时,打开新的socket(不同的源端口)
+    """
+    # 没有响应时重新发送到另外一个上游服务器的时间
+    __RETRY_TIMEOUT = 1
+    # 每个上游服务器最多的socket数目
+    __MAX_SOCKETS_PER_SERVER = 16
+
+    __query_timeout = 5
+    __seq = 0
+    # seq => _query
+    __queries = None
+    # 缓存键 => _query,用于合并相同的查询
+    __pending = None
+    # 所有查询的超时时间相同,因此使用先进先出队列,元素为 (time,seq)
+    __retry_queue = None
+    __timeout_queue = None
+
+    __upstream = None
+    # 上游服务器 => [fd,...]
+    __upstream_fds = None
+    # fd => 上游服务器
+    __fd_servers = None
+    # fd => dns_upstream.id_space
+    __id_spaces = None
+    # 隧道的ID空间,网关模式的IPv4与IPv6 DNS代理共享
+    __tunnel_ids = None
+    __race = False
+    __proxy_name = None
+
+    def init_queries(self, name, query_timeout, tunnel_ids=None):
+        """初始化查询相关数据
+        :param name: 代理名,用于指标标签
+        :param query_timeout: 查询超时时间
+        :param tunnel_ids: 隧道的ID空间,None表示自己创建
+        :return:
+        """
+        self.__proxy_name = name
+        self.__query_timeout = query_timeout
+        self.__queries = {}
+        self.__pending = {}
+        self.__retry_queue = deque()
+        self.__timeout_queue = deque()
+        self.__upstream_fds = {}
+        self.__fd_servers = {}
+        self.__id_spaces = {}
+
+        if tunnel_ids is None: tunnel_ids = dns_upstream.id_space()
+        self.__tunnel_ids = tunnel_ids
+
+        metrics.new_gauge("dns_inflight", "dns queries waiting for response", ("proxy",)).set_function(
+            lambda: [((name,), len(self.__queries),)], key=name
+        )
+        metrics.new_gauge("dns_upstream_sockets", "number of sockets to upstream dns servers",
+                          ("proxy",)).set_function(lambda: [((name,), len(self.__fd_servers),)], key=name)
+
+    def set_upstreams(self, servers, self_server=None, race=False):
+        """设置上游DNS服务器
+        :param servers: 上游DNS服务器列表
+        :param self_server: 自身的socket已经连接的上游服务器,该服务器直接使用自身的socket
+        :param race: 第一次查询某个域名时是否同时发送到两个最快的服务器
+        :return:
+        """
+        self.__upstream = dns_upstream.upstream(servers, name=self.__proxy_name)
+        self.__race = race
+
+        for server in servers:
+            self.__upstream_fds[server] = []
+            if server == self_server:
+                self.__add_upstream_fd(server, self.fileno)
+            else:
+                self.__open_upstream_socket(server)
+            ''''''
+        return
 
-    def get_dns_id(self):
-        n_dns_id = -1
+    def __add_upstream_fd(self, server, fd):
+        self.__upstream_fds[server].append(fd)
+        self.__fd_servers[fd] = server
+        self.__id_spaces[fd] = dns_upstream.id_space()
 
-        try:
-            n_dns_id = self.__empty_ids.pop(0)
-            return n_dns_id
-        except IndexError:
-            pass
+    def __del_upstream_fd(self, fd):
+        server = self.__fd_servers[fd]
+        self.__upstream_fds[server].remove(fd)
+        del self.__fd_servers[fd]
+        del self.__id_spaces[fd]
+
+    def __open_upstream_socket(self, server):
+        fd = self.create_handler(self.fileno, udp_client_for_dns, server, is_ipv6=utils.is_ipv6_address(server))
+        self.__add_upstream_fd(server, fd)
+
+        return fd
+
+    def __alloc_upstream_id(self, server, q):
+        """分配上游服务器的DNS ID
+        :return: (fd,dns_id),fd为-1表示分配失败
+        """
+        fds = self.__upstream_fds[server]
+        for fd in list(fds):
+            # 上游socket可能因为出错已经被删除
+            if fd != self.fileno and not self.handler_exists(fd):
+                self.__del_upstream_fd(fd)
+                continue
+            dns_id = self.__id_spaces[fd].alloc(q)
+            if dns_id >= 0: return (fd, dns_id,)
+
+        if len(fds) >= self.__MAX_SOCKETS_PER_SERVER: return (-1, -1,)
+
+        fd = self.__open_upstream_socket(server)
 
-        if self.__cur_max_dns_id < 65536:
-            n_dns_id = self.__cur_max_dns_id
-            self.__cur_max_dns_id += 1
+        return (fd, self.__id_spaces[fd].alloc(q),)
 
-        return n_dns_id
+    def __send_to_server(self, q, server, now):
+        fd, dns_id = self.__alloc_upstream_id(server, q)
+        if fd < 0: return False
 
-    def set_dns_id_map(self, dns_id, value):
-        self.__dns_id_map[dns_id] = value
+        q.sent[server] = (fd, dns_id, now,)
+        message = dns_cache.set_dns_id(q.message, dns_id)
 
-    def del_dns_id_map(self, dns_id):
-        if dns_id not in self.__dns_id_map: return
+        if fd == self.fileno:
+            self.send(message)
+            self.add_evt_write(self.fileno)
+        else:
+            self.send_message_to_handler(self.fileno, fd, message)
 
-        if dns_id == self.__cur_max_dns_id - 1:
-            self.__cur_max_dns_id -= 1
+        return True
+
+    def new_query(self, key, waiter, message):
+        """创建新的查询
+        :param key: 缓存键
+        :param waiter: 请求者信息
+        :param message: 请求消息
+        :return: _query对象
+        """
+        self.__seq += 1
+
+        q = _query()
+        q.seq = self.__seq
+        q.owner = self.fileno
+        q.key = key
+        q.waiters = [waiter]
+        q.message = message
+        q.sent = {}
+
+        self.__queries[q.seq] = q
+        if key is not None: self.__pending[key] = q
+        self.__timeout_queue.append((time.time() + self.__query_timeout, q.seq,))
+
+        return q
+
+    def get_pending(self, key):
+        """获取正在进行的相同查询
+        :param key:
+        :return: None表示没有相同的查询
+        """
+        return self.__pending.get(key, None)
+
+    def send_to_upstream(self, q):
+        """发送查询到上游DNS服务器
+        :return: False表示没有可用的DNS ID
+        """
+        if self.__race and q.key is not None and self.__upstream.is_first_query(q.key):
+            servers = self.__upstream.choose_n(2)
         else:
-            self.__empty_ids.append(dns_id)
+            servers = [self.__upstream.choose()]
+
+        now = time.time()
+        ok = False
+        for server in servers:
+            if self.__send_to_server(q, server, now): ok = True
 
-        del self.__dns_id_map[dns_id]
+        if not ok: return False
 
-    def get_dns_id_map(self, dns_id):
-        return self.__dns_id_map[dns_id]
+        q.last_send_time = now
+        self.__retry_queue.append((now + self.__RETRY_TIMEOUT, q.seq,))
+
+        return True
+
+    def wrap_tunnel_query(self, q):
+        """分配隧道的DNS ID
+        :return: 替换ID之后的消息,None表示没有可用的DNS ID
+        """
+        dns_id = self.__tunnel_ids.alloc(q)
+        if dns_id < 0: return None
+
+        q.tunnel_id = dns_id
+
+        return dns_cache.set_dns_id(q.message, dns_id)
+
+    def get_upstream_query(self, fd, message):
+        """根据上游服务器的响应获取查询
+        :param fd: 接收到响应的文件描述符
+        :param message:
+        :return: None表示没有对应的查询,应该丢弃
+        """
+        if fd not in self.__id_spaces: return None
+
+        dns_id = (message[0] << 8) | message[1]
+        q = self.__id_spaces[fd].get(dns_id)
+        if not q: return None
 
-    def dns_id_map_exists(self, dns_id):
-        return dns_id in self.__dns_id_map
+        server = self.__fd_servers[fd]
+        if server not in q.sent: return None
 
-    def recyle_resource(self, dns_ids):
-        for dns_id in dns_ids: self.del_dns_id_map(dns_id)
+        s_fd, s_dns_id, send_time = q.sent[server]
+        if s_fd != fd or s_dns_id != dns_id: return None
 
-    def print_dns_id_map(self):
-        print(self.__dns_id_map)
+        self.__upstream.rtt_update(server, time.time() - send_time)
+
+        return q
+
+    def get_tunnel_query(self, message):
+        dns_id = (message[0] << 8) | message[1]
+
+        return self.__tunnel_ids.get(dns_id)
+
+    def finish_query(self, q):
+        """查询结束,回收资源"""
+        if q.seq not in self.__queries: return
+
+        del self.__queries[q.seq]
+        if q.key is not None and self.__pending.get(q.key, None) is q: del self.__pending[q.key]
+
+        for fd, dns_id, send_time in q.sent.values():
+            if fd in self.__id_spaces: self.__id_spaces[fd].free(dns_id)
+
+        if q.tunnel_id >= 0: self.__tunnel_ids.free(q.tunnel_id)
+
+    def check_queries(self):
+        """重试没有响应的查询,回收超时的查询,需要周期调用
+        :return: 超时的查询列表
+        """
+        now = time.time()
+        queue = self.__retry_queue
+
+        while queue and queue[0][0] <= now:
+            t, seq = queue.popleft()
+            q = self.__queries.get(seq, None)
+            if not q: continue
+            # 在此期间已经重试过
+            if now - q.last_send_time < self.__RETRY_TIMEOUT: continue
+
+            server = self.__upstream.choose(exclude=q.sent)
+            if not server: continue
+
+            for s, info in q.sent.items():
+                if info[2] == q.last_send_time: self.__upstream.loss_update(s)
+
+            if not self.__send_to_server(q, server, now): continue
+
+            q.last_send_time = now
+            queue.append((now + self.__RETRY_TIMEOUT, seq,))
+
+        results = []
+        queue = self.__timeout_queue
+        while queue and queue[0][0] <= now:
+            t, seq = queue.popleft()
+            q = self.__queries.get(seq, None)
+            if not q: continue
+
+            # 之前发送的服务器在重试的时候已经记录了丢包
+            for s, info in q.sent.items():
+                if info[2] == q.last_send_time: self.__upstream.loss_update(s)
+
+            self.finish_query(q)
+            results.append(q)
+
+        return results
+
+    def upstream_fd_exists(self, fd):
+        return fd in self.__fd_servers
 
 
 class dnsd_proxy(dns_base):
     """服务端的DNS代理"""
-    __LOOP_TIMEOUT = 5
+    __LOOP_TIMEOUT = 1
     # DNS查询超时
     __QUERY_TIMEOUT = 3
-    __timer = None
+    __cache = None
 
-    def init_func(self, creator_fd, dns_server, is_ipv6=False):
-        self.__timer = timer.timer()
+    def init_func(self, creator_fd, dns_servers, cache=None, race=False):
+        """
+        :param creator_fd:
+        :param dns_servers: 上游DNS服务器列表
+        :param cache: dns_cache对象,None表示不缓存
+        :param race: 第一次查询某个域名时是否同时查询两个服务器
+        :return:
+        """
+        self.__cache = cache
 
-        if is_ipv6:
+        dns_server = dns_servers[0]
+        if utils.is_ipv6_address(dns_server):
             fa = socket.AF_INET6
         else:
             fa = socket.AF_INET
@@ -85,36 +345,38 @@ class dnsd_proxy(dns_base):
         self.add_evt_read(self.fileno)
 
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
+        self.init_queries("dnsd", self.__QUERY_TIMEOUT)
+        self.set_upstreams(dns_servers, self_server=dns_server, race=race)
+
         return self.fileno
 
     def udp_readable(self, message, address):
+        self.__handle_response(self.fileno, message)
+
+    def message_from_handler(self, from_fd, message):
+        self.__handle_response(from_fd, message)
+
+    def __handle_response(self, fd, message):
         size = len(message)
         if size < 16: return
 
-        dns_id = (message[0] << 8) | message[1]
-        if not self.dns_id_map_exists(dns_id): return
-        n_dns_id, session_id = self.get_dns_id_map(dns_id)
-        L = list(message)
+        q = self.get_upstream_query(fd, message)
+        if not q: return
 
-        L[0:2] = (
-            (n_dns_id & 0xff00) >> 8,
-            n_dns_id & 0xff
-        )
-        self.del_dns_id_map(dns_id)
-        self.__timer.drop(dns_id)
+        self.finish_query(q)
+        _dns_responses.inc(1, ("dnsd",))
+
+        if q.key is not None: self.__cache.put(q.key, message)
 
-        self.dispatcher.response_dns(session_id, bytes(L))
+        for query, session_id in q.waiters:
+            self.dispatcher.response_dns(session_id, dns_cache.set_reply_header(message, query))
 
     def udp_writable(self):
         self.remove_evt_write(self.fileno)
 
     def udp_timeout(self):
-        dns_ids = self.__timer.get_timeout_names()
-        for dns_id in dns_ids:
-            if not self.__timer.exists(dns_id): continue
-            self.del_dns_id_map(dns_id)
+        for q in self.check_queries(): _dns_timeouts.inc(1, ("dnsd",))
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
-        return
 
     def udp_error(self):
         self.delete_handler(self.fileno)
@@ -125,20 +387,27 @@ class dnsd_proxy(dns_base):
 
     def request_dns(self, session_id, message):
         if len(message) < 16: return
-        dns_id = (message[0] << 8) | message[1]
-        n_dns_id = self.get_dns_id()
-        if n_dns_id < 0: return
-
-        self.set_dns_id_map(n_dns_id, (dns_id, session_id))
-        L = list(message)
-        L[0:2] = (
-            (n_dns_id & 0xff00) >> 8,
-            n_dns_id & 0x00ff
-        )
-        self.__timer.set_timeout(n_dns_id, self.__QUERY_TIMEOUT)
-
-        self.send(bytes(L))
-        self.add_evt_write(self.fileno)
+        _dns_queries.inc(1, ("dnsd",))
+        key = None
+        if self.__cache: key = dns_cache.make_key(message)
+
+        if key is not None:
+            rs = self.__cache.get(key, message)
+            if rs:
+                self.dispatcher.response_dns(session_id, rs[0])
+                return
+
+            # 相同的查询正在进行,等待上游的应答
+            q = self.get_pending(key)
+            if q:
+                q.waiters.append((message, session_id,))
+                return
+
+        q = self.new_query(key, (message, session_id,), message)
+        if not self.send_to_upstream(q):
+            self.finish_query(q)
+            _dns_drops.inc(1, ("dnsd",))
+        return
 
 
 class udp_client_for_dns(udp_handler.udp_handler):
@@ -182,19 +451,41 @@ class dnsc_proxy(dns_base):
     """客户端的DNS代理
     """
     __host_match = None
-    __timer = None
 
     __DNS_QUERY_TIMEOUT = 5
-    __LOOP_TIMEOUT = 10
+    __LOOP_TIMEOUT = 1
 
     __debug = False
     __dnsserver = None
     __server_side = False
 
-    __udp_client = None
     __is_ipv6 = False
 
-    def init_func(self, creator, address, host_match, debug=False, server_side=False, is_ipv6=False):
+    __cache = None
+    __ip_match = None
+    # 本地模式下DNS应答的头部模板
+    __udp_templates = None
+
+    def init_func(self, creator, address, host_match, debug=False, server_side=False, is_ipv6=False, cache=None,
+                  race=False, tunnel_ids=None, ip_match=None):
+        """
+        :param creator:
+        :param address: 网关模式时为监听地址,否则为上游DNS服务器列表
+        :param host_match:
+        :param debug:
+        :param server_side: 是否是网关模式
+        :param is_ipv6:
+        :param cache: dns_cache对象,None表示不缓存
+        :param race: 第一次查询某个域名时是否同时查询两个服务器
+        :param tunnel_ids: 隧道的DNS ID空间,网关模式下IPv4与IPv6的DNS代理需要共享
+        :param ip_match: IP规则,应答中的地址命中规则时以IP规则的标志为准
+        :return:
+        """
+        if not server_side:
+            dns_servers = address
+            address = dns_servers[0]
+            is_ipv6 = utils.is_ipv6_address(address)
+
         if is_ipv6:
             fa = socket.AF_INET6
         else:
@@ -214,139 +505,216 @@ class dnsc_proxy(dns_base):
             self.bind((address, 53))
         else:
             self.connect((address, 53))
+            self.__udp_templates = ippkts.udp_template_cache(max_size=256)
 
         self.__debug = debug
         self.__host_match = host_match
-        self.__timer = timer.timer()
+        self.__ip_match = ip_match
+        self.__cache = cache
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
 
+        if is_ipv6:
+            name = "dnsc6"
+        else:
+            name = "dnsc"
+        self.init_queries(name, self.__DNS_QUERY_TIMEOUT, tunnel_ids=tunnel_ids)
+
+        if not server_side: self.set_upstreams(dns_servers, self_server=address, race=race)
+
         return self.fileno
 
-    def set_parent_dnsserver(self, server, is_ipv6=False):
+    def set_parent_dnsserver(self, servers, race=False):
         """当作为网关模式时需要调用此函数来设置上游DNS
-        :param server:
+        :param servers: 上游DNS服务器列表
+        :param race: 第一次查询某个域名时是否同时查询两个服务器
         :return:
         """
-        self.__udp_client = self.create_handler(self.fileno, udp_client_for_dns, server, is_ipv6=is_ipv6)
+        self.set_upstreams(servers, race=race)
+
+    def __need_addrs(self, flags):
+        """是否需要检查应答中的地址"""
+        if flags == 1: return True
+
+        return self.__ip_match is not None and self.__ip_match.size() > 0
+
+    def __set_routers(self, addrs, flags=1):
+        """设置应答中地址的路由
+        :param addrs:
+        :param flags: 域名规则的标志,地址命中IP规则时以IP规则的标志为准
+        """
+        for ip in addrs:
+            is_ipv6 = utils.is_ipv6_address(ip)
+            if not is_ipv6 and not utils.is_ipv4_address(ip): continue
+            ip_flags = flags
+
+            if self.__ip_match:
+                is_match, v = self.__ip_match.match(ip, is_ipv6=is_ipv6)
+                if is_match: ip_flags = v
+            if ip_flags != 1: continue
+
+            self.dispatcher.set_router(ip, is_ipv6=is_ipv6, is_dynamic=True)
+        return
+
+    def __handle_msg_from_response(self, message, fd=-1):
+        """处理DNS响应
+        :param message:
+        :param fd: 上游服务器对应的文件描述符,-1表示来自于隧道
+        :return:
+        """
+        if len(message) < 12: return
+
+        if fd >= 0:
+            q = self.get_upstream_query(fd, message)
+        else:
+            q = self.get_tunnel_query(message)
+        if not q: return
+
+        # 隧道的ID空间是共享的,查询可能属于另外一个协议族的DNS代理
+        if q.owner != self.fileno:
+            self.dispatcher.send_msg_to_other_dnsservice_for_dns_response(message, is_ipv6=not self.__is_ipv6)
+            return
+
+        # 相同的查询的域名相同,因此flags也相同
+        flags = q.waiters[0][4]
+        if self.__need_addrs(flags):
+            addrs = self.__get_addrs(message)
+            if addrs is None: return
+            self.__set_routers(addrs, flags)
+
+        self.finish_query(q)
+        _dns_responses.inc(1, ("dnsc",))
+
+        if q.key is not None: self.__cache.put(q.key, message)
+
+        for waiter in q.waiters:
+            self.__send_response(waiter, dns_cache.set_reply_header(message, waiter[6]))
+
+    def __get_addrs(self, message):
+        """获取应答中的IP地址
+        :return: None表示应答不合法
+        """
+        try:
+            return dns_wire.get_addrs(dns_wire.iter_records(message), message)
+        except dns_wire.DNSWireErr:
+            pass
 
-    def __handle_msg_from_response(self, message):
         try:
             msg = dns.message.from_wire(message)
         except:
-            return
+            return None
+
+        addrs = []
+        for rrset in msg.answer:
+            for cname in rrset: addrs.append(cname.__str__())
+
+        return addrs
+
+    def __send_response(self, waiter, message):
+        """发送应答到请求者
+        :param waiter: (saddr,daddr,dport,dns_id,flags,is_ipv6,请求消息)
+        :param message:
+        :return:
+        """
+        saddr, daddr, dport, n_dns_id, flags, is_ipv6, query = waiter
 
-        dns_id = (message[0] << 8) | message[1]
-        if not self.dns_id_map_exists(dns_id): return
-
-        saddr, daddr, dport, n_dns_id, flags, is_ipv6 = self.get_dns_id_map(dns_id)
-        self.del_dns_id_map(dns_id)
-        L = list(message)
-        L[0:2] = (
-            (n_dns_id & 0xff00) >> 8,
-            n_dns_id & 0xff,
-        )
-        message = bytes(L)
-
-        if flags == 1:
-            for rrset in msg.answer:
-                for cname in rrset:
-                    ip = cname.__str__()
-                    if utils.is_ipv4_address(ip): self.dispatcher.set_router(ip, is_dynamic=True)
-                    if utils.is_ipv6_address(ip): self.dispatcher.set_router(ip, is_ipv6=True, is_dynamic=True)
-                ''''''
-            ''''''
         if not self.__server_side:
             if self.__is_ipv6:
                 mtu = 1280
             else:
                 mtu = 1500
-            packets = ippkts.build_udp_packets(saddr, daddr, 53, dport, message, mtu=mtu, is_ipv6=self.__is_ipv6)
+            packets = self.__udp_templates.build_udp_packets(
+                saddr, daddr, 53, dport, message, mtu=mtu, is_ipv6=self.__is_ipv6
+            )
             for packet in packets:
                 self.dispatcher.send_msg_to_tun(packet)
-
-            self.del_dns_id_map(dns_id)
-            self.__timer.drop(dns_id)
             return
 
-        if self.__is_ipv6 != is_ipv6 and self.__server_side:
-            if self.__is_ipv6:
-                is_ipv6 = False
-            else:
-                is_ipv6 = True
-            self.dispatcher.send_msg_to_other_dnsservice_for_dns_response(message, is_ipv6=is_ipv6)
-
         if self.__is_ipv6:
             sts_daddr = socket.inet_ntop(socket.AF_INET6, daddr)
         else:
             sts_daddr = socket.inet_ntop(socket.AF_INET, daddr)
 
-        self.del_dns_id_map(dns_id)
-        self.__timer.drop(dns_id)
         self.sendto(message, (sts_daddr, dport))
         self.add_evt_write(self.fileno)
 
     def __handle_msg_for_request(self, saddr, daddr, sport, message, is_ipv6=False):
         size = len(message)
         if size < 8: return
+        _dns_queries.inc(1, ("dnsc",))
 
-        try:
-            msg = dns.message.from_wire(message)
-        except:
-            return
-
-        questions = msg.question
-
-        if len(questions) != 1 or msg.opcode() != 0:
-            self.__send_to_dns_server(self.__transparent_dns, message)
-            return
+        question = dns_wire.parse_question(message)
+        host = None
 
-        """
-        q = questions[0]
-        if q.rdtype != 1 or q.rdclass != 1:
-            self.__send_to_dns_server(self.__transparent_dns, message)
-            return
-        """
+        if question:
+            host = question[0]
+        else:
+            # 简单解析失败时使用dnspython解析
+            try:
+                msg = dns.message.from_wire(message)
+            except:
+                return
+
+            if len(msg.question) == 1 and msg.opcode() == 0:
+                host = b".".join(msg.question[0].name[0:-1]).decode("iso-8859-1")
+            ''''''
 
-        q = questions[0]
-        host = b".".join(q.name[0:-1]).decode("iso-8859-1")
-        pos = host.find(".")
+        # 非标准的查询直接发送到上游DNS服务器
+        if host is None:
+            is_match, flags = False, None
+        else:
+            pos = host.find(".")
 
-        if pos > 0 and self.__debug: print(host)
-        is_match, flags = self.__host_match.match(host)
+            if pos > 0 and self.__debug: print(host)
+            is_match, flags = self.__host_match.match(host)
 
         # 如果flags为2,那么丢弃DNS请求
-        if flags == 2: return
+        if flags == 2:
+            _dns_drops.inc(1, ("dnsc",))
+            return
 
         dns_id = (message[0] << 8) | message[1]
-        n_dns_id = self.get_dns_id()
-        if n_dns_id < 0: return
-
         if not is_match: flags = None
 
-        self.set_dns_id_map(n_dns_id, (daddr, saddr, sport, dns_id, flags, is_ipv6,))
-
-        L = list(message)
-        L[0:2] = (
-            (n_dns_id & 0xff00) >> 8,
-            n_dns_id & 0xff,
-        )
-
-        message = bytes(L)
-        self.__timer.set_timeout(n_dns_id, self.__DNS_QUERY_TIMEOUT)
-
-        if not is_match and self.__server_side:
-            self.send_message_to_handler(self.fileno, self.__udp_client, message)
+        waiter = (daddr, saddr, sport, dns_id, flags, is_ipv6, message,)
+        key = None
+        if self.__cache and question: key = dns_cache.key_from_question(question, message)
+
+        if key is not None:
+            rs = self.__cache.get(key, message)
+            if rs:
+                message, addrs = rs
+                if self.__need_addrs(flags): self.__set_routers(addrs, flags)
+                self.__send_response(waiter, message)
+                return
+
+            # 相同的查询正在进行,等待上游的应答
+            q = self.get_pending(key)
+            if q:
+                q.waiters.append(waiter)
+                return
+
+        q = self.new_query(key, waiter, message)
+
+        if not is_match:
+            if not self.send_to_upstream(q):
+                self.finish_query(q)
+                _dns_drops.inc(1, ("dnsc",))
             return
 
-        if not is_match and not self.__server_side:
-            self.send(message)
-            self.add_evt_write(self.fileno)
+        message = self.wrap_tunnel_query(q)
+        if not message:
+            self.finish_query(q)
+            _dns_drops.inc(1, ("dnsc",))
             return
+
         self.dispatcher.send_msg_to_tunnel(proto_utils.ACT_DNS, message)
 
     def message_from_handler(self, from_fd, message):
+        if self.upstream_fd_exists(from_fd):
+            self.__handle_msg_from_response(message, fd=from_fd)
+            return
         self.__handle_msg_from_response(message)
 
     def msg_from_tunnel(self, message):
@@ -356,11 +724,7 @@ class dnsc_proxy(dns_base):
         self.__handle_msg_for_request(saddr, daddr, sport, message, is_ipv6=is_ipv6)
 
     def udp_timeout(self):
-        names = self.__timer.get_timeout_names()
-        for name in names:
-            if not self.__timer.exists(name): continue
-            self.del_dns_id_map(name)
-            self.__timer.drop(name)
+        for q in self.check_queries(): _dns_timeouts.inc(1, ("dnsc",))
         self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
 
     def udp_readable(self, message, address):
@@ -371,7 +735,7 @@ class dnsc_proxy(dns_base):
                 byte_saddr = socket.inet_pton(socket.AF_INET, address[0])
             self.__handle_msg_for_request(byte_saddr, None, address[1], message, is_ipv6=self.__is_ipv6)
             return
-        self.__handle_msg_from_response(message)
+        self.__handle_msg_from_response(message, fd=self.fileno)
 
     def udp_writable(self):
         self.remove_evt_write(self.fileno)
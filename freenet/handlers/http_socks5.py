@@ -4,6 +4,7 @@
 
 import pywind.evtframework.handlers.tcp_handler as tcp_handler
 import pywind.evtframework.handlers.udp_handler as udp_handler
+import freenet.handlers.tcp_connector as tcp_connector
 import socket, time, struct
 import pywind.web.lib.httputils as httputils
 import freenet.lib.base_proto.app_proxy as app_proxy_proto
@@ -204,6 +205,7 @@ class _http_transparent_proxy_resp(object):
 class http_socks5_listener(tcp_handler.tcp_handler):
     __cookie_ids = None
     __host_match = None
+    __ip_match = None
     __debug = None
 
     __current_max_cookie_id = None
@@ -212,7 +214,7 @@ class http_socks5_listener(tcp_handler.tcp_handler):
     # 等待删除的cookie ids
     __wait_del_cookie_ids = None
 
-    def init_func(self, creator, address, host_match, is_ipv6=False, debug=True):
+    def init_func(self, creator, address, host_match, is_ipv6=False, debug=True, ip_match=None):
         if is_ipv6:
             fa = socket.AF_INET6
         else:
@@ -220,6 +222,7 @@ class http_socks5_listener(tcp_handler.tcp_handler):
 
         self.__cookie_ids = {}
         self.__host_match = host_match
+        self.__ip_match = ip_match
         self.__debug = debug
         self.__current_max_cookie_id = 1
         self.__empty_cookie_ids = []
@@ -244,7 +247,7 @@ class http_socks5_listener(tcp_handler.tcp_handler):
                 self.create_handler(
                     self.fileno, _http_socks5_handler,
                     cs, caddr, self.__host_match,
-                    debug=self.__debug
+                    debug=self.__debug, ip_match=self.__ip_match
                 )
             except BlockingIOError:
                 break
@@ -340,6 +343,7 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
 
     __use_tunnel = None
     __host_match = None
+    __ip_match = None
     __creator = None
 
     __req_ok = None
@@ -359,7 +363,7 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
 
     __http_transparent = None
 
-    def init_func(self, creator, cs, caddr, host_match, debug=True):
+    def init_func(self, creator, cs, caddr, host_match, debug=True, ip_match=None):
         self.set_socket(cs)
         self.__is_udp = False
         self.__caddr = caddr
@@ -370,6 +374,7 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
         self.__is_ipv6 = False
         self.__use_tunnel = False
         self.__host_match = host_match
+        self.__ip_match = ip_match
         self.__creator = creator
         self.__req_ok = False
         self.__sentdata_buf = []
@@ -387,6 +392,16 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
 
         return self.fileno
 
+    def __match(self, host):
+        """域名使用域名规则匹配,IP地址使用IP规则匹配
+        :return: (is_match,flags)
+        """
+        if utils.is_ipv4_address(host) or utils.is_ipv6_address(host):
+            if not self.__ip_match: return (False, 0,)
+            return self.__ip_match.match(host, is_ipv6=utils.is_ipv6_address(host))
+
+        return self.__host_match.match(host)
+
     def __handle_socks5_step1(self):
         if self.reader.size() < 2:
             self.delete_handler(self.fileno)
@@ -452,13 +467,12 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
         if self.__debug: print("%s:%s" % (addr, port,))
 
         if cmd == 1:
-            if atyp == 3:
-                is_match, flags = self.__host_match.match(addr)
+            is_match, flags = self.__match(addr)
 
-                if is_match and flags == 1:
-                    self.__use_tunnel = True
-                    self.__tunnel_proxy_reqconn(atyp, addr, port)
-                    return
+            if is_match and flags == 1:
+                self.__use_tunnel = True
+                self.__tunnel_proxy_reqconn(atyp, addr, port)
+                return
             self.__fileno = self.create_handler(
                 self.fileno, _tcp_client, (addr, port,), is_ipv6=self.__is_ipv6
             )
@@ -527,7 +541,7 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
         self.__is_http_tunnel = True
 
         host, port = rs
-        is_match, flags = self.__host_match.match(host)
+        is_match, flags = self.__match(host)
 
         if self.__debug: print("%s:%s" % (host, port,))
 
@@ -563,7 +577,7 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
         header_data = httputils.build_http1x_req_header(request[0], uri, seq)
         req_data = b"".join([header_data.encode("iso-8859-1"), body_data])
 
-        is_match, flags = self.__host_match.match(host)
+        is_match, flags = self.__match(host)
         self.__http_transparent = _http_transparent_proxy_resp()
 
         if is_match and flags:
@@ -847,23 +861,15 @@ class _http_socks5_handler(tcp_handler.tcp_handler):
         self.dispatcher.send_msg_to_tunnel(proto_utils.ACT_SOCKS, sent_data)
 
 
-class _tcp_client(tcp_handler.tcp_handler):
+class _tcp_client(tcp_connector.tcp_connector):
     __TIMEOUT = 300
     __update_time = 0
     __creator = None
 
     def init_func(self, creator, address, is_ipv6=False):
-        if is_ipv6:
-            fa = socket.AF_INET6
-        else:
-            fa = socket.AF_INET
-
-        s = socket.socket(fa, socket.SOCK_STREAM)
-        if is_ipv6: s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
-
         self.__creator = creator
-        self.set_socket(s)
-        self.connect(address)
+        self.create_socket(is_ipv6)
+        self.connect_host(address)
 
         return self.fileno
 
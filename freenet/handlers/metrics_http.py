@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""本地指标查询服务,监听在回环地址或者Unix socket上,以Prometheus文本格式输出指标
+GET /metrics
+"""
+
+import pywind.evtframework.handlers.tcp_handler as tcp_handler
+import pywind.web.lib.httputils as httputils
+import freenet.lib.metrics as metrics
+import socket, os
+
+
+class metrics_listener(tcp_handler.tcp_handler):
+    __unix_path = None
+
+    def init_func(self, creator, address, is_unix=False):
+        """
+        :param creator:
+        :param address: (ip,port) 或者 unix socket路径
+        :param is_unix: 是否是unix socket
+        :return:
+        """
+        if is_unix:
+            fa = socket.AF_UNIX
+            self.__unix_path = address
+            if os.path.exists(address): os.remove(address)
+        else:
+            fa = socket.AF_INET
+            if address[0].find(":") > -1: fa = socket.AF_INET6
+
+        s = socket.socket(fa, socket.SOCK_STREAM)
+        if not is_unix: s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+
+        self.set_socket(s)
+        self.bind(address)
+        self.listen(5)
+
+        if is_unix: os.chmod(address, 0o600)
+
+        self.register(self.fileno)
+        self.add_evt_read(self.fileno)
+
+        return self.fileno
+
+    def tcp_accept(self):
+        while 1:
+            try:
+                cs, caddr = self.accept()
+                self.create_handler(self.fileno, _metrics_handler, cs)
+            except BlockingIOError:
+                break
+        return
+
+    def tcp_error(self):
+        self.delete_handler(self.fileno)
+
+    def tcp_delete(self):
+        self.unregister(self.fileno)
+        self.close()
+        if self.__unix_path and os.path.exists(self.__unix_path): os.remove(self.__unix_path)
+
+
+class _metrics_handler(tcp_handler.tcp_handler):
+    __TIMEOUT = 10
+    __MAX_HEADER_SIZE = 4096
+    __buf = None
+
+    def init_func(self, creator, cs):
+        self.__buf = []
+
+        self.set_socket(cs)
+        self.register(self.fileno)
+        self.add_evt_read(self.fileno)
+        self.set_timeout(self.fileno, self.__TIMEOUT)
+
+        return self.fileno
+
+    def tcp_readable(self):
+        self.__buf.append(self.reader.read())
+        rdata = b"".join(self.__buf)
+        self.__buf = [rdata]
+
+        p = rdata.find(b"\r\n\r\n")
+        if p < 0:
+            if len(rdata) > self.__MAX_HEADER_SIZE: self.delete_handler(self.fileno)
+            return
+
+        # 读取完请求头部之后不再接收数据
+        self.remove_evt_read(self.fileno)
+
+        try:
+            request, _ = httputils.parse_htt1x_request_header(rdata[0:p + 4].decode("iso-8859-1"))
+        except httputils.Http1xHeaderErr:
+            self.__response("400 Bad Request", b"")
+            return
+
+        method, uri = request[0].upper(), request[1]
+        p = uri.find("?")
+        if p > 0: uri = uri[0:p]
+
+        if method != "GET":
+            self.__response("405 Method Not Allowed", b"")
+            return
+
+        if uri not in ("/", "/metrics",):
+            self.__response("404 Not Found", b"")
+            return
+
+        self.__response("200 OK", metrics.render().encode("utf-8"))
+
+    def __response(self, status, body):
+        header = httputils.build_http1x_resp_header(status, [
+            ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+            ("Content-Length", len(body)),
+            ("Connection", "close"),
+        ])
+        self.writer.write(header.encode("iso-8859-1"))
+        self.writer.write(body)
+        self.add_evt_write(self.fileno)
+        self.delete_this_no_sent_data()
+
+    def tcp_writable(self):
+        self.remove_evt_write(self.fileno)
+
+    def tcp_timeout(self):
+        self.delete_handler(self.fileno)
+
+    def tcp_error(self):
+        self.delete_handler(self.fileno)
+
+    def tcp_delete(self):
+        self.unregister(self.fileno)
+        self.close()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""路由管理
+通过rtnetlink直接修改内核路由表,代替每条路由执行一次route命令
+添加与删除请求先放入队列,在事件循环中批量发送给内核,内核的应答异步读取
+"""
+
+import socket, errno
+from collections import OrderedDict
+
+import pywind.evtframework.handlers.handler as handler
+import freenet.lib.rtnetlink as rtnetlink
+import freenet.lib.metrics as metrics
+
+
+class route_manager(handler.handler):
+    # 一次发送给内核的最大字节数
+    __BATCH_SIZE = 32 * 1024
+    # 没有应答的最大请求数,每个应答都会占用接收缓冲区,过多会导致应答丢失
+    __MAX_INFLIGHT = 128
+
+    __socket = None
+    __seq = 0
+
+    __ifname = None
+    # 网卡名到网卡索引的映射
+    __ifindexes = None
+    __table = None
+
+    # 已经设置的路由 (dst,prefix,table) -> (gateway,is_ipv6,ifname)
+    __routes = None
+    # 等待发送的请求 (dst,prefix,table) -> (is_add,gateway,is_ipv6,ifname)
+    __pending = None
+    # 已经发送还没有应答的请求 seq -> (is_add,key)
+    __inflight = None
+
+    __metric_ops = None
+
+    def init_func(self, creator_fd, ifname, table=rtnetlink.RT_TABLE_MAIN):
+        """
+        :param creator_fd:
+        :param ifname: 路由的默认出口网卡
+        :param table: 默认路由表
+        """
+        s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+        s.bind((0, 0,))
+        s.setblocking(0)
+
+        self.__socket = s
+        self.__ifname = ifname
+        self.__table = table
+
+        self.__ifindexes = {}
+        self.__routes = {}
+        self.__pending = OrderedDict()
+        self.__inflight = {}
+
+        self.__metric_ops = metrics.new_counter("route_ops_total", "route changes sent to kernel", ("op", "result",))
+        metrics.new_gauge("kernel_routes", "routes installed by route manager").set_function(lambda: len(self.__routes))
+
+        self.set_fileno(s.fileno())
+        self.register(self.fileno)
+        self.add_evt_read(self.fileno)
+
+        return self.fileno
+
+    def __get_ifindex(self, ifname):
+        # 网卡可能在路由管理创建之后才建立,因此在发送时才获取索引
+        if ifname not in self.__ifindexes: self.__ifindexes[ifname] = socket.if_nametoindex(ifname)
+
+        return self.__ifindexes[ifname]
+
+    def __request(self, is_add, dst, prefix, gateway, is_ipv6, ifname, table):
+        key = (dst, prefix, table,)
+        value = (gateway, is_ipv6, ifname,)
+
+        installed = key in self.__routes
+        if key in self.__pending: del self.__pending[key]
+
+        # 添加之后在发送前被删除,或者重复的请求,都不需要发送
+        if is_add and installed and self.__routes[key] == value: return
+        if not is_add and not installed: return
+
+        if is_add:
+            self.__routes[key] = value
+        else:
+            del self.__routes[key]
+
+        self.__pending[key] = (is_add,) + value
+        self.add_to_loop_task(self.fileno)
+
+    def add_route(self, dst, prefix, is_ipv6=False, gateway=None, ifname=None, table=None):
+        """添加路由
+        :param dst: 目标网络地址
+        :param prefix: 前缀长度,主机路由为32或者128
+        :param is_ipv6:
+        :param gateway: 网关,为None表示直接从网卡发出
+        :param ifname: 出口网卡,为None使用默认网卡
+        :param table: 路由表,为None使用默认路由表
+        """
+        if ifname is None: ifname = self.__ifname
+        if table is None: table = self.__table
+
+        self.__request(True, dst, prefix, gateway, is_ipv6, ifname, table)
+
+    def del_route(self, dst, prefix, table=None):
+        if table is None: table = self.__table
+        key = (dst, prefix, table,)
+        if key not in self.__routes: return
+
+        gateway, is_ipv6, ifname = self.__routes[key]
+        self.__request(False, dst, prefix, gateway, is_ipv6, ifname, table)
+
+    def route_exists(self, dst, prefix, table=None):
+        if table is None: table = self.__table
+
+        return (dst, prefix, table,) in self.__routes
+
+    def flush(self):
+        """把等待的请求批量发送给内核"""
+        buf = []
+        buf_size = 0
+        # 这一批中的请求 [(seq,key,request),...],发送失败时重新放入等待队列
+        batch = []
+
+        while self.__pending and len(self.__inflight) < self.__MAX_INFLIGHT:
+            key, request = self.__pending.popitem(last=False)
+            is_add, gateway, is_ipv6, ifname = request
+            dst, prefix, table = key
+
+            try:
+                ifindex = self.__get_ifindex(ifname)
+            except OSError:
+                print("cannot found interface %s" % ifname)
+                if is_add and key in self.__routes: del self.__routes[key]
+                continue
+
+            self.__seq = (self.__seq + 1) & 0xffffffff
+            msg = rtnetlink.build_route_msg(
+                self.__seq, is_add, dst, prefix, oif=ifindex, gateway=gateway, table=table, is_ipv6=is_ipv6
+            )
+
+            if buf_size + len(msg) > self.__BATCH_SIZE:
+                if not self.__send(b"".join(buf)):
+                    # 当前取出的请求还没有放入这一批
+                    batch.append((None, key, request,))
+                    self.__requeue(batch)
+                    return
+                buf = []
+                buf_size = 0
+                batch = []
+
+            self.__inflight[self.__seq] = (is_add, key,)
+            buf.append(msg)
+            buf_size += len(msg)
+            batch.append((self.__seq, key, request,))
+        ''''''
+
+        if buf and not self.__send(b"".join(buf)): self.__requeue(batch)
+
+    def __send(self, message):
+        try:
+            self.__socket.send(message)
+        except BlockingIOError:
+            # 内核接收缓冲区满,这一批请求重新放入等待队列,下次循环再发送
+            print("rtnetlink socket buffer is full")
+            return False
+
+        return True
+
+    def __requeue(self, batch):
+        """发送失败的请求按照原来的顺序放回等待队列的前面"""
+        for seq, key, request in reversed(batch):
+            self.__inflight.pop(seq, None)
+            # 发送失败之后又有了同一条路由的新请求,以新请求为准
+            if key in self.__pending: continue
+            self.__pending[key] = request
+            self.__pending.move_to_end(key, last=False)
+        ''''''
+        return
+
+    def task_loop(self):
+        self.flush()
+        # 剩下的请求等待内核应答之后再发送
+        if not self.__pending: self.del_loop_task(self.fileno)
+
+    def evt_read(self):
+        while 1:
+            try:
+                message = self.__socket.recv(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                # ENOBUFS,部分应答已经丢失,不再等待它们
+                self.__inflight = {}
+                continue
+            try:
+                acks = rtnetlink.parse_acks(message)
+            except rtnetlink.RtnetlinkErr:
+                continue
+            for seq, err in acks: self.__handle_ack(seq, err)
+        ''''''
+
+    def __handle_ack(self, seq, err):
+        if seq not in self.__inflight: return
+        is_add, key = self.__inflight.pop(seq)
+
+        if is_add:
+            op = "add"
+        else:
+            op = "del"
+
+        # 删除不存在的路由不是错误
+        if err == 0 or (not is_add and err == errno.ESRCH):
+            self.__metric_ops.inc(1, (op, "ok",))
+            return
+
+        self.__metric_ops.inc(1, (op, "error",))
+        print("cannot %s route %s/%s table %s:%s" % (op, key[0], key[1], key[2], errno.errorcode.get(err, err)))
+
+        # 添加失败时不保留内存中的记录,以便下次重新添加
+        if is_add and key in self.__routes and key not in self.__pending: del self.__routes[key]
+
+    def error(self):
+        self.evt_read()
+
+    def delete(self):
+        self.unregister(self.fileno)
+        self.__socket.close()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""支持域名的TCP客户端
+域名由异步解析器解析,得到的IPv6与IPv4地址按照Happy Eyeballs的方式交替尝试连接:
+每隔一段时间发起下一个连接,先连接成功者胜出,胜出的套接字通过dup2替换到本handler的文件描述符上,
+这样创建者持有的文件描述符始终不变
+"""
+
+import os, socket, time
+
+import pywind.evtframework.handlers.tcp_handler as tcp_handler
+import freenet.lib.utils as utils
+
+
+class _connect_attempt(tcp_handler.tcp_handler):
+    """单个地址的连接尝试"""
+    __creator = None
+    __address = None
+
+    def init_func(self, creator, family, address, timeout=3):
+        s = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET6: s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+
+        self.__creator = creator
+        self.__address = address
+
+        self.set_socket(s)
+        self.connect(address, timeout=timeout)
+
+        return self.fileno
+
+    def connect_ok(self):
+        self.ctl_handler(self.fileno, self.__creator, "attempt_ok", self.__address)
+
+    def tcp_error(self):
+        self.ctl_handler(self.fileno, self.__creator, "attempt_fail")
+
+    def tcp_timeout(self):
+        self.ctl_handler(self.fileno, self.__creator, "attempt_fail")
+
+    def tcp_delete(self):
+        self.unregister(self.fileno)
+        self.close()
+
+
+class tcp_connector(tcp_handler.tcp_handler):
+    """子类使用connect_host代替connect,连接成功调用connect_ok,失败调用tcp_error"""
+    # 发起下一个地址连接的间隔,定时器精度为秒
+    __ATTEMPT_DELAY = 1
+    # 解析与连接的总超时
+    __CONNECT_TIMEOUT = 10
+
+    __host = None
+    __port = None
+    __addrs = None
+    __attempts = None
+    __connected = False
+    __connecting = False
+    __deadline = 0
+    # 解析器同步返回的结果,在循环任务中处理
+    __pending_addrs = None
+
+    def create_socket(self, is_ipv6):
+        """创建套接字,连接域名时作为占位,连接成功之后会被替换"""
+        if is_ipv6:
+            fa = socket.AF_INET6
+        else:
+            fa = socket.AF_INET
+
+        s = socket.socket(fa, socket.SOCK_STREAM)
+        if is_ipv6: s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 1)
+
+        self.set_socket(s)
+
+    def connect_host(self, address, timeout=3):
+        host, port = address
+
+        if utils.is_ipv4_address(host) or utils.is_ipv6_address(host):
+            self.connect(address, timeout=timeout)
+            return
+
+        self.__host = host.lower()
+        self.__port = port
+        self.__attempts = {}
+        self.__connecting = True
+        self.__deadline = time.time() + self.__CONNECT_TIMEOUT
+
+        self.set_timeout(self.fileno, self.__CONNECT_TIMEOUT)
+
+        addrs = self.dispatcher.resolve_host(self.fileno, host)
+        if addrs is None: return
+
+        # connect_host在init_func中调用,此时handler还没有注册,失败时无法删除自己,因此延迟到循环任务中处理
+        self.__pending_addrs = addrs
+        self.add_to_loop_task(self.fileno)
+
+    def task_loop(self):
+        self.del_loop_task(self.fileno)
+        addrs = self.__pending_addrs
+        self.__pending_addrs = None
+
+        if not self.__connecting or addrs is None: return
+        self.__resolved(addrs)
+
+    def __resolved(self, addrs):
+        if not addrs:
+            self.__fail()
+            return
+
+        self.__addrs = list(addrs)
+        self.__next_attempt()
+
+    def __next_attempt(self):
+        while self.__addrs:
+            family, ip = self.__addrs.pop(0)
+            try:
+                fd = self.create_handler(
+                    self.fileno, _connect_attempt, family, (ip, self.__port,), timeout=self.__CONNECT_TIMEOUT
+                )
+            except OSError:
+                continue
+            # 连接可能在创建时已经失败
+            if not self.handler_exists(fd): continue
+            self.__attempts[fd] = None
+            break
+        ''''''
+
+        if not self.__attempts:
+            self.__fail()
+            return
+
+        if self.__addrs:
+            self.set_timeout(self.fileno, self.__ATTEMPT_DELAY)
+        else:
+            self.set_timeout(self.fileno, max(1, int(self.__deadline - time.time())))
+
+    def __del_attempts(self):
+        if not self.__attempts: return
+        for fd in self.__attempts: self.delete_handler(fd)
+        self.__attempts = {}
+
+    def __fail(self):
+        self.__connecting = False
+        self.__del_attempts()
+        self.set_timeout(self.fileno, -1)
+        self.tcp_error()
+
+    def __attempt_ok(self, fd):
+        h = self.dispatcher.get_handler(fd)
+        fileno = self.fileno
+
+        # 用胜出的连接替换占位套接字,文件描述符保持不变,并且不能被os.system启动的子进程继承
+        os.dup2(h.fileno, fileno, inheritable=False)
+        self.socket.detach()
+        s = socket.socket(fileno=fileno)
+        self.set_socket(s)
+
+        self.__connecting = False
+        self.__connected = True
+        self.__del_attempts()
+        self.set_timeout(self.fileno, -1)
+        self.connect_ok()
+
+    def __attempt_fail(self, fd):
+        if fd in self.__attempts: del self.__attempts[fd]
+        self.delete_handler(fd)
+
+        if self.__addrs:
+            self.__next_attempt()
+            return
+
+        if not self.__attempts: self.__fail()
+
+    def is_conn_ok(self):
+        if self.__connected: return True
+
+        return super(tcp_connector, self).is_conn_ok()
+
+    def timeout(self):
+        if not self.__connecting:
+            super(tcp_connector, self).timeout()
+            return
+
+        if time.time() >= self.__deadline:
+            self.__fail()
+            return
+
+        # 还没有解析出地址
+        if self.__addrs is None:
+            self.set_timeout(self.fileno, max(1, int(self.__deadline - time.time())))
+            return
+
+        self.__next_attempt()
+
+    def handler_ctl(self, from_fd, cmd, *args, **kwargs):
+        if not self.__connecting: return
+
+        if cmd == "resolve_result":
+            host, addrs = args
+            if host != self.__host or self.__addrs is not None: return
+            self.__resolved(addrs)
+            return
+
+        if from_fd not in self.__attempts: return
+
+        if cmd == "attempt_ok":
+            self.__attempt_ok(from_fd)
+            return
+
+        if cmd == "attempt_fail":
+            self.__attempt_fail(from_fd)
+            return
+
+    def delete(self):
+        self.__connecting = False
+        self.__del_attempts()
+        super(tcp_connector, self).delete()
@@ -2,16 +2,28 @@
 """实现P2P代理,让非白名单的IP地址走代理"""
 import pywind.evtframework.handlers.handler as handler
 import pywind.evtframework.handlers.udp_handler as udp_handler
-import socket, os, time
+import socket, os, time, itertools
+from collections import deque
 import freenet.lib.fdsl_ctl as fdsl_ctl
 import freenet.lib.ippkts as ippkts
 import freenet.lib.utils as utils
+import freenet.lib.metrics as metrics
+import freenet.lib.sendmmsg as sendmmsg
+
+_raw_packets = metrics.new_counter("raw_send_packets_total", "packets sent by raw sockets", ("family", "result",))
 
 
 class traffic_read(handler.handler):
     """读取局域网的源数据包"""
     __tunnel_fd = -1
 
+    # 批量读取时一次读取的最大字节数
+    __READ_SIZE = 65536
+    # 每次可读事件最多读取的次数,防止其他的handler得不到处理
+    __MAX_READS = 16
+    # 旧版本的内核模块不支持批量读取,每次读取一个数据包
+    __batch = False
+
     def init_func(self, creator_fd, gw_configs, enable_ipv6=False):
         """
         :param creator_fd:
@@ -41,12 +53,37 @@ class traffic_read(handler.handler):
             )
         self.__tunnel_fd = creator_fd
 
+        queue_size = int(gw_configs.get("dgram_queue_size", 1024))
+        if fdsl_ctl.set_queue_size(fileno, queue_size) != 0: print("cannot set dgram queue size to %s" % queue_size)
+        self.__batch = fdsl_ctl.set_batch(fileno, True) == 0
+        if not self.__batch: print("the dgram kernel module does not support batch read, reading one packet at a time")
+
         self.set_fileno(fileno)
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
 
+        metrics.new_gauge("dgram_dev_packets", "packets captured by kernel module", ("result",)).set_function(
+            self.__collect_packets
+        )
+        metrics.new_gauge("queue_depth", "packets waiting in queue", ("queue",)).set_function(
+            self.__collect_depth, key="dgram_dev"
+        )
+
         return self.fileno
 
+    def __collect_packets(self):
+        stats = fdsl_ctl.get_stats(self.fileno)
+        if not stats: return []
+        pushed, overflow, oversize, queue_size, have = stats
+
+        return [(("pushed",), pushed,), (("overflow",), overflow,), (("oversize",), oversize,)]
+
+    def __collect_depth(self):
+        stats = fdsl_ctl.get_stats(self.fileno)
+        if not stats: return []
+
+        return [(("dgram_dev",), stats[4],)]
+
     def set_tunnel_ip(self, tunnel_ip):
         if utils.is_ipv6_address(tunnel_ip):
             r = fdsl_ctl.set_tunnel(self.fileno, socket.inet_pton(socket.AF_INET6, tunnel_ip), True)
@@ -56,113 +93,274 @@ class traffic_read(handler.handler):
         return
 
     def evt_read(self):
-        n = 0
-        while n < 5:
+        """批量读取,每个数据包前面有2字节的长度"""
+        if not self.__batch:
+            self.__read_one_by_one()
+            return
+
+        for i in range(self.__MAX_READS):
+            try:
+                data = os.read(self.fileno, self.__READ_SIZE)
+            except BlockingIOError:
+                break
+            if not data: break
+
+            size = len(data)
+            pos = 0
+            while pos + 2 <= size:
+                length = (data[pos] << 8) | data[pos + 1]
+                pos += 2
+                self.dispatcher.handle_msg_from_dgramdev(data[pos:pos + length])
+                pos += length
+            ''''''
+        return
+
+    def __read_one_by_one(self):
+        for i in range(self.__MAX_READS):
             try:
                 pkt = os.read(self.fileno, 8192)
-                self.dispatcher.handle_msg_from_dgramdev(pkt)
             except BlockingIOError:
                 break
-            n += 1
-            if not pkt: continue
+            if not pkt: break
+            self.dispatcher.handle_msg_from_dgramdev(pkt)
+        ''''''
         return
 
     def delete(self):
+        metrics.new_gauge("dgram_dev_packets", "packets captured by kernel module", ("result",)).del_function()
+        metrics.new_gauge("queue_depth", "packets waiting in queue", ("queue",)).del_function(key="dgram_dev")
         self.unregister(self.fileno)
         os.close(self.fileno)
 
 
-class ip4_raw_send(handler.handler):
-    """把数据包发送到局域网的设备"""
-    __creator_fd = -1
-    __sent = None
+class packet_read(handler.handler):
+    """使用AF_PACKET内存映射环形缓冲区读取局域网的源数据包,不需要fdslight_dgram内核模块
+    内核模块工作在转发链,这里在数据包进入路由之前得到副本,因此需要排除发送到本机的数据包,
+    并且由nftables在转发链中丢弃原来的数据包
+    """
     __socket = None
+    __ring = None
+    __forward_drop = None
+
+    __subnet = None
+    __subnet6 = None
 
-    def init_func(self, creator_fd):
-        self.__creator_fd = creator_fd
-        self.__sent = []
+    __local_addrs = None
+    __local_addrs_time = 0
+    # 刷新本机地址的时间间隔
+    __LOCAL_ADDRS_REFRESH = 30
 
-        family = socket.AF_INET
+    def init_func(self, creator_fd, gw_configs, enable_ipv6=False):
+        import freenet.lib.packet_ring as packet_ring
+
+        dgram_proxy_subnet, prefix = utils.extract_subnet_info(gw_configs["dgram_proxy_subnet"])
+        dgram_proxy_subnet6, prefix6 = utils.extract_subnet_info(gw_configs["dgram_proxy_subnet6"])
 
-        s = socket.socket(family, socket.SOCK_RAW,
-                          socket.IPPROTO_UDP | socket.IPPROTO_ICMP | socket.IPPROTO_UDP | 136)
-        s.setsockopt(socket.IPPROTO_IP, socket.IP_HDRINCL, 1)
+        subnet = utils.calc_subnet(dgram_proxy_subnet, prefix, is_ipv6=False)
+        subnet6 = utils.calc_subnet(dgram_proxy_subnet6, prefix6, is_ipv6=True)
+
+        self.__subnet = (socket.inet_aton(subnet), prefix,)
+        if enable_ipv6: self.__subnet6 = (socket.inet_pton(socket.AF_INET6, subnet6), prefix6,)
+
+        s = socket.socket(socket.AF_PACKET, socket.SOCK_DGRAM, socket.htons(packet_ring.ETH_P_ALL))
         s.setblocking(0)
+        packet_ring.attach_filter(s, packet_ring.build_filter(self.__subnet, self.__subnet6))
 
+        capture_if = gw_configs.get("capture_if", "")
+        if capture_if: s.bind((capture_if, 0,))
+
+        self.__ring = packet_ring.rx_ring(s)
         self.__socket = s
+
+        if enable_ipv6:
+            self.__forward_drop = packet_ring.forward_drop((subnet, prefix,), (subnet6, prefix6,))
+        else:
+            self.__forward_drop = packet_ring.forward_drop((subnet, prefix,))
+        self.__forward_drop.setup()
+
+        self.__local_addrs = set()
+        self.__refresh_local_addrs()
+
         self.set_fileno(s.fileno())
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
 
         return self.fileno
 
+    def __refresh_local_addrs(self):
+        """获取本机的全部地址,发送到本机的数据包不需要代理"""
+        addrs = set()
+        fp = os.popen("ip -o addr show")
+        for line in fp:
+            seq = line.split()
+            if len(seq) < 4 or seq[2] not in ("inet", "inet6",): continue
+            address = seq[3].split("/")[0]
+            if seq[2] == "inet":
+                addrs.add(socket.inet_aton(address))
+            else:
+                addrs.add(socket.inet_pton(socket.AF_INET6, address))
+        ''''''
+        fp.close()
+
+        self.__local_addrs = addrs
+        self.__local_addrs_time = time.time()
+
+    def set_tunnel_ip(self, tunnel_ip):
+        import freenet.lib.packet_ring as packet_ring
+
+        if utils.is_ipv6_address(tunnel_ip):
+            byte_tunnel_ip = socket.inet_pton(socket.AF_INET6, tunnel_ip)
+        else:
+            byte_tunnel_ip = socket.inet_aton(tunnel_ip)
+
+        insns = packet_ring.build_filter(self.__subnet, self.__subnet6, byte_tunnel_ip)
+        packet_ring.attach_filter(self.__socket, insns)
+        self.__forward_drop.setup(tunnel_ip)
+
     def evt_read(self):
-        """丢弃所有收到的包"""
-        while 1:
-            try:
-                _ = self.__socket.recvfrom(8192)
-            except BlockingIOError:
-                break
-            ''''''
+        if time.time() - self.__local_addrs_time > self.__LOCAL_ADDRS_REFRESH: self.__refresh_local_addrs()
+
+        for packet in self.__ring.read():
+            if packet[0] >> 4 == 4:
+                byte_daddr = packet[16:20]
+            else:
+                byte_daddr = packet[24:40]
+            if byte_daddr in self.__local_addrs: continue
+            self.dispatcher.handle_msg_from_dgramdev(packet)
+        ''''''
         return
 
-    def evt_write(self):
-        if not self.__sent: self.remove_evt_write(self.fileno)
+    def delete(self):
+        self.__forward_drop.cleanup()
+        self.unregister(self.fileno)
+        self.__ring.close()
+        self.__socket.close()
 
-        while 1:
-            try:
-                ippkt = self.__sent.pop(0)
-            except IndexError:
-                break
 
-            ip_ver = (ippkt[0] & 0xf0) >> 4
-            # 目前只支持IPv4
-            if ip_ver != 4: continue
+class raw_send(handler.handler):
+    """把数据包发送到局域网的设备,数据包必须包含IP头部
+    支持sendmmsg时一次系统调用发送一批数据包
+    """
+    __socket = None
+    __sent = None
+    __sender = None
+    __is_ipv6 = False
+    __ip_ver = 4
+    __family_name = None
+
+    # 队列中最多的数据包个数,超过时丢弃新的数据包
+    __MAX_QUEUE_SIZE = 4096
 
-            dst_addr_pkt = ippkt[16:20]
-            dst_addr = socket.inet_ntoa(dst_addr_pkt)
-            pkt_len = (ippkt[2] << 8) | ippkt[3]
+    def init_func(self, creator_fd, is_ipv6=False):
+        """
+        :param creator_fd:
+        :param is_ipv6: 是否发送IPv6数据包,一个handler只发送一种地址族的数据包
+        :return:
+        """
+        if is_ipv6:
+            fa = socket.AF_INET6
+            self.__ip_ver = 6
+            self.__family_name = "ip6"
+        else:
+            fa = socket.AF_INET
+            self.__ip_ver = 4
+            self.__family_name = "ip4"
+
+        self.__is_ipv6 = is_ipv6
+        self.__sent = deque()
+
+        # IPPROTO_RAW的套接字只用于发送,不会收到数据包,并且隐含IP_HDRINCL
+        s = socket.socket(fa, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        s.setblocking(0)
+
+        if sendmmsg.is_supported(): self.__sender = sendmmsg.batch_sender(s.fileno(), is_ipv6=is_ipv6)
+
+        self.__socket = s
+        self.set_fileno(s.fileno())
+        self.register(self.fileno)
+
+        metrics.new_gauge("queue_depth", "packets waiting in queue", ("queue",)).set_function(
+            self.__collect_depth, key="raw_send_%s" % self.__family_name
+        )
+
+        return self.fileno
+
+    def __collect_depth(self):
+        return [(("raw_send_%s" % self.__family_name,), len(self.__sent),)]
+
+    def __send_one(self, ippkt):
+        if self.__is_ipv6:
+            dst_addr = socket.inet_ntop(socket.AF_INET6, ippkt[24:40])
+        else:
+            dst_addr = socket.inet_ntoa(ippkt[16:20])
+
+        self.__socket.sendto(ippkt, (dst_addr, 0))
+
+    def evt_write(self):
+        sent = self.__sent
+        sender = self.__sender
+
+        while sent:
             try:
-                sent_len = self.__socket.sendto(ippkt, (dst_addr, 0))
+                if sender and len(sent[0]) <= sender.slot_size:
+                    n = sender.send(itertools.islice(sent, sender.batch_size))
+                else:
+                    self.__send_one(sent[0])
+                    n = 1
             except BlockingIOError:
-                self.__sent.insert(0, ippkt)
-                return
+                n = 0
+            except OSError:
+                # 无法发送的数据包,例如没有路由,丢弃之后继续发送
+                sent.popleft()
+                _raw_packets.inc(labels=(self.__family_name, "error",))
+                continue
 
-            if pkt_len > sent_len:
-                self.__sent.insert(0, ippkt)
-                break
-            ''''''
-        return
+            if n == 0: return
+
+            for i in range(n): sent.popleft()
+            _raw_packets.inc(n, labels=(self.__family_name, "sent",))
+        ''''''
+
+        self.remove_evt_write(self.fileno)
 
     def message_from_handler(self, from_fd, byte_data):
-        self.add_evt_write(self.fileno)
+        if (byte_data[0] & 0xf0) >> 4 != self.__ip_ver:
+            _raw_packets.inc(labels=(self.__family_name, "version",))
+            return
+
+        if len(self.__sent) >= self.__MAX_QUEUE_SIZE:
+            _raw_packets.inc(labels=(self.__family_name, "overflow",))
+            return
+
+        if not self.__sent: self.add_evt_write(self.fileno)
         self.__sent.append(byte_data)
 
     def delete(self):
+        metrics.new_gauge("queue_depth", "packets waiting in queue", ("queue",)).del_function(
+            key="raw_send_%s" % self.__family_name
+        )
         self.unregister(self.fileno)
         self.__socket.close()
 
 
 class p2p_proxy(udp_handler.udp_handler):
-    # 代理超时时间
-    __PROXY_TIMEOUT = 180
-    __LOOP_TIMEOUT = 10
-
-    __internal_ip = None
-    __byte_internal_ip = None
-    __port = None
-
-    # 允许发送的对端机器
-    __permits = None
-
-    __update_time = 0
-
-    __session_id = None
+    """服务端UDP全锥形代理的套接字,可以被一个流独占,也可以在套接字池中被多个流共享,
+    收到的数据包按照对端地址找到对应的流,参见freenet.lib.udp_flow
+    """
     __is_udplite = False
-
     __is_ipv6 = False
-
-    def init_func(self, creator_fd, session_id, internal_address, is_udplite=False, is_ipv6=False):
+    __is_shared = False
+    __fa = None
+    __local_port = None
+
+    # 对端到流的映射 {(byte_addr,port):flow,...}
+    __peers = None
+    # 使用这个套接字的流
+    __flows = None
+    # 每个对端地址的头部模板
+    __udp_templates = None
+
+    def init_func(self, creator_fd, is_udplite=False, is_ipv6=False, is_shared=False):
         if not is_udplite:
             proto = 17
         else:
@@ -175,13 +373,13 @@ class p2p_proxy(udp_handler.udp_handler):
 
         self.__is_udplite = is_udplite
         self.__is_ipv6 = is_ipv6
-        self.__update_time = time.time()
-        self.__internal_ip = internal_address[0]
-        self.__byte_internal_ip = socket.inet_pton(fa, self.__internal_ip)
-        self.__port = internal_address[1]
+        self.__is_shared = is_shared
+        self.__fa = fa
+        self.__peers = {}
+        self.__flows = set()
+        self.__udp_templates = ippkts.udp_template_cache(max_size=64)
 
         s = socket.socket(fa, socket.SOCK_DGRAM, proto)
-        self.__permits = {}
 
         self.set_socket(s)
 
@@ -190,38 +388,74 @@ class p2p_proxy(udp_handler.udp_handler):
         else:
             self.bind(("0.0.0.0", 0))
 
+        self.__local_port = self.getsockname()[1]
+
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
 
-        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
-        self.__session_id = session_id
-
         return self.fileno
 
-    def udp_readable(self, message, address):
-        addr_id = "%s-%s" % address
+    @property
+    def local_port(self):
+        return self.__local_port
+
+    @property
+    def is_shared(self):
+        return self.__is_shared
+
+    @property
+    def flow_count(self):
+        return len(self.__flows)
+
+    def add_flow(self, flw):
+        self.__flows.add(flw)
+        flw.fileno = self.fileno
+        flw.local_port = self.__local_port
 
-        if addr_id not in self.__permits: return
+    def remove_flow(self, flw):
+        self.__flows.discard(flw)
+        for peer in flw.permits:
+            if self.__peers.get(peer, None) is flw: del self.__peers[peer]
+        flw.permits.clear()
 
-        self.__update_time = time.time()
-        n_saddr = socket.inet_aton(address[0])
+    def add_permit(self, flw, peer):
+        """允许接收的数据包来源
+        :param flw:
+        :param peer: (byte_addr,port)
+        :return: False表示共享套接字中这个对端已经被其他的流使用
+        """
+        owner = self.__peers.get(peer, None)
+        if owner is not None and owner is not flw: return False
+
+        self.__peers[peer] = flw
+        flw.permits.add(peer)
+
+        return True
+
+    def udp_readable(self, message, address):
+        n_saddr = socket.inet_pton(self.__fa, address[0])
         sport = address[1]
 
+        flw = self.__peers.get((n_saddr, sport,), None)
+        if not flw: return
+
+        flw.update_time = time.time()
+
         if self.__is_ipv6:
             mtu = 1280
         else:
             mtu = 1440
 
-        udp_packets = ippkts.build_udp_packets(
-            n_saddr, self.__byte_internal_ip,
-            sport, self.__port, message,
+        udp_packets = self.__udp_templates.build_udp_packets(
+            n_saddr, flw.byte_saddr,
+            sport, flw.sport, message,
             mtu=mtu,
             is_udplite=self.__is_udplite,
             is_ipv6=self.__is_ipv6
         )
 
         for udp_pkt in udp_packets:
-            self.dispatcher.send_msg_to_tunnel_from_p2p_proxy(self.__session_id, udp_pkt)
+            self.dispatcher.send_msg_to_tunnel_from_p2p_proxy(flw.session_id, udp_pkt)
         return
 
     def udp_writable(self):
@@ -231,28 +465,10 @@ class p2p_proxy(udp_handler.udp_handler):
         self.delete_handler(self.fileno)
 
     def udp_delete(self):
-        self.dispatcher.tell_del_dgram_proxy(self.__session_id, self.__internal_ip, self.__port)
+        self.dispatcher.tell_del_dgram_proxy(self.fileno, list(self.__flows))
         self.unregister(self.fileno)
         self.close()
 
-    def udp_timeout(self):
-        t = time.time()
-
-        if t - self.__update_time > self.__PROXY_TIMEOUT:
-            self.delete_handler(self.fileno)
-            return
-
-        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
-
     def send_msg(self, message, address):
         self.add_evt_write(self.fileno)
         self.sendto(message, address)
-        self.add_permit(address)
-
-    def add_permit(self, address):
-        """允许接收的数据包来源
-        :param address: 
-        :return: 
-        """
-        addr_id = "%s-%s" % address
-        if addr_id not in self.__permits: self.__permits[addr_id] = None
@@ -1,9 +1,10 @@
 #!/usr/bin/env python3
 
-import os, sys
+import os, sys, socket, struct
 import pywind.evtframework.handlers.handler as handler
 import freenet.lib.fn_utils as fn_utils
 import freenet.lib.simple_qos as simple_qos
+import freenet.lib.metrics as metrics
 
 try:
     import fcntl
@@ -11,8 +12,13 @@ except ImportError:
     pass
 
 
+# 设置网卡MTU的ioctl,来自linux/sockios.h
+_SIOCSIFMTU = 0x8922
+
+
 class tun_base(handler.handler):
     __creator_fd = None
+    __dev_name = None
     # 要写入到tun的IP包
     ___ip_packets_for_write = []
     # 写入tun设备的最大IP数据包的个数
@@ -24,6 +30,8 @@ class tun_base(handler.handler):
 
     __qos = None
 
+    __metric_drops = None
+
     def __create_tun_dev(self, name):
         """创建tun 设备
         :param name:
@@ -54,10 +62,16 @@ class tun_base(handler.handler):
             sys.exit(-1)
 
         self.__creator_fd = creator_fd
+        self.__dev_name = tun_dev_name
         self.__qos = simple_qos.qos(simple_qos.QTYPE_DST)
 
         self.set_fileno(tun_fd)
         fcntl.fcntl(tun_fd, fcntl.F_SETFL, os.O_NONBLOCK)
+
+        self.__metric_drops = metrics.new_counter("queue_drops_total", "packets dropped by full queue", ("queue",))
+        metrics.new_gauge("queue_depth", "packets waiting in queue", ("queue",)).set_function(
+            lambda: [(("tun_write",), self.__current_write_queue_n,)], key="tun_write"
+        )
         self.dev_init(tun_dev_name, *args, **kwargs)
 
         return tun_fd
@@ -65,6 +79,21 @@ class tun_base(handler.handler):
     def dev_init(self, dev_name, *args, **kwargs):
         pass
 
+    def set_mtu(self, mtu):
+        """设置tun设备的MTU
+        :return: 是否设置成功
+        """
+        ifreq = struct.pack("16si12x", self.__dev_name.encode(), mtu)
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            fcntl.ioctl(s.fileno(), _SIOCSIFMTU, ifreq)
+        except OSError:
+            return False
+        finally:
+            s.close()
+
+        return True
+
     def evt_read(self):
         for i in range(10):
             try:
@@ -145,7 +174,7 @@ class tun_base(handler.handler):
             # 删除第一个包,防止队列过多
             self.__current_write_queue_n -= 1
             self.___ip_packets_for_write.pop(0)
-            return
+            self.__metric_drops.inc(1, ("tun_write",))
 
         self.__current_write_queue_n += 1
         self.___ip_packets_for_write.append(n_ip_message)
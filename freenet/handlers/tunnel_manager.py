@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""客户端隧道管理
+启动时就建立隧道,可选再建立一条备用隧道,主隧道断开时直接切换到备用隧道
+服务器地址异步解析并且缓存,断开之后按指数退避重新连接,不需要等待数据包到来
+重新连接期间的数据包放入有上限的缓冲区,连接成功之后再发送
+
+TCP隧道可以同时建立多个连接,IP数据包按照五元组哈希分配到连接上,同一个流始终使用同一个连接,
+每个连接建立之后首先发送加入消息告知服务器连接序号与总数,服务器按照同样的哈希选择返回的连接
+DNS与socks数据只使用第一个可用的连接,以保证顺序
+"""
+
+import os, socket
+from collections import deque
+
+import pywind.evtframework.handlers.handler as handler
+import freenet.lib.base_proto.utils as proto_utils
+import freenet.lib.utils as utils
+import freenet.lib.logging as logging
+import freenet.lib.metrics as metrics
+
+_reconnects = metrics.new_counter("tunnel_reconnects_total", "tunnel connection attempts", ("result",))
+_buffer_dropped = metrics.new_counter("tunnel_buffer_dropped_total", "packets dropped when the tunnel is down")
+
+
+class tunnel_manager(handler.handler):
+    # 重新连接的最大等待时间
+    __MAX_BACKOFF = 64
+
+    __server_address = None
+    __server_ip = None
+    __is_ipv6 = None
+    __resolver_fileno = -1
+    __is_resolving = False
+
+    __tunnel_cls = None
+    __tunnel_args = None
+    __tunnel_kwargs = None
+
+    # 每个位置的连接文件描述符,-1表示没有建立
+    __tunnels = None
+    # 每个位置的连接是否已经可以发送数据
+    __oks = None
+    __standby = -1
+    __standby_ok = False
+    __enable_standby = False
+
+    # 下一次连接失败之后的等待时间
+    __backoff = 1
+    __is_waiting = False
+    __buffer = None
+    __buffer_size = None
+
+    __pipe_w = None
+
+    def init_func(self, creator_fd, server_address, resolver_fileno, tunnel_cls, tunnel_args, tunnel_kwargs,
+                  is_ipv6=False, standby=False, buffer_size=256, connections=1):
+        """
+        :param creator_fd:
+        :param server_address: (host,port)
+        :param resolver_fileno: 用于解析服务器地址的async_resolver.resolver
+        :param tunnel_cls: tunnelc.tcp_tunnel或者tunnelc.udp_tunnel
+        :param tunnel_args: 传递给隧道的参数
+        :param tunnel_kwargs: 传递给隧道的参数
+        :param is_ipv6: 是否以IPv6建立隧道
+        :param standby: 是否建立备用隧道
+        :param buffer_size: 隧道没有建立时最多缓存的数据包个数
+        :param connections: 同时使用的连接数,只有TCP隧道支持多个连接
+        """
+        # 管道只用于分配唯一的文件描述符,以便使用定时器与handler_ctl,不加入事件监听
+        r, w = os.pipe()
+
+        self.__pipe_w = w
+        self.__server_address = server_address
+        self.__resolver_fileno = resolver_fileno
+        self.__tunnel_cls = tunnel_cls
+        self.__tunnel_args = tunnel_args
+        self.__tunnel_kwargs = tunnel_kwargs
+        self.__is_ipv6 = is_ipv6
+        self.__enable_standby = standby
+        self.__buffer = deque()
+        self.__buffer_size = buffer_size
+        self.__tunnels = [-1] * connections
+        self.__oks = [False] * connections
+
+        metrics.new_gauge("tunnel_buffered", "packets waiting for the tunnel").set_function(
+            lambda: len(self.__buffer)
+        )
+        metrics.new_gauge("tunnel_connections", "established tunnel connections").set_function(
+            lambda: self.__oks.count(True)
+        )
+
+        self.set_fileno(r)
+        # 在事件循环中建立隧道,此时其他的handler都已经创建
+        self.add_to_loop_task(r)
+
+        return r
+
+    def tunnel_ok(self):
+        return True in self.__oks
+
+    def __primary(self):
+        """第一个可用连接的位置,没有可用连接返回-1"""
+        if True not in self.__oks: return -1
+
+        return self.__oks.index(True)
+
+    def __select(self, action, message):
+        n = len(self.__tunnels)
+        if n == 1:
+            if self.__oks[0]: return self.__tunnels[0]
+            return -1
+
+        if action != proto_utils.ACT_IPDATA:
+            i = self.__primary()
+            if i < 0: return -1
+            return self.__tunnels[i]
+
+        # 连接不可用时顺序使用下一个连接,其他连接上的流不受影响
+        i = utils.flow_hash(message) % n
+        for j in range(n):
+            k = (i + j) % n
+            if self.__oks[k]: return self.__tunnels[k]
+        ''''''
+
+        return -1
+
+    def send_msg_to_tunnel(self, session_id, action, message):
+        fileno = self.__select(action, message)
+        if fileno >= 0:
+            self.dispatcher.get_handler(fileno).send_msg_to_tunnel(session_id, action, message)
+            return
+
+        if len(self.__buffer) >= self.__buffer_size:
+            self.__buffer.popleft()
+            _buffer_dropped.inc()
+        self.__buffer.append((session_id, action, message,))
+
+    def __flush_buffer(self):
+        if not self.tunnel_ok(): return
+        while self.__buffer:
+            session_id, action, message = self.__buffer.popleft()
+            self.send_msg_to_tunnel(session_id, action, message)
+        ''''''
+        return
+
+    def __need_connect(self):
+        if -1 in self.__tunnels: return True
+
+        return self.__enable_standby and self.__standby < 0
+
+    def __connect(self):
+        if self.__is_resolving: return
+        if not self.__need_connect(): return
+
+        h = self.dispatcher.get_handler(self.__resolver_fileno)
+        addrs = h.resolve(self.fileno, self.__server_address[0])
+        if addrs is None:
+            self.__is_resolving = True
+            return
+
+        self.__resolved(addrs)
+
+    def __resolved(self, addrs):
+        if self.__is_ipv6:
+            family = socket.AF_INET6
+        else:
+            family = socket.AF_INET
+
+        server_ip = None
+        for fa, ip in addrs:
+            if fa != family: continue
+            server_ip = ip
+            break
+        ''''''
+
+        # 解析失败时使用上一次的地址
+        if not server_ip: server_ip = self.__server_ip
+        if not server_ip:
+            logging.print_general("not_found_host", self.__server_address)
+            self.__retry_later()
+            return
+
+        if server_ip != self.__server_ip:
+            self.__server_ip = server_ip
+            self.dispatcher.tell_server_ip(server_ip)
+
+        for i in range(len(self.__tunnels)):
+            if self.__tunnels[i] < 0: self.__open_tunnel(i)
+        if self.__enable_standby and self.__standby < 0: self.__open_tunnel(-1)
+
+    def __open_tunnel(self, index):
+        """
+        :param index: 连接位置,-1表示备用连接
+        """
+        fd = self.create_handler(self.fileno, self.__tunnel_cls, *self.__tunnel_args, **self.__tunnel_kwargs)
+        # 隧道在create_tunnel中就可能通知连接成功,因此先记录文件描述符
+        if index < 0:
+            self.__standby = fd
+            self.__standby_ok = False
+        else:
+            self.__tunnels[index] = fd
+            self.__oks[index] = False
+
+        if self.dispatcher.get_handler(fd).create_tunnel(self.__server_address, self.__server_ip): return
+
+        # 删除隧道时会通知tunnel_close,由__tunnel_down处理重新连接
+        self.delete_handler(fd)
+
+    def __retry_later(self):
+        """按指数退避等待之后重新连接"""
+        # 多个连接同时失败只计算一次
+        if self.__is_waiting: return
+        self.__is_waiting = True
+        self.set_timeout(self.fileno, self.__backoff)
+        self.__backoff = min(self.__backoff * 2, self.__MAX_BACKOFF)
+
+    def __join(self, index):
+        """告知服务器连接的位置,只有一个连接时不发送,以兼容不支持多连接的服务器"""
+        n = len(self.__tunnels)
+        if n == 1: return
+
+        self.dispatcher.get_handler(self.__tunnels[index]).send_msg_to_tunnel(
+            self.dispatcher.session_id, proto_utils.ACT_TUNNEL, proto_utils.build_tunnel_join(index, n)
+        )
+
+    def __tunnel_up(self, fileno):
+        _reconnects.inc(1, ("ok",))
+        self.__backoff = 1
+
+        if fileno == self.__standby:
+            self.__standby_ok = True
+            return
+
+        i = self.__tunnels.index(fileno)
+        self.__oks[i] = True
+        self.__join(i)
+        self.__flush_buffer()
+
+    def __tunnel_down(self, fileno):
+        if fileno == self.__standby:
+            is_ok = self.__standby_ok
+            self.__standby = -1
+            self.__standby_ok = False
+        else:
+            i = self.__tunnels.index(fileno)
+            is_ok = self.__oks[i]
+            is_primary = i == self.__primary()
+
+            # 备用连接接替断开的连接
+            self.__tunnels[i] = self.__standby
+            self.__oks[i] = self.__standby_ok
+            self.__standby = -1
+            self.__standby_ok = False
+
+            # 通过隧道建立的代理连接已经不可用
+            if is_primary: self.dispatcher.tell_tunnel_close()
+            if self.__oks[i]:
+                self.__join(i)
+                self.__flush_buffer()
+            ''''''
+
+        if is_ok:
+            # 正常断开的隧道立即重新连接,在事件循环中进行,此时旧的隧道还没有从分发器中删除
+            self.add_to_loop_task(self.fileno)
+            return
+
+        _reconnects.inc(1, ("fail",))
+        self.__retry_later()
+
+    def handler_ctl(self, from_fd, cmd, *args, **kwargs):
+        if cmd == "resolve_result":
+            host, addrs = args
+            self.__is_resolving = False
+            self.__resolved(addrs)
+            return
+
+        if from_fd < 0: return
+        if from_fd != self.__standby and from_fd not in self.__tunnels: return
+
+        if cmd == "tunnel_ok": self.__tunnel_up(from_fd)
+        if cmd == "tunnel_close": self.__tunnel_down(from_fd)
+
+    def task_loop(self):
+        self.del_loop_task(self.fileno)
+        self.__connect()
+
+    def timeout(self):
+        self.__is_waiting = False
+        self.__connect()
+
+    def delete(self):
+        fds = self.__tunnels + [self.__standby]
+        self.__tunnels = [-1] * len(self.__tunnels)
+        self.__oks = [False] * len(self.__oks)
+        self.__standby = -1
+
+        for fd in fds:
+            if fd >= 0: self.delete_handler(fd)
+
+        os.close(self.fileno)
+        os.close(self.__pipe_w)
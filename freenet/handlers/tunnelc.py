@@ -7,6 +7,11 @@ import pywind.evtframework.handlers.udp_handler as udp_handler
 import socket, time
 import freenet.lib.base_proto.utils as proto_utils
 import freenet.lib.logging as logging
+import freenet.lib.metrics as metrics
+import freenet.lib.fec as fec
+import freenet.lib.pmtu as pmtu
+
+_crypto_errors = metrics.new_counter("crypto_errors_total", "packets failed in decrypting or checking", ("tunnel",))
 
 
 class tcp_tunnel(tcp_handler.tcp_handler):
@@ -18,6 +23,7 @@ class tcp_tunnel(tcp_handler.tcp_handler):
     __conn_timeout = 0
 
     __server_address = None
+    __creator = -1
 
     def init_func(self, creator, crypto, crypto_configs, conn_timeout=720, is_ipv6=False):
         if is_ipv6:
@@ -27,6 +33,7 @@ class tcp_tunnel(tcp_handler.tcp_handler):
         s = socket.socket(fa, socket.SOCK_STREAM)
 
         self.set_socket(s)
+        self.__creator = creator
         self.__conn_timeout = conn_timeout
 
         self.__encrypt = crypto.encrypt()
@@ -37,19 +44,26 @@ class tcp_tunnel(tcp_handler.tcp_handler):
 
         return self.fileno
 
-    def create_tunnel(self, server_address):
-        server_ip = self.dispatcher.get_server_ip(server_address[0])
+    def create_tunnel(self, server_address, server_ip):
+        """
+        :param server_address: 配置中的服务器地址
+        :param server_ip: 已经解析的服务器IP
+        """
+        self.__server_address = server_address
 
         try:
             self.connect((server_ip, server_address[1]), timeout=8)
             logging.print_general("connecting", server_address)
-        except socket.gaierror:
-            logging.print_general("not_found_host", server_address)
+        except OSError:
+            logging.print_general("tcp_error", server_address)
             return False
 
-        self.__server_address = server_address
+        if self.is_conn_ok(): self.connect_ok()
         return True
 
+    def __tell_creator(self, cmd):
+        if self.handler_exists(self.__creator): self.ctl_handler(self.fileno, self.__creator, cmd)
+
     def tcp_readable(self):
         rdata = self.reader.read()
         self.__decrypt.input(rdata)
@@ -58,6 +72,7 @@ class tcp_tunnel(tcp_handler.tcp_handler):
             try:
                 self.__decrypt.parse()
             except proto_utils.ProtoError:
+                _crypto_errors.inc(1, ("tcp",))
                 self.delete_handler(self.fileno)
                 return
             while 1:
@@ -72,7 +87,8 @@ class tcp_tunnel(tcp_handler.tcp_handler):
         self.remove_evt_write(self.fileno)
 
     def tcp_delete(self):
-        self.dispatcher.tell_tunnel_close()
+        # 必须在关闭套接字之前通知,否则新建立的隧道可能复用同一个文件描述符
+        self.__tell_creator("tunnel_close")
         self.unregister(self.fileno)
         self.close()
         logging.print_general("disconnect", self.__server_address)
@@ -105,8 +121,8 @@ class tcp_tunnel(tcp_handler.tcp_handler):
 
         logging.print_general("connected", self.__server_address)
 
-        # 发送还没有连接的时候堆积的数据包
-        return
+        # 由隧道管理发送还没有连接的时候堆积的数据包
+        self.__tell_creator("tunnel_ok")
 
     def send_msg_to_tunnel(self, session_id, action, message):
         sent_pkt = self.__encrypt.build_packet(session_id, action, message)
@@ -128,13 +144,31 @@ class udp_tunnel(udp_handler.udp_handler):
 
     __server_address = None
     __redundancy = None
-
-    def init_func(self, creator, crypto, crypto_configs, redundancy=False, conn_timeout=720, is_ipv6=False):
+    __creator = -1
+    __fec = None
+
+    __is_ipv6 = False
+    __prober = None
+    # 探测到的数据包大小,None表示使用默认的分块方式
+    __pkt_size = None
+
+    def init_func(self, creator, crypto, crypto_configs, redundancy=False, conn_timeout=720, is_ipv6=False,
+                  fec_k=0, pmtu_probe=False):
+        """
+        :param fec_k: 前向纠错每组的数据包个数,0表示不开启
+        :param pmtu_probe: 是否探测路径MTU
+        """
         if is_ipv6:
             fa = socket.AF_INET6
         else:
             fa = socket.AF_INET
         self.__redundancy = redundancy
+        self.__creator = creator
+        self.__is_ipv6 = is_ipv6
+
+        if pmtu_probe: self.__prober = pmtu.prober(is_ipv6=is_ipv6)
+
+        if fec_k > 0: self.__fec = fec.session(k=fec_k)
 
         s = socket.socket(fa, socket.SOCK_DGRAM)
 
@@ -151,32 +185,115 @@ class udp_tunnel(udp_handler.udp_handler):
 
         return self.fileno
 
-    def create_tunnel(self, server_address):
-        server_ip = self.dispatcher.get_server_ip(server_address[0])
+    def create_tunnel(self, server_address, server_ip):
+        self.__server_address = server_address
         try:
             self.connect((server_ip, server_address[1]))
-        except socket.gaierror:
-            logging.print_general("not_found_host", server_address)
+        except OSError:
+            logging.print_general("udp_error", server_address)
             return False
 
-        self.__server_address = server_address
         logging.print_general("udp_open", server_address)
 
-        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
         self.__update_time = time.time()
         self.register(self.fileno)
         self.add_evt_read(self.fileno)
+        # UDP没有握手,套接字建立之后就可以发送
+        self.__tell_creator("tunnel_ok")
+        self.__probe()
+        self.set_timeout(self.fileno, self.__next_timeout())
 
         return True
 
+    def __tell_creator(self, cmd):
+        if self.handler_exists(self.__creator): self.ctl_handler(self.fileno, self.__creator, cmd)
+
     def udp_readable(self, message, address):
+        if self.__fec and fec.is_fec_frame(message):
+            try:
+                packets = self.__fec.decode(message)
+            except fec.FecErr:
+                return
+            for packet in packets: self.__handle_packet(packet)
+            if self.__fec.need_flush(): self.__fec_flush()
+            return
+
+        self.__handle_packet(message)
+
+    def __handle_packet(self, message):
         result = self.__decrypt.parse(message)
         if not result: return
 
         session_id, action, byte_data = result
+        if action == proto_utils.ACT_PMTU:
+            self.__handle_pmtu(byte_data)
+            return
         self.dispatcher.handle_msg_from_tunnel(session_id, action, byte_data)
         self.__update_time = time.time()
 
+    def __next_timeout(self):
+        # 探测期间需要及时结束探测
+        if self.__prober and self.__prober.is_probing: return min(self.__LOOP_TIMEOUT, 2)
+
+        return self.__LOOP_TIMEOUT
+
+    def __probe(self):
+        """同时发送一组设置了DF标志的探测包,探测包直接发送,不经过发送队列与前向纠错"""
+        if not self.__prober or not self.__prober.need_probe(): return
+
+        probe_id, sizes = self.__prober.begin()
+        if not pmtu.set_df(self.socket, True, is_ipv6=self.__is_ipv6): return
+
+        session_id = self.dispatcher.session_id
+        for size in sizes:
+            padding = self.__encrypt.max_payload_size(size) - pmtu.HEADER_SIZE
+            message = pmtu.build_msg(pmtu.TYPE_PROBE, probe_id, size, padding=padding)
+            pkts = self.__encrypt.build_packets(session_id, proto_utils.ACT_PMTU, message, pkt_size=size)
+            self.__encrypt.reset()
+            try:
+                self.socket.send(pkts[0])
+            except OSError:
+                # 超过本机网卡MTU或者发送缓冲区已满
+                continue
+        ''''''
+
+        pmtu.set_df(self.socket, False, is_ipv6=self.__is_ipv6)
+
+    def __handle_pmtu(self, message):
+        if not self.__prober: return
+        try:
+            msg_type, probe_id, size = pmtu.parse_msg(message)
+        except pmtu.PmtuErr:
+            return
+        if msg_type == pmtu.TYPE_ACK: self.__prober.ack(probe_id, size)
+
+    def __finish_probe(self):
+        size = self.__prober.finish()
+        # 没有收到任何确认时保持原来的大小
+        if not size: return
+
+        # 前向纠错帧在隧道数据包外面,需要减去它的开销
+        if self.__fec: size -= fec.HEADER_SIZE + 2
+        if size == self.__pkt_size: return
+
+        self.__pkt_size = size
+        logging.print_general("pmtu:%s" % size, self.__server_address)
+        self.send_msg_to_tunnel(self.dispatcher.session_id, proto_utils.ACT_PMTU,
+                                pmtu.build_msg(pmtu.TYPE_SET, 0, size))
+        self.dispatcher.tell_tunnel_mtu(self.__encrypt.max_payload_size(size))
+
+    def __fec_flush(self):
+        frames = self.__fec.flush()
+        if not frames: return
+        for frame in frames: self.send(frame)
+        self.add_evt_write(self.fileno)
+
+    def task_loop(self):
+        if self.__fec.pending() and not self.__fec.need_flush(): return
+
+        self.del_loop_task(self.fileno)
+        self.__fec_flush()
+
     def udp_writable(self):
         self.remove_evt_write(self.fileno)
 
@@ -190,21 +307,33 @@ class udp_tunnel(udp_handler.udp_handler):
             logging.print_general("udp_timeout", self.__server_address)
             self.delete_handler(self.fileno)
             return
-        self.set_timeout(self.fileno, self.__LOOP_TIMEOUT)
+        if self.__fec: self.__fec_flush()
+        if self.__prober:
+            self.__finish_probe()
+            self.__probe()
+        self.set_timeout(self.fileno, self.__next_timeout())
 
     def udp_delete(self):
         self.unregister(self.fileno)
-        self.dispatcher.tell_tunnel_close()
+        self.__tell_creator("tunnel_close")
         self.close()
         logging.print_general("udp_close", self.__server_address)
 
     def send_msg_to_tunnel(self, session_id, action, message):
         ippkts = self.__encrypt.build_packets(
-            session_id, action, message, redundancy=self.__redundancy
+            session_id, action, message, redundancy=self.__redundancy, pkt_size=self.__pkt_size
         )
         self.__encrypt.reset()
 
-        for ippkt in ippkts: self.send(ippkt)
+        for ippkt in ippkts:
+            if not self.__fec:
+                self.send(ippkt)
+                continue
+            for frame in self.__fec.encode(ippkt): self.send(frame)
+        ''''''
+
+        # 没有填满的组在事件循环中到达FLUSH_TIMEOUT之后发送校检包
+        if self.__fec and self.__fec.pending(): self.add_to_loop_task(self.fileno)
 
         self.add_evt_write(self.fileno)
         self.__update_time = time.time()
@@ -2,8 +2,14 @@
 import pywind.evtframework.handlers.udp_handler as udp_handler
 import pywind.evtframework.handlers.tcp_handler as tcp_handler
 import socket, time
+from collections import OrderedDict
 import freenet.lib.base_proto.utils as proto_utils
 import freenet.lib.logging as logging
+import freenet.lib.metrics as metrics
+import freenet.lib.fec as fec
+import freenet.lib.pmtu as pmtu
+
+_crypto_errors = metrics.new_counter("crypto_errors_total", "packets failed in decrypting or checking", ("tunnel",))
 
 
 class tcp_tunnel(tcp_handler.tcp_handler):
@@ -93,6 +99,7 @@ class _tcp_tunnel_handler(tcp_handler.tcp_handler):
             try:
                 self.__decrypt.parse()
             except proto_utils.ProtoError:
+                _crypto_errors.inc(1, ("tcp",))
                 self.delete_handler(self.fileno)
                 return
             while 1:
@@ -124,7 +131,7 @@ class _tcp_tunnel_handler(tcp_handler.tcp_handler):
 
     def tcp_delete(self):
         if self.__session_id:
-            self.dispatcher.tell_del_all_app_proxy(self.__session_id)
+            self.dispatcher.tell_tunnel_close(self.fileno, self.__session_id)
 
         self.unregister(self.fileno)
         self.close()
@@ -139,6 +146,19 @@ class _tcp_tunnel_handler(tcp_handler.tcp_handler):
 
 
 class udp_tunnel(udp_handler.udp_handler):
+    # 前向纠错会话的最大个数与空闲超时
+    __FEC_MAX_SESSIONS = 4096
+    __FEC_IDLE_TIMEOUT = 300
+
+    # 会话ID -> [fec.session,最后收到数据的时间,客户端地址]
+    __fec_sessions = None
+    # 客户端地址 -> 会话ID,只有解密成功之后才加入
+    __fec_addrs = None
+    # 有没有填满的组的会话ID,在事件循环中到达FLUSH_TIMEOUT之后发送校检包
+    __fec_waits = None
+    # 会话ID -> 协商的数据包大小,客户端地址改变之后继续使用,个数限制与前向纠错会话相同
+    __pkt_sizes = None
+
     def init_func(self, creator, address, crypto, crypto_configs, is_ipv6=False):
         if is_ipv6:
             fa = socket.AF_INET6
@@ -159,15 +179,113 @@ class udp_tunnel(udp_handler.udp_handler):
         self.__encrypt.config(crypto_configs)
         self.__decrypt.config(crypto_configs)
 
+        self.__fec_sessions = OrderedDict()
+        self.__fec_addrs = OrderedDict()
+        self.__fec_waits = set()
+        self.__pkt_sizes = OrderedDict()
+        # 定时清理空闲的前向纠错会话
+        self.set_timeout(self.fileno, 1)
+
         return self.fileno
 
+    def __bind_fec_session(self, session_id, address, k):
+        """解密成功之后建立或者刷新前向纠错会话,组大小与客户端相同,没有通过验证的帧不会淘汰已有的会话"""
+        now = time.time()
+
+        if session_id in self.__fec_sessions:
+            entry = self.__fec_sessions[session_id]
+            entry[1] = now
+            entry[2] = address
+            self.__fec_sessions.move_to_end(session_id)
+        else:
+            if len(self.__fec_sessions) >= self.__FEC_MAX_SESSIONS: self.__fec_sessions.popitem(last=False)
+            entry = [fec.session(k=k), now, address]
+            self.__fec_sessions[session_id] = entry
+
+        if self.__fec_addrs.get(address, None) != session_id:
+            self.__fec_addrs[address] = session_id
+            if len(self.__fec_addrs) > self.__FEC_MAX_SESSIONS: self.__fec_addrs.popitem(last=False)
+
+        return entry
+
+    def __get_fec_session(self, message, address):
+        """获取地址对应的前向纠错会话,未知的地址先解密帧中的数据包,成功之后才建立会话
+        :return: None表示没有通过验证
+        """
+        session_id = self.__fec_addrs.get(address, None)
+        if session_id is not None and session_id in self.__fec_sessions: return self.__fec_sessions[session_id]
+
+        _, _, k, _, _ = fec.parse_header(message)
+        packet = fec.data_packet(message)
+        # 校检帧不能单独验证
+        if packet is None: return None
+
+        result = self.__decrypt.parse(packet)
+        if not result: return None
+
+        return self.__bind_fec_session(result[0], address, k)
+
     def udp_readable(self, message, address):
+        if not fec.is_fec_frame(message):
+            self.__handle_packet(message, address)
+            return
+
+        try:
+            entry = self.__get_fec_session(message, address)
+            if not entry: return
+            session = entry[0]
+            packets = session.decode(message)
+        except fec.FecErr:
+            return
+
+        for packet in packets:
+            session_id = self.__handle_packet(packet, address)
+            # 只有解密成功的数据包才刷新会话
+            if session_id is not None: self.__bind_fec_session(session_id, address, session.encoder.k)
+        ''''''
+        if session.need_flush(): self.__fec_flush(session, entry[2])
+
+    def __handle_packet(self, message, address):
+        """
+        :return: 解密成功时返回会话ID,否则返回None
+        """
         result = self.__decrypt.parse(message)
-        if not result: return
+        if not result: return None
 
         session_id, action, byte_data = result
+        if action == proto_utils.ACT_PMTU:
+            self.__handle_pmtu(session_id, address, byte_data)
+            return session_id
         self.dispatcher.handle_msg_from_tunnel(self.fileno, session_id, address, action, byte_data)
 
+        return session_id
+
+    def __handle_pmtu(self, session_id, address, message):
+        """确认客户端的探测包,记录客户端协商的数据包大小"""
+        try:
+            msg_type, probe_id, size = pmtu.parse_msg(message)
+        except pmtu.PmtuErr:
+            return
+
+        if msg_type == pmtu.TYPE_PROBE:
+            ack = pmtu.build_msg(pmtu.TYPE_ACK, probe_id, size)
+            ippkts = self.__encrypt.build_packets(session_id, proto_utils.ACT_PMTU, ack)
+            self.__encrypt.reset()
+            for ippkt in ippkts: self.sendto(ippkt, address)
+            self.add_evt_write(self.fileno)
+            return
+
+        if msg_type != pmtu.TYPE_SET or not pmtu.is_valid_size(size): return
+        if session_id not in self.__pkt_sizes and len(self.__pkt_sizes) >= self.__FEC_MAX_SESSIONS:
+            self.__pkt_sizes.popitem(last=False)
+        self.__pkt_sizes[session_id] = size
+
+    def __fec_flush(self, session, address):
+        frames = session.flush()
+        if not frames: return
+        for frame in frames: self.sendto(frame, address)
+        self.add_evt_write(self.fileno)
+
     def udp_writable(self):
         self.remove_evt_write(self.fileno)
 
@@ -175,16 +293,54 @@ class udp_tunnel(udp_handler.udp_handler):
         self.delete_handler(self.fileno)
 
     def udp_timeout(self):
-        pass
+        now = time.time()
+        dels = []
+
+        for session_id, (session, update_time, address) in self.__fec_sessions.items():
+            if now - update_time > self.__FEC_IDLE_TIMEOUT:
+                dels.append(session_id)
+                continue
+            self.__fec_flush(session, address)
+        ''''''
+
+        for session_id in dels: del self.__fec_sessions[session_id]
+        self.set_timeout(self.fileno, 1)
+
+    def task_loop(self):
+        for session_id in list(self.__fec_waits):
+            entry = self.__fec_sessions.get(session_id, None)
+            if entry and entry[0].pending() and not entry[0].need_flush(): continue
+
+            self.__fec_waits.discard(session_id)
+            if entry: self.__fec_flush(entry[0], entry[2])
+        ''''''
+        if not self.__fec_waits: self.del_loop_task(self.fileno)
 
     def udp_delete(self):
         self.unregister(self.fileno)
         self.close()
 
     def send_msg(self, session_id, address, action, message):
-        ippkts = self.__encrypt.build_packets(session_id, action, message)
+        pkt_size = self.__pkt_sizes.get(session_id, None)
+        ippkts = self.__encrypt.build_packets(session_id, action, message, pkt_size=pkt_size)
         self.__encrypt.reset()
 
-        for ippkt in ippkts: self.sendto(ippkt, address)
+        entry = self.__fec_sessions.get(session_id, None)
+        if not entry:
+            for ippkt in ippkts: self.sendto(ippkt, address)
+            self.add_evt_write(self.fileno)
+            return
+
+        # 发送使用会话当前的地址,地址改变之后前向纠错的状态不受影响
+        entry[2] = address
+        session = entry[0]
+        for ippkt in ippkts:
+            for frame in session.encode(ippkt): self.sendto(frame, address)
+        ''''''
+
+        # 请求与应答的最后几个数据包不等到下一个数据包或者定时器才发送校检包
+        if session.pending():
+            self.__fec_waits.add(session_id)
+            self.add_to_loop_task(self.fileno)
 
         self.add_evt_write(self.fileno)
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""用户流量统计,速率限制与每月流量配额
+每个数据包只需要几次整数运算:累加计数,令牌桶扣除令牌,比较配额
+计数在事件循环中定时写入文件,每一行为一个用户在一个月的累计流量,每个用户每个月只有一行,
+写入时先写临时文件再替换原来的文件,重启之后读取当月的记录恢复流量,因此配额不会因为重启而清零
+"""
+
+import os, time, json
+import freenet.lib.metrics as metrics
+
+_dropped = metrics.new_counter("access_dropped_packets_total", "packets dropped by access limits", ("reason",))
+
+
+class token_bucket(object):
+    __slots__ = ("rate", "burst", "tokens", "update_time",)
+
+    def __init__(self, rate, burst=0):
+        """
+        :param rate: 每秒允许的字节数
+        :param burst: 令牌桶容量,0表示一秒的流量
+        """
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.update_time = time.monotonic()
+
+    def consume(self, n):
+        """扣除n个令牌,令牌不够时返回False"""
+        now = time.monotonic()
+        tokens = self.tokens + (now - self.update_time) * self.rate
+        if tokens > self.burst: tokens = self.burst
+        self.update_time = now
+
+        if tokens < n:
+            self.tokens = tokens
+            return False
+
+        self.tokens = tokens - n
+        return True
+
+
+class account(object):
+    __slots__ = (
+        "username", "month_recv", "month_sent", "recv_packets", "sent_packets", "quota",
+        "recv_bucket", "send_bucket", "dirty",
+    )
+
+    def __init__(self, username, rate_limit=0, burst=0, monthly_quota=0):
+        """
+        :param username:
+        :param rate_limit: 每个方向每秒允许的字节数,0表示不限制
+        :param burst: 令牌桶容量
+        :param monthly_quota: 每月两个方向合计的流量,0表示不限制
+        """
+        self.username = username
+        # 当月接收与发送的字节数
+        self.month_recv = 0
+        self.month_sent = 0
+        self.recv_packets = 0
+        self.sent_packets = 0
+        self.quota = monthly_quota
+
+        if rate_limit > 0:
+            self.recv_bucket = token_bucket(rate_limit, burst)
+            self.send_bucket = token_bucket(rate_limit, burst)
+        else:
+            self.recv_bucket = None
+            self.send_bucket = None
+
+        # 是否有还没有写入文件的流量
+        self.dirty = False
+
+
+class accounting(object):
+    # session_id -> account
+    __accounts = None
+    # 文件中的全部记录 (month,username) -> (recv,sent)
+    __records = None
+    # 是否有还没有写入文件的记录
+    __changed = False
+
+    __path = None
+    __flush_interval = None
+    __flush_time = 0
+    __month = None
+
+    def __init__(self, path, flush_interval=60):
+        """
+        :param path: 流量记录文件,每行一个JSON对象
+        :param flush_interval: 写入文件的时间间隔
+        """
+        self.__accounts = {}
+        self.__records = {}
+        self.__path = path
+        self.__flush_interval = flush_interval
+        self.__flush_time = time.time()
+        self.__month = time.strftime("%Y-%m")
+
+        self.__load()
+
+    def __load(self):
+        if not os.path.isfile(self.__path): return
+
+        try:
+            f = open(self.__path, "r")
+        except OSError as e:
+            print("cannot read accounting file %s: %s" % (self.__path, e,))
+            return
+
+        with f:
+            for line in f:
+                try:
+                    rs = json.loads(line)
+                except ValueError:
+                    continue
+                if not isinstance(rs, dict): continue
+
+                month = rs.get("month", None)
+                username = rs.get("username", None)
+                if not isinstance(month, str) or not isinstance(username, str): continue
+
+                try:
+                    recv, sent = int(rs.get("recv", 0)), int(rs.get("sent", 0))
+                except (TypeError, ValueError):
+                    continue
+
+                # 旧版本的文件每个用户有多行,保留最后一行
+                self.__records[(month, username,)] = (recv, sent,)
+            ''''''
+        return
+
+    def add_user(self, session_id, username, rate_limit=0, burst=0, monthly_quota=0):
+        """加入用户,用户已经存在时更新选项并且保留流量"""
+        a = account(username, rate_limit=rate_limit, burst=burst, monthly_quota=monthly_quota)
+        old = self.__accounts.get(session_id, None)
+
+        if old:
+            a.month_recv, a.month_sent = old.month_recv, old.month_sent
+            a.recv_packets, a.sent_packets = old.recv_packets, old.sent_packets
+            a.dirty = old.dirty
+        else:
+            a.month_recv, a.month_sent = self.__records.get((self.__month, username,), (0, 0,))
+
+        self.__accounts[session_id] = a
+
+    def remove_user(self, session_id):
+        a = self.__accounts.get(session_id, None)
+        if not a: return
+
+        # 同一个用户再次加入时继续使用当月的流量,文件在下一次定时写入时更新
+        if a.dirty:
+            self.__records[(self.__month, a.username,)] = (a.month_recv, a.month_sent,)
+            self.__changed = True
+        del self.__accounts[session_id]
+
+    def get(self, session_id):
+        return self.__accounts.get(session_id, None)
+
+    def recv(self, session_id, size):
+        """统计从客户端接收的数据
+        :return: False表示超过速率或者配额,需要丢弃数据
+        """
+        a = self.__accounts.get(session_id, None)
+        if not a: return True
+
+        if a.quota and a.month_recv + a.month_sent >= a.quota:
+            _dropped.inc(labels=("quota",))
+            return False
+
+        if a.recv_bucket and not a.recv_bucket.consume(size):
+            _dropped.inc(labels=("rate",))
+            return False
+
+        a.month_recv += size
+        a.recv_packets += 1
+        a.dirty = True
+
+        return True
+
+    def send(self, session_id, size):
+        """统计发送到客户端的数据
+        :return: False表示超过速率或者配额,需要丢弃数据
+        """
+        a = self.__accounts.get(session_id, None)
+        if not a: return True
+
+        if a.quota and a.month_recv + a.month_sent >= a.quota:
+            _dropped.inc(labels=("quota",))
+            return False
+
+        if a.send_bucket and not a.send_bucket.consume(size):
+            _dropped.inc(labels=("rate",))
+            return False
+
+        a.month_sent += size
+        a.sent_packets += 1
+        a.dirty = True
+
+        return True
+
+    def loop(self):
+        """由事件循环调用,到达时间间隔时写入文件,月份改变时清零当月流量"""
+        now = time.time()
+        if now - self.__flush_time < self.__flush_interval: return
+        self.__flush_time = now
+
+        self.flush()
+
+        month = time.strftime("%Y-%m")
+        if month == self.__month: return
+
+        self.__month = month
+        for a in self.__accounts.values():
+            a.month_recv = 0
+            a.month_sent = 0
+        ''''''
+
+    def flush(self):
+        """把有变化的用户流量写入文件,每个用户每个月一行"""
+        for a in self.__accounts.values():
+            if not a.dirty: continue
+            a.dirty = False
+            self.__records[(self.__month, a.username,)] = (a.month_recv, a.month_sent,)
+            self.__changed = True
+        ''''''
+        if not self.__changed: return
+
+        lines = []
+        for (month, username,), (recv, sent,) in sorted(self.__records.items()):
+            lines.append(json.dumps({"month": month, "username": username, "recv": recv, "sent": sent, }))
+        ''''''
+
+        tmp_path = "%s.tmp" % self.__path
+        try:
+            with open(tmp_path, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            os.replace(tmp_path, self.__path)
+        except OSError as e:
+            print("cannot write accounting file %s: %s" % (self.__path, e,))
+            return
+
+        self.__changed = False
+
+
+"""
+import tempfile
+
+acc = accounting(tempfile.mktemp())
+for i in range(1000): acc.add_user(i, "user%d" % i, rate_limit=1024 * 1024, monthly_quota=1024 ** 3)
+
+begin = time.time()
+for i in range(1000000): acc.recv(i % 1000, 1400)
+print("%.3f us" % (time.time() - begin))
+"""
@@ -0,0 +1,389 @@
+#!/usr/bin/env python3
+"""用户认证后端
+json与sqlite后端一次读取全部用户,会话ID在内存中查找,文件改变或者收到信号时重新加载
+service后端按照会话ID向本地的用户服务查询,查询结果缓存在内存中,不存在的会话ID也会缓存一段时间,
+防止大量未知的会话ID导致频繁查询
+查询与重新加载都在工作线程中执行,不会阻塞事件循环,结果由事件循环调用authenticator.poll取出
+
+用户为dict对象,必须有username,json与sqlite后端还必须有password,其他的键为用户选项,例如rate_limit
+"""
+
+import os, time, json, socket, sqlite3, threading, queue
+import http.client, urllib.parse
+from collections import OrderedDict, deque
+
+
+class AuthErr(Exception): pass
+
+
+class backend(object):
+    # 是否支持按照会话ID查询
+    can_lookup = False
+
+    def users(self):
+        """读取全部用户
+        :return: [user,...]
+        """
+        return []
+
+    def lookup(self, session_id):
+        """按照会话ID查询用户
+        :return: user,用户不存在返回None
+        """
+        return None
+
+    def changed(self):
+        """用户数据是否在上次读取之后改变"""
+        return False
+
+
+class _file_backend(backend):
+    __paths = None
+    __mtimes = None
+
+    def __init__(self, *paths):
+        self.__paths = paths
+        self.__mtimes = self.__get_mtimes()
+
+    def __get_mtimes(self):
+        results = []
+        for path in self.__paths:
+            try:
+                results.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                results.append(0)
+            ''''''
+        return results
+
+    def changed(self):
+        mtimes = self.__get_mtimes()
+        if mtimes == self.__mtimes: return False
+
+        self.__mtimes = mtimes
+        return True
+
+
+class json_backend(_file_backend):
+    """与access.json相同格式的文件"""
+    __path = None
+
+    def __init__(self, path):
+        self.__path = path
+        super(json_backend, self).__init__(path)
+
+    def users(self):
+        try:
+            with open(self.__path, "r") as f:
+                users = json.loads(f.read())
+        except (OSError, ValueError) as e:
+            raise AuthErr("cannot load %s: %s" % (self.__path, e,))
+
+        if not isinstance(users, list): raise AuthErr("wrong user file %s" % self.__path)
+
+        return users
+
+
+class sqlite_backend(_file_backend):
+    """表users至少需要username与password两列,其他的列为用户选项"""
+    __path = None
+
+    def __init__(self, path):
+        self.__path = path
+        # WAL模式下写入的数据在提交之后才合并到数据库文件
+        super(sqlite_backend, self).__init__(path, "%s-wal" % path)
+
+    def users(self):
+        try:
+            conn = sqlite3.connect(self.__path)
+        except sqlite3.Error as e:
+            raise AuthErr("cannot open %s: %s" % (self.__path, e,))
+
+        conn.row_factory = sqlite3.Row
+        try:
+            rows = conn.execute("SELECT * FROM users").fetchall()
+        except sqlite3.Error as e:
+            raise AuthErr("cannot read users from %s: %s" % (self.__path, e,))
+        finally:
+            conn.close()
+
+        return [dict(row) for row in rows]
+
+
+class _unix_http_connection(http.client.HTTPConnection):
+    __path = None
+
+    def __init__(self, path, timeout):
+        super(_unix_http_connection, self).__init__("localhost", timeout=timeout)
+        self.__path = path
+
+    def connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        s.connect(self.__path)
+        self.sock = s
+
+
+class service_backend(backend):
+    """本地用户服务,GET <url>?session_id=<十六进制会话ID>,用户存在时返回200与JSON格式的用户,否则返回404
+    url为http://host:port/path或者unix:///socket_path:/path
+    查询在authenticator的工作线程中执行
+    """
+    can_lookup = True
+
+    __url = None
+    __timeout = None
+
+    def __init__(self, url, timeout=1):
+        self.__url = urllib.parse.urlparse(url)
+        self.__timeout = timeout
+
+        if self.__url.scheme not in ("http", "unix",): raise AuthErr("unsupported user service %s" % url)
+
+    def __connect(self):
+        if self.__url.scheme == "http":
+            conn = http.client.HTTPConnection(self.__url.hostname, self.__url.port or 80, timeout=self.__timeout)
+            return conn, self.__url.path or "/"
+
+        # unix:///run/users.sock:/users
+        sock_path, _, path = self.__url.path.partition(":")
+        return _unix_http_connection(sock_path, self.__timeout), path or "/"
+
+    def lookup(self, session_id):
+        conn, path = self.__connect()
+        query = urllib.parse.urlencode({"session_id": session_id.hex()})
+
+        try:
+            conn.request("GET", "%s?%s" % (path, query,))
+            resp = conn.getresponse()
+            body = resp.read()
+        except (OSError, http.client.HTTPException) as e:
+            raise AuthErr("user service error: %s" % e)
+        finally:
+            conn.close()
+
+        if resp.status == 404: return None
+        if resp.status != 200: raise AuthErr("user service response status %s" % resp.status)
+
+        try:
+            user = json.loads(body.decode("utf-8"))
+        except (UnicodeDecodeError, ValueError):
+            raise AuthErr("wrong user service response")
+
+        if not isinstance(user, dict) or "username" not in user: raise AuthErr("wrong user service response")
+
+        return user
+
+
+def create_backend(name, source):
+    """
+    :param name: json | sqlite | service
+    :param source: 文件路径或者用户服务的url
+    :return:
+    """
+    if name == "json": return json_backend(source)
+    if name == "sqlite": return sqlite_backend(source)
+    if name == "service": return service_backend(source)
+
+    raise AuthErr("unsupported auth backend %s" % name)
+
+
+class authenticator(object):
+    """会话ID到用户的缓存
+    缓存中没有的会话ID由工作线程向用户服务查询,查询期间get返回None,数据包被丢弃,客户端重传时使用查询结果
+    """
+    __backend = None
+    __gen_session_id = None
+
+    # session_id -> user
+    __users = None
+    # 不存在的会话ID session_id -> 过期时间
+    __negatives = None
+    __neg_ttl = None
+    __neg_size = None
+
+    # 每秒最多发起的查询次数,超过时直接认为会话不存在并且不缓存
+    __max_lookups = None
+    __lookup_count = 0
+    __lookup_time = 0
+
+    # 正在查询的会话ID
+    __lookups = None
+    __reloading = False
+    # 重新加载期间又收到了重新加载的请求
+    __reload_again = False
+    __requests = None
+    # deque的append与popleft是线程安全的
+    __results = None
+    __threads = None
+
+    def __init__(self, backend, gen_session_id, neg_ttl=60, neg_size=65536, max_lookups=100, workers=2):
+        """
+        :param backend:
+        :param gen_session_id: 根据用户名和密码生成会话ID的函数
+        :param neg_ttl: 不存在的会话ID的缓存时间
+        :param neg_size: 不存在的会话ID的最大缓存个数
+        :param max_lookups:
+        :param workers: 工作线程数
+        """
+        self.__backend = backend
+        self.__gen_session_id = gen_session_id
+        self.__users = {}
+        self.__negatives = OrderedDict()
+        self.__neg_ttl = neg_ttl
+        self.__neg_size = neg_size
+        self.__max_lookups = max_lookups
+
+        self.__lookups = set()
+        self.__requests = queue.Queue()
+        self.__results = deque()
+        self.__threads = []
+
+        for i in range(workers):
+            t = threading.Thread(target=self.__worker, daemon=True)
+            t.start()
+            self.__threads.append(t)
+
+    def __load_users(self):
+        results = {}
+        for user in self.__backend.users():
+            if not isinstance(user, dict) or "username" not in user or "password" not in user:
+                raise AuthErr("wrong user %s" % user)
+            results[self.__gen_session_id(user["username"], user["password"])] = user
+        ''''''
+        return results
+
+    def __worker(self):
+        while 1:
+            req = self.__requests.get()
+            if req is None: break
+
+            cmd, arg = req
+            try:
+                if cmd == "lookup":
+                    rs = self.__backend.lookup(arg)
+                elif arg is None:
+                    rs = self.__load_users()
+                else:
+                    # 用户服务不能列出全部用户,只重新查询已经缓存的会话
+                    rs = {}
+                    for session_id in arg:
+                        user = self.__backend.lookup(session_id)
+                        if user is not None: rs[session_id] = user
+                    ''''''
+                ok = True
+            except AuthErr as e:
+                print(e)
+                rs = None
+                ok = False
+            self.__results.append((cmd, arg, ok, rs,))
+        ''''''
+        return
+
+    def get(self, session_id):
+        """
+        :return: user,用户不存在或者正在查询时返回None
+        """
+        user = self.__users.get(session_id, None)
+        if user is not None: return user
+        if not self.__backend.can_lookup: return None
+        if session_id in self.__lookups: return None
+
+        now = time.time()
+        t = self.__negatives.get(session_id, None)
+        if t is not None:
+            if t > now: return None
+            del self.__negatives[session_id]
+
+        if int(now) != self.__lookup_time:
+            self.__lookup_time = int(now)
+            self.__lookup_count = 0
+        if self.__lookup_count >= self.__max_lookups: return None
+        self.__lookup_count += 1
+
+        self.__lookups.add(session_id)
+        self.__requests.put(("lookup", session_id,))
+
+        return None
+
+    def users(self):
+        return self.__users
+
+    def load(self):
+        """第一次加载用户,在启动时同步执行,失败时抛出AuthErr"""
+        if not self.__backend.can_lookup: self.__users = self.__load_users()
+
+    def reload(self):
+        """请求重新加载用户,结果由poll返回"""
+        if self.__reloading:
+            self.__reload_again = True
+            return
+        self.__reloading = True
+
+        if self.__backend.can_lookup:
+            self.__requests.put(("reload", list(self.__users),))
+        else:
+            self.__requests.put(("reload", None,))
+
+    def poll(self):
+        """处理工作线程的结果,由事件循环调用
+        :return: 重新加载完成时返回(added,removed,changed),每一个都是 {session_id:user,...},否则返回None
+        """
+        result = None
+
+        while self.__results:
+            cmd, arg, ok, rs = self.__results.popleft()
+
+            if cmd == "lookup":
+                self.__lookups.discard(arg)
+                if not ok: continue
+                if rs is not None:
+                    self.__users[arg] = rs
+                    continue
+                self.__negatives[arg] = time.time() + self.__neg_ttl
+                if len(self.__negatives) > self.__neg_size: self.__negatives.popitem(last=False)
+                continue
+
+            self.__reloading = False
+            # 加载失败时保留原来的用户
+            if ok: result = self.__apply_reload(arg, rs)
+        ''''''
+        if self.__reload_again and not self.__reloading:
+            self.__reload_again = False
+            self.reload()
+
+        return result
+
+    def __apply_reload(self, session_ids, new_users):
+        """
+        :param session_ids: 重新查询的会话ID,None表示new_users为全部用户
+        :param new_users:
+        :return:
+        """
+        self.__negatives.clear()
+        old_users = self.__users
+
+        if session_ids is None:
+            checked = old_users
+        else:
+            # 重新加载期间新查询到的会话不受影响
+            checked = {session_id: old_users[session_id] for session_id in session_ids if session_id in old_users}
+            merged = {session_id: user for session_id, user in old_users.items() if session_id not in checked}
+            merged.update(new_users)
+            new_users = merged
+
+        added = {}
+        changed = {}
+        for session_id, user in new_users.items():
+            if session_id not in old_users:
+                added[session_id] = user
+            elif old_users[session_id] != user:
+                changed[session_id] = user
+            ''''''
+        removed = {session_id: user for session_id, user in checked.items() if session_id not in new_users}
+
+        self.__users = new_users
+
+        return (added, removed, changed,)
+
+    def changed(self):
+        return self.__backend.changed()
@@ -10,12 +10,16 @@ reverse:4 bit 保留
 action:4bit 动作
 """
 import freenet.lib.base_proto.utils as proto_utils
+import freenet.lib.metrics as metrics
+import freenet.lib.fec as fec
 import struct
 
 MIN_FIXED_HEADER_SIZE = 38
 
 _FMT = "!16s16sHHbb"
 
+_crypto_errors = metrics.new_counter("crypto_errors_total", "packets failed in decrypting or checking", ("tunnel",))
+
 
 class builder(object):
     __session_id = 0
@@ -41,31 +45,17 @@ class builder(object):
 
     def __gen_raib(self, block_a, block_b):
         """生成冗余数据块,类似于磁盘阵列的RAID5模式,较少丢包率
+        较短的数据块补0到相同长度,跨数据包的纠错参见freenet.lib.fec
         """
-        size_a = len(block_a)
-        size_b = len(block_b)
-
-        list_a = list(block_a)
-        list_b = list(block_b)
+        size = max(len(block_a), len(block_b))
+        block_a = block_a + bytes(size - len(block_a))
+        block_b = block_b + bytes(size - len(block_b))
 
-        L = None
-        if size_a > size_b:
-            L = list_b
-        else:
-            L = list_a
-        n = abs(size_a - size_b)
-        for i in range(n): L.append(0)
-        csum_list = []
-        cnt = 0
-        for n in list_a:
-            csum = n ^ list_b[cnt]
-            cnt += 1
-            csum_list.append(csum)
-
-        return (bytes(list_a), bytes(list_b), bytes(csum_list),)
+        return (block_a, block_b, fec.xor_bytes(block_a, block_b),)
 
     def __build_proto_header(self, session_id, pkt_md5, pkt_len, real_size, tot_seg, seq, action):
-        if action not in proto_utils.ACTS: raise ValueError("not support action type")
+        if action not in proto_utils.ACTS and action != proto_utils.ACT_PMTU: raise ValueError(
+            "not support action type")
         """
         L = [
             session_id, pkt_md5,
@@ -86,10 +76,18 @@ class builder(object):
             pkt_len, real_size, (tot_seg << 4) | seq, action
         )
 
-    def __get_sent_raw_data(self, data_len, byte_data, redundancy=False):
+    def __get_sent_raw_data(self, data_len, byte_data, redundancy=False, pkt_size=None):
         """获取要发送的原始数据"""
         if data_len == 0: return [b"", ]
 
+        # 已经探测到路径MTU,能够放入一个数据包时不分块,否则平均分成两块
+        if pkt_size:
+            if data_len <= self.max_payload_size(pkt_size): return [byte_data, ]
+            half = (data_len + 1) // 2
+            block_a, block_b = (byte_data[0:half], byte_data[half:],)
+            if redundancy: return self.__gen_raib(block_a, block_b)
+            return [block_a, block_b, ]
+
         # 不开启数据冗余那么直接返回
         if not redundancy: return [byte_data, ]
 
@@ -112,12 +110,13 @@ class builder(object):
             ret_v = tuple(tmplist)
         return ret_v
 
-    def build_packets(self, session_id, action, byte_data, redundancy=False):
+    def build_packets(self, session_id, action, byte_data, redundancy=False, pkt_size=None):
         """
         :param session_id: 
         :param action: 
         :param byte_data: 
         :param redundancy:是否开启UDP数据冗余
+        :param pkt_size:探测到的单个UDP数据包的最大大小,为None时使用默认的分块方式
         :return: 
         """
         if len(session_id) != 16: raise proto_utils.ProtoError("the size of session_id must be 16")
@@ -128,7 +127,7 @@ class builder(object):
             raise proto_utils.ProtoError("the size of byte data muse be less than %s" % self.__max_pkt_size + 1)
 
         data_seq = []
-        tmp_t = self.__get_sent_raw_data(data_len, byte_data, redundancy=redundancy)
+        tmp_t = self.__get_sent_raw_data(data_len, byte_data, redundancy=redundancy, pkt_size=pkt_size)
         tot_seq = len(tmp_t)
         md5_hash = proto_utils.calc_content_md5(byte_data)
         seq = 1
@@ -149,6 +148,10 @@ class builder(object):
         if size < min_size: raise proto_utils.ProtoError("the value of size must not be less than %s" % min_size)
         self.__block_size = size
 
+    def max_payload_size(self, pkt_size):
+        """UDP数据包大小不超过pkt_size时能够携带的最大数据长度,数据需要填充时重写这个方法"""
+        return pkt_size - self.__fixed_header_size
+
     def wrap_header(self, base_hdr):
         """重写这个方法"""
         return base_hdr
@@ -191,13 +194,7 @@ class parser(object):
 
     def __parse_raib(self, data_block, csum_block):
         """从数据块和校检块中获取另一数据块内容"""
-        cnt = 0
-        tmp_list = []
-        for n in data_block:
-            tmp_list.append(n ^ csum_block[cnt])
-            cnt += 1
-
-        return bytes(tmp_list)
+        return fec.xor_bytes(data_block, csum_block)
 
     def __parse_header(self, header):
         """
@@ -231,11 +228,16 @@ class parser(object):
 
     def __check_data_is_modify(self, md5, byte_data):
         n_md5 = proto_utils.calc_content_md5(byte_data)
-        return md5 == n_md5
+        if md5 != n_md5:
+            _crypto_errors.inc(1, ("udp",))
+            return False
+        return True
 
     def parse(self, packet):
         real_header = self.unwrap_header(packet[0:self.__fixed_header_size])
-        if not real_header: return
+        if not real_header:
+            _crypto_errors.inc(1, ("udp",))
+            return
 
         session_id, pkt_md5, pkt_len, payload_len, tot_seg, seq, action = self.__parse_header(real_header)
         real_body = self.unwrap_body(payload_len, packet[self.__fixed_header_size:])
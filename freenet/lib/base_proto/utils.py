@@ -13,10 +13,38 @@ ACTS = (
     ACT_IPDATA, ACT_DNS, ACT_SOCKS
 )
 
+# 表示隧道控制数据,只用于TCP隧道,不在ACTS中
+ACT_TUNNEL = 4
+
+# 一个会话最多同时使用的TCP连接数
+MAX_TUNNEL_CONNECTIONS = 16
+
+# 表示路径MTU探测数据,只用于UDP隧道,不在ACTS中,参见freenet.lib.pmtu
+ACT_PMTU = 5
+
 
 class ProtoError(Exception): pass
 
 
+def build_tunnel_join(index, count):
+    """构建多连接隧道的加入消息,客户端在每个连接建立之后首先发送
+    :param index: 连接序号
+    :param count: 连接总数
+    :return:
+    """
+    return bytes([index, count])
+
+
+def parse_tunnel_join(message):
+    """
+    :param message:
+    :return: (index,count)
+    """
+    if len(message) != 2: raise ProtoError("wrong tunnel join message")
+
+    return (message[0], message[1],)
+
+
 def gen_session_id(user_name, passwd):
     """生成会话ID"""
     sts = "%s%s" % (user_name, passwd)
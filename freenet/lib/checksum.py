@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""Internet校检和(RFC 1071)以及增量式校检和(RFC 1624)
+16位字的反码和与把整个缓冲区看作一个大端大整数之后对0xffff取模的结果相同(因为2^16 mod 0xffff为1),
+因此一次int.from_bytes就可以计算整个缓冲区,不需要逐个字循环
+编译了fn_utils时使用其中的C实现
+
+所有的校检和与字段都是按照网络字节序解释的整数,可以直接使用struct.pack("!H")写入
+"""
+
+try:
+    import freenet.lib.fn_utils as fn_utils
+
+    if not hasattr(fn_utils, "csum_partial"): fn_utils = None
+except ImportError:
+    fn_utils = None
+
+
+def _py_calc_sum(data, initial=0):
+    n = int.from_bytes(data, "big")
+    # 奇数长度在最后补0
+    if len(data) % 2: n <<= 8
+
+    return (n + initial) % 0xffff
+
+
+def _py_calc_csum_for_change(csum, old, new):
+    """RFC 1624公式3, HC' = ~(~HC + ~m + m'),~m的和等于-m的和"""
+    s = ((~csum & 0xffff) - int.from_bytes(old, "big") + int.from_bytes(new, "big")) % 0xffff
+    # 反码运算中非0数据的和不会为0
+    if s == 0: return 0
+
+    return ~s & 0xffff
+
+
+if fn_utils:
+    _calc_sum = fn_utils.csum_partial
+    _calc_csum_for_change = fn_utils.csum_replace
+else:
+    _calc_sum = _py_calc_sum
+    _calc_csum_for_change = _py_calc_csum_for_change
+
+
+def calc_sum(data, initial=0):
+    """计算反码和,没有取反,用于分段计算校检和,例如先计算伪首部
+    :param data: bytes,bytearray或者memoryview
+    :param initial: 之前计算的反码和
+    :return:
+    """
+    return _calc_sum(data, initial)
+
+
+def fold_csum(s):
+    """把反码和转换成校检和"""
+    return ~(s % 0xffff) & 0xffff
+
+
+def calc_csum(data):
+    """计算整个缓冲区的校检和
+    :param data:
+    :return:
+    """
+    n = _calc_sum(data)
+    # 反码运算中只有全0的数据和为0
+    if n == 0 and any(data): return 0
+
+    return ~n & 0xffff
+
+
+def calc_incre_csum(csum, old_field, new_field):
+    """16位字段改变之后的校检和
+    :param csum: 旧的校检和
+    :param old_field: 旧的16位字段
+    :param new_field: 新的16位字段
+    :return:
+    """
+    s = ((~csum & 0xffff) - old_field + new_field) % 0xffff
+    if s == 0: return 0
+
+    return ~s & 0xffff
+
+
+def calc_csum_for_change(csum, old, new):
+    """多个字节改变之后的校检和,一次计算整个IPv4或者IPv6地址
+    :param csum: 旧的校检和
+    :param old: 旧的字节,长度必须为偶数
+    :param new: 新的字节,长度与old相同
+    :return:
+    """
+    if len(old) != len(new) or len(old) % 2: raise ValueError("wrong field length")
+
+    return _calc_csum_for_change(csum, old, new)
+
+
+def calc_pseudo_sum(saddr, daddr, protocol, length):
+    """计算TCP,UDP与UDPLite伪首部的反码和
+    :param saddr: bytes类型的源地址
+    :param daddr: bytes类型的目的地址
+    :param protocol:
+    :param length: 传输层长度
+    :return:
+    """
+    s = _calc_sum(saddr)
+    s = _calc_sum(daddr, s)
+
+    return (s + protocol + (length >> 16) + (length & 0xffff)) % 0xffff
+
+
+"""
+import os, time
+
+for size in (64, 128, 256, 512, 1024, 1500,):
+    data = os.urandom(size)
+    for name, func in (("py", _py_calc_sum,), ("c", fn_utils.csum_partial if fn_utils else None,),):
+        if not func: continue
+        begin = time.time()
+        for i in range(100000): func(data, 0)
+        print(name, size, "%.3f us" % ((time.time() - begin) * 10))
+
+old = os.urandom(16)
+new = os.urandom(16)
+begin = time.time()
+for i in range(100000): calc_csum_for_change(0x1234, old, new)
+print("change ipv6 address %.3f us" % ((time.time() - begin) * 10))
+"""
@@ -46,6 +46,12 @@ class encrypt(tunnel.builder):
 
         return aes_cfb.encrypt(self.__key, self.__iv, body_data + filled)
 
+    def max_payload_size(self, pkt_size):
+        # 数据体需要填充到16字节的倍数
+        size = pkt_size - FIXED_HEADER_SIZE
+
+        return size - size % 16
+
     def __set_aes_key(self, new_key):
         self.__key = hashlib.md5(new_key.encode()).digest()
 
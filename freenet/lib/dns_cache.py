@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""DNS应答缓存
+以(qname,qtype,qclass)与请求的EDNS,DO,CD标志作为键,按照记录的TTL过期,支持否定缓存(NXDOMAIN或者没有应答记录)
+带有不认识的EDNS选项的请求不缓存,例如ECS的应答与客户端的网段有关
+缓存数目超过限制时按照LRU淘汰,命中时会重写DNS ID与问题中的域名并且减去已经经过的TTL
+"""
+
+import time
+from collections import OrderedDict
+
+import freenet.lib.metrics as metrics
+import freenet.lib.dns_wire as dns_wire
+
+_cache_hits = metrics.new_counter("dns_cache_hits_total", "dns cache hits", ("cache",))
+_cache_misses = metrics.new_counter("dns_cache_misses_total", "dns cache misses", ("cache",))
+
+
+def make_key(message):
+    """根据DNS请求生成缓存键
+    :param message: 请求消息
+    :return: 不能缓存的请求返回None
+    """
+    rs = dns_wire.parse_question(message)
+    if not rs: return None
+
+    return key_from_question(rs, message)
+
+
+def key_from_question(question, message):
+    """根据dns_wire.parse_question的结果与请求消息生成缓存键
+    :return: 不能缓存的请求返回None
+    """
+    qname, qtype, qclass = question
+
+    try:
+        edns = dns_wire.get_edns(message)
+    except dns_wire.DNSWireErr:
+        return None
+
+    if edns is None:
+        has_edns, do = False, False
+    else:
+        do, codes = edns
+        for code in codes:
+            if code != dns_wire.EDNS_OPT_PADDING: return None
+        has_edns = True
+
+    return (qname.lower(), qtype, qclass, has_edns, do, dns_wire.is_checking_disabled(message),)
+
+
+def set_dns_id(message, dns_id):
+    """修改DNS消息的ID"""
+    return bytes(((dns_id & 0xff00) >> 8, dns_id & 0xff,)) + message[2:]
+
+
+def set_reply_header(message, query):
+    """把应答的DNS ID与问题中的域名改为请求中的,请求的域名可能使用了随机大小写
+    :param message: 应答消息
+    :param query: 请求消息
+    :return:
+    """
+    buf = bytearray(message)
+    buf[0:2] = query[0:2]
+
+    try:
+        end = dns_wire.get_qname_end(query)
+    except dns_wire.DNSWireErr:
+        return bytes(buf)
+
+    # 只有在忽略大小写之后相同时才替换
+    if end <= len(buf) and buf[12:end].lower() == query[12:end].lower(): buf[12:end] = query[12:end]
+
+    return bytes(buf)
+
+
+class dns_cache(object):
+    __max_size = None
+    __min_ttl = None
+    __max_ttl = None
+    __neg_ttl = None
+
+    # 缓存键映射到 [过期时间,存储时间,应答消息,地址列表,TTL偏移列表]
+    __caches = None
+    __name = None
+
+    def __init__(self, max_size=4096, min_ttl=0, max_ttl=86400, neg_ttl=300, name="default"):
+        """
+        :param max_size: 最大缓存条目数
+        :param min_ttl: 最小缓存时间
+        :param max_ttl: 最大缓存时间
+        :param neg_ttl: 否定缓存的最大时间
+        :param name: 缓存名,用于指标标签
+        """
+        self.__max_size = max_size
+        self.__min_ttl = min_ttl
+        self.__max_ttl = max_ttl
+        self.__neg_ttl = neg_ttl
+        self.__caches = OrderedDict()
+        self.__name = name
+
+        metrics.new_gauge("dns_cache_entries", "dns cache entries", ("cache",)).set_function(
+            lambda: [((self.__name,), len(self.__caches),)], key=name
+        )
+
+    def __get_ttl(self, records, message):
+        rcode = dns_wire.get_rcode(message)
+
+        if rcode not in (dns_wire.RCODE_NOERROR, dns_wire.RCODE_NXDOMAIN,): return 0
+
+        answer_ttls = [r[3] for r in records if r[0] == 1]
+        if rcode == dns_wire.RCODE_NOERROR and answer_ttls:
+            ttl = min(answer_ttls)
+            if ttl < self.__min_ttl: ttl = self.__min_ttl
+            if ttl > self.__max_ttl: ttl = self.__max_ttl
+            return ttl
+
+        # 否定缓存,时间为SOA记录的TTL与minimum中的最小值
+        rs = dns_wire.get_soa_minimum(records, message)
+        if not rs: return self.__neg_ttl
+
+        return min(rs[0], rs[1], self.__neg_ttl)
+
+    def put(self, key, message):
+        """加入应答到缓存
+        :param key:
+        :param message: 上游DNS服务器的应答消息
+        :return:
+        """
+        if key is None or self.__max_size < 1: return
+        if len(message) < dns_wire.HEADER_SIZE: return
+
+        # 截断的应答不缓存
+        if dns_wire.is_truncated(message): return
+
+        try:
+            records = dns_wire.iter_records(message)
+        except dns_wire.DNSWireErr:
+            return
+
+        ttl = self.__get_ttl(records, message)
+        if ttl < 1: return
+
+        addrs = dns_wire.get_addrs(records, message)
+        ttl_offsets = dns_wire.get_ttl_offsets(records)
+
+        now = time.time()
+        if key in self.__caches: del self.__caches[key]
+
+        self.__caches[key] = [now + ttl, now, bytes(message), addrs, ttl_offsets]
+
+        while len(self.__caches) > self.__max_size: self.__caches.popitem(last=False)
+
+    def get(self, key, query):
+        """从缓存中获取应答
+        :param key:
+        :param query: 请求消息
+        :return: None表示没有命中,否则返回 (应答消息,地址列表)
+        """
+        if key is None: return None
+
+        rs = self.__caches.get(key, None)
+        if rs is None:
+            _cache_misses.inc(1, (self.__name,))
+            return None
+
+        expire_time, store_time, message, addrs, ttl_offsets = rs
+        now = time.time()
+
+        if now >= expire_time:
+            self.__caches.pop(key, None)
+            _cache_misses.inc(1, (self.__name,))
+            return None
+
+        self.__caches.move_to_end(key)
+        _cache_hits.inc(1, (self.__name,))
+
+        elapsed = int(now - store_time)
+        if elapsed >= 1: message = dns_wire.set_ttls(message, ttl_offsets, elapsed)
+
+        return (set_reply_header(message, query), addrs,)
+
+    def exists(self, key):
+        return key in self.__caches
+
+    def clear(self):
+        self.__caches = OrderedDict()
+
+    def size(self):
+        return len(self.__caches)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""上游DNS服务器选择与DNS ID分配
+记录每个上游DNS服务器的平滑RTT(SRTT)与丢包率,优先选择最快的健康服务器
+丢包率过高的服务器在一段时间之后重新尝试
+"""
+
+import time, random, array
+from collections import OrderedDict
+
+import freenet.lib.metrics as metrics
+
+
+def parse_servers(s):
+    """解析逗号分隔的DNS服务器列表
+    :param s: 例如 "8.8.8.8,1.1.1.1"
+    :return: [server,...]
+    """
+    results = []
+    for server in s.split(","):
+        server = server.strip()
+        if not server: continue
+        if server in results: continue
+        results.append(server)
+
+    return results
+
+
+class _server_state(object):
+    srtt = None
+    loss = 0.0
+    last_fail_time = 0
+
+    def score(self):
+        # 没有RTT记录的服务器优先尝试,以便获取RTT
+        srtt = self.srtt or 0.0
+
+        return srtt * (1 + 4 * self.loss) + self.loss
+
+
+class upstream(object):
+    # SRTT平滑因子
+    __RTT_ALPHA = 0.125
+    # 丢包率平滑因子
+    __LOSS_ALPHA = 0.2
+    # 丢包率超过此值认为服务器不健康
+    __MAX_LOSS = 0.5
+    # 不健康的服务器经过此时间之后重新尝试
+    __RECHECK_TIMEOUT = 30
+    # 记录已经查询过的域名的数目
+    __MAX_SEEN = 8192
+
+    __servers = None
+    __states = None
+    __seen = None
+
+    def __init__(self, servers, name="default"):
+        """
+        :param servers: 上游DNS服务器列表,排在前面的服务器在同等条件下优先
+        :param name: 名称,用于指标标签
+        """
+        self.__servers = list(servers)
+        self.__states = {}
+        self.__seen = OrderedDict()
+
+        for server in self.__servers: self.__states[server] = _server_state()
+
+        metrics.new_gauge("dns_upstream_srtt_seconds", "smoothed rtt of upstream dns server",
+                          ("proxy", "server",)).set_function(
+            lambda: [((name, s,), self.__states[s].srtt or 0,) for s in self.__servers], key=name
+        )
+        metrics.new_gauge("dns_upstream_loss_ratio", "loss ratio of upstream dns server",
+                          ("proxy", "server",)).set_function(
+            lambda: [((name, s,), self.__states[s].loss,) for s in self.__servers], key=name
+        )
+
+    @property
+    def servers(self):
+        return self.__servers
+
+    def __is_healthy(self, state, now):
+        if state.loss < self.__MAX_LOSS: return True
+
+        return now - state.last_fail_time > self.__RECHECK_TIMEOUT
+
+    def choose_n(self, n, exclude=()):
+        """选择最好的n个服务器
+        :param n:
+        :param exclude: 排除的服务器
+        :return: [server,...]
+        """
+        now = time.time()
+        healthy = []
+        unhealthy = []
+
+        for server in self.__servers:
+            if server in exclude: continue
+            state = self.__states[server]
+            if self.__is_healthy(state, now):
+                healthy.append(server)
+            else:
+                unhealthy.append(server)
+            ''''''
+
+        # sort是稳定的,同等条件下保持配置文件的顺序
+        healthy.sort(key=lambda s: self.__states[s].score())
+        unhealthy.sort(key=lambda s: self.__states[s].score())
+
+        return (healthy + unhealthy)[0:n]
+
+    def choose(self, exclude=()):
+        """选择最好的服务器
+        :return: 没有可用的服务器返回None
+        """
+        rs = self.choose_n(1, exclude=exclude)
+        if not rs: return None
+
+        return rs[0]
+
+    def rtt_update(self, server, rtt):
+        """服务器响应之后更新RTT"""
+        if server not in self.__states: return
+        state = self.__states[server]
+
+        if state.srtt is None:
+            state.srtt = rtt
+        else:
+            state.srtt = (1 - self.__RTT_ALPHA) * state.srtt + self.__RTT_ALPHA * rtt
+        state.loss = (1 - self.__LOSS_ALPHA) * state.loss
+
+    def loss_update(self, server):
+        """服务器超时没有响应"""
+        if server not in self.__states: return
+        state = self.__states[server]
+
+        state.loss = (1 - self.__LOSS_ALPHA) * state.loss + self.__LOSS_ALPHA
+        state.last_fail_time = time.time()
+
+    def is_first_query(self, key):
+        """检查是否是第一次查询某个域名,并且记录下来"""
+        if key in self.__seen:
+            self.__seen.move_to_end(key)
+            return False
+
+        self.__seen[key] = None
+        if len(self.__seen) > self.__MAX_SEEN: self.__seen.popitem(last=False)
+
+        return True
+
+
+_sys_random = random.SystemRandom()
+
+
+class id_space(object):
+    """16位DNS ID空间
+    ID随机分配以防止DNS欺骗,空闲ID保存在数组中,分配和释放都是O(1)
+    """
+    __free_ids = None
+    __used = None
+
+    def __init__(self):
+        self.__free_ids = array.array("H", range(0, 0x10000))
+        self.__used = {}
+
+    def alloc(self, value):
+        """分配ID
+        :param value: ID对应的值
+        :return: -1表示ID空间已经用完
+        """
+        free_ids = self.__free_ids
+        n = len(free_ids)
+        if n == 0: return -1
+
+        # 随机选取一个空闲ID,并与最后一个交换之后删除
+        i = _sys_random.randrange(n)
+        dns_id = free_ids[i]
+        free_ids[i] = free_ids[n - 1]
+        free_ids.pop()
+
+        self.__used[dns_id] = value
+
+        return dns_id
+
+    def free(self, dns_id):
+        if dns_id not in self.__used: return
+
+        del self.__used[dns_id]
+        self.__free_ids.append(dns_id)
+
+    def get(self, dns_id):
+        return self.__used.get(dns_id, None)
+
+    def exists(self, dns_id):
+        return dns_id in self.__used
+
+    def is_full(self):
+        return len(self.__free_ids) == 0
+
+    def size(self):
+        return len(self.__used)
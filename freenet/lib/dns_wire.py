@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""DNS报文的简单解析,只解析快速路径需要的字段,避免dnspython构造完整的对象
+解析失败时返回None,由调用者使用dnspython处理
+"""
+
+import socket, struct
+
+TYPE_A = 1
+TYPE_SOA = 6
+TYPE_AAAA = 28
+TYPE_OPT = 41
+
+# EDNS的填充选项,不影响应答
+EDNS_OPT_PADDING = 12
+
+RCODE_NOERROR = 0
+RCODE_NXDOMAIN = 3
+
+HEADER_SIZE = 12
+
+
+class DNSWireErr(Exception): pass
+
+
+def _skip_name(message, offset):
+    """跳过域名
+    :return: 域名之后的偏移
+    """
+    size = len(message)
+
+    while 1:
+        if offset >= size: raise DNSWireErr("wrong name")
+        n = message[offset]
+        # 压缩指针
+        if n & 0xc0 == 0xc0: return offset + 2
+        if n & 0xc0: raise DNSWireErr("wrong label type")
+        if n == 0: return offset + 1
+        offset += n + 1
+
+
+def _read_question(message, offset):
+    """读取问题,域名不允许压缩
+    :return: (qname,qtype,qclass,下一个偏移)
+    """
+    size = len(message)
+    labels = []
+
+    while 1:
+        if offset >= size: raise DNSWireErr("wrong question")
+        n = message[offset]
+        if n & 0xc0: raise DNSWireErr("compressed question")
+        offset += 1
+        if n == 0: break
+        if offset + n > size: raise DNSWireErr("wrong question")
+        labels.append(message[offset:offset + n].decode("iso-8859-1"))
+        offset += n
+
+    if offset + 4 > size: raise DNSWireErr("wrong question")
+    qtype, qclass = struct.unpack("!HH", message[offset:offset + 4])
+
+    return (".".join(labels), qtype, qclass, offset + 4,)
+
+
+def parse_question(message):
+    """解析只有一个问题的标准查询
+    :param message:
+    :return: (qname,qtype,qclass),qname不带最后的点;非标准查询或者解析失败返回None
+    """
+    if len(message) < HEADER_SIZE: return None
+    # opcode不为0
+    if message[2] & 0x78: return None
+
+    qdcount = (message[4] << 8) | message[5]
+    if qdcount != 1: return None
+
+    try:
+        qname, qtype, qclass, offset = _read_question(message, HEADER_SIZE)
+    except DNSWireErr:
+        return None
+
+    return (qname, qtype, qclass,)
+
+
+def get_qname_end(message):
+    """获取第一个问题的域名之后的偏移
+    :raise DNSWireErr
+    """
+    return _skip_name(message, HEADER_SIZE)
+
+
+def is_checking_disabled(message):
+    return bool(message[3] & 0x10)
+
+
+def get_edns(message):
+    """获取请求的EDNS信息
+    :param message:
+    :return: None表示没有OPT记录,否则返回 (do,[option_code,...])
+    :raise DNSWireErr
+    """
+    for section, rtype, rclass, ttl, ttl_offset, rdata_offset, rdlength in iter_records(message):
+        if section != 3 or rtype != TYPE_OPT: continue
+
+        codes = []
+        offset = rdata_offset
+        end = rdata_offset + rdlength
+        while offset + 4 <= end:
+            code, length = struct.unpack("!HH", message[offset:offset + 4])
+            codes.append(code)
+            offset += 4 + length
+        
+        if offset != end: raise DNSWireErr("wrong edns option")
+
+        return (bool(ttl & 0x8000), codes,)
+
+    return None
+
+
+def get_rcode(message):
+    return message[3] & 0x0f
+
+
+def is_truncated(message):
+    return bool(message[2] & 0x02)
+
+
+def iter_records(message):
+    """遍历应答的资源记录
+    :param message:
+    :return: [(section,rtype,rclass,ttl,ttl_offset,rdata_offset,rdlength),...],section 1为answer,2为authority,3为additional
+    """
+    size = len(message)
+    if size < HEADER_SIZE: raise DNSWireErr("wrong header")
+
+    qdcount, ancount, nscount, arcount = struct.unpack("!HHHH", message[4:12])
+    offset = HEADER_SIZE
+
+    for i in range(qdcount):
+        offset = _skip_name(message, offset) + 4
+
+    results = []
+    sections = ((1, ancount,), (2, nscount,), (3, arcount,),)
+
+    for section, count in sections:
+        for i in range(count):
+            offset = _skip_name(message, offset)
+            if offset + 10 > size: raise DNSWireErr("wrong record")
+            rtype, rclass, ttl, rdlength = struct.unpack("!HHIH", message[offset:offset + 10])
+            rdata_offset = offset + 10
+            offset = rdata_offset + rdlength
+            if offset > size: raise DNSWireErr("wrong record")
+            results.append((section, rtype, rclass, ttl, rdata_offset - 6, rdata_offset, rdlength,))
+        ''''''
+
+    return results
+
+
+def get_addrs(records, message):
+    """获取answer中的A与AAAA记录的地址"""
+    results = []
+
+    for section, rtype, rclass, ttl, ttl_offset, rdata_offset, rdlength in records:
+        if section != 1: continue
+        if rtype == TYPE_A and rdlength == 4:
+            results.append(socket.inet_ntop(socket.AF_INET, message[rdata_offset:rdata_offset + 4]))
+        if rtype == TYPE_AAAA and rdlength == 16:
+            results.append(socket.inet_ntop(socket.AF_INET6, message[rdata_offset:rdata_offset + 16]))
+        ''''''
+
+    return results
+
+
+def get_ttl_offsets(records):
+    """获取需要修改TTL的记录,OPT记录的TTL字段有另外的意义,排除在外
+    :return: [(ttl_offset,ttl),...]
+    """
+    results = []
+    for section, rtype, rclass, ttl, ttl_offset, rdata_offset, rdlength in records:
+        if rtype == TYPE_OPT: continue
+        results.append((ttl_offset, ttl,))
+
+    return results
+
+
+def get_soa_minimum(records, message):
+    """获取authority中SOA记录的TTL与minimum字段
+    :return: (ttl,minimum),没有SOA记录返回None
+    """
+    for section, rtype, rclass, ttl, ttl_offset, rdata_offset, rdlength in records:
+        if section != 2 or rtype != TYPE_SOA: continue
+        if rdlength < 22: return None
+        end = rdata_offset + rdlength
+        minimum, = struct.unpack("!I", message[end - 4:end])
+        return (ttl, minimum,)
+
+    return None
+
+
+def set_ttls(message, ttl_offsets, elapsed):
+    """所有记录的TTL减去经过的时间
+    :param message:
+    :param ttl_offsets: get_ttl_offsets的结果
+    :param elapsed:
+    :return: bytearray
+    """
+    buf = bytearray(message)
+    for offset, ttl in ttl_offsets:
+        ttl -= elapsed
+        if ttl < 0: ttl = 0
+        struct.pack_into("!I", buf, offset, ttl)
+
+    return buf
+
+
+"""
+import time, dns.message, dns.rrset, dns.rdatatype
+
+names = ["www.example%d.com" % i for i in range(200)]
+msgs = []
+for name in names:
+    for rdtype in ("A", "AAAA",):
+        q = dns.message.make_query(name, rdtype)
+        r = dns.message.make_response(q)
+        r.answer.append(dns.rrset.from_text(name + ".", 300, "IN", "CNAME", "cdn.example.net."))
+        if rdtype == "A":
+            r.answer.append(dns.rrset.from_text("cdn.example.net.", 60, "IN", "A", "1.2.3.4", "5.6.7.8"))
+        else:
+            r.answer.append(dns.rrset.from_text("cdn.example.net.", 60, "IN", "AAAA", "2001:db8::1"))
+        msgs.append((q.to_wire(), r.to_wire(),))
+
+N = 20
+t = time.time()
+for i in range(N):
+    for q, r in msgs:
+        m = dns.message.from_wire(q)
+        host = b".".join(m.question[0].name[0:-1]).decode("iso-8859-1")
+        m = dns.message.from_wire(r)
+        addrs = [rdata.__str__() for rrset in m.answer for rdata in rrset]
+print("dnspython", time.time() - t)
+
+t = time.time()
+for i in range(N):
+    for q, r in msgs:
+        qname, qtype, qclass = parse_question(q)
+        addrs = get_addrs(iter_records(r), r)
+print("dns_wire", time.time() - t)
+"""
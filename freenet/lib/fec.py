@@ -0,0 +1,478 @@
+#!/usr/bin/env python3
+"""UDP隧道的前向纠错
+连续的k个数据包组成一组,每组附加m个Reed-Solomon(GF(256),Cauchy矩阵)校检包,
+收到任意k个包就可以恢复整组数据,数据包立即发送,不增加没有丢包时的延迟
+m按照对端报告的丢包率调整,没有丢包时不发送校检包
+
+帧格式:
+magic:4 bytes
+group_id:4 bytes 组序号
+index:1 byte 组内序号,小于k为数据包,否则为校检包
+k:1 byte 组内数据包个数,数据包中为计划的个数,校检包中为实际的个数
+m:1 byte 组内校检包个数
+loss:1 byte 本端测量的丢包率,0到255
+数据包的负载为 2 bytes长度 + 原始数据,校检包的负载为组内最长负载的长度
+
+XOR与GF(256)乘法使用int.from_bytes与bytes.translate,不逐字节循环
+"""
+
+import struct, time
+from collections import OrderedDict, deque
+
+_MAGIC = b"\xfdFEC"
+_HDR_FMT = "!4sIBBBB"
+HEADER_SIZE = 12
+
+# 组内最多的包个数
+MAX_SHARDS = 255
+
+_EXP = [0] * 512
+_LOG = [0] * 256
+
+
+def _init_tables():
+    x = 1
+    for i in range(255):
+        _EXP[i] = x
+        _LOG[x] = i
+        x <<= 1
+        if x & 0x100: x ^= 0x11d
+    ''''''
+    for i in range(255, 512): _EXP[i] = _EXP[i - 255]
+
+
+_init_tables()
+
+# 乘法表,用于bytes.translate,按需生成
+_MUL_TABLES = {}
+
+
+class FecErr(Exception): pass
+
+
+def gf_mul(a, b):
+    if a == 0 or b == 0: return 0
+
+    return _EXP[_LOG[a] + _LOG[b]]
+
+
+def gf_inv(a):
+    if a == 0: raise ZeroDivisionError("gf_inv(0)")
+
+    return _EXP[255 - _LOG[a]]
+
+
+def mul_bytes(c, data):
+    """数据的每个字节与c相乘"""
+    if c == 1: return data
+    if c == 0: return bytes(len(data))
+
+    table = _MUL_TABLES.get(c, None)
+    if table is None:
+        table = bytes([gf_mul(c, x) for x in range(256)])
+        _MUL_TABLES[c] = table
+
+    return data.translate(table)
+
+
+def xor_bytes(a, b):
+    """两个相同长度的数据异或"""
+    n = int.from_bytes(a, "little") ^ int.from_bytes(b, "little")
+
+    return n.to_bytes(len(a), "little")
+
+
+def _pad(data, size):
+    if len(data) == size: return data
+
+    return data + bytes(size - len(data))
+
+
+def _coef(k, row, col):
+    """校检包row对数据包col的系数,Cauchy矩阵保证任意k行可逆"""
+    return gf_inv((k + row) ^ col)
+
+
+def _encode_parity(shards, m):
+    """
+    :param shards: 相同长度的数据负载
+    :return: [校检负载,...]
+    """
+    k = len(shards)
+    size = len(shards[0])
+    results = []
+
+    for j in range(m):
+        acc = 0
+        for i in range(k): acc ^= int.from_bytes(mul_bytes(_coef(k, j, i), shards[i]), "little")
+        results.append(acc.to_bytes(size, "little"))
+    ''''''
+
+    return results
+
+
+def _invert(matrix):
+    """GF(256)上的高斯-约当消元求逆矩阵"""
+    n = len(matrix)
+    a = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+
+    for col in range(n):
+        pivot = -1
+        for r in range(col, n):
+            if a[r][col]:
+                pivot = r
+                break
+        if pivot < 0: raise FecErr("singular matrix")
+        a[col], a[pivot] = a[pivot], a[col]
+
+        inv = gf_inv(a[col][col])
+        a[col] = [gf_mul(inv, v) for v in a[col]]
+
+        for r in range(n):
+            if r == col or not a[r][col]: continue
+            f = a[r][col]
+            a[r] = [v ^ gf_mul(f, w) for v, w in zip(a[r], a[col])]
+        ''''''
+
+    return [row[n:] for row in a]
+
+
+def _decode(k, shards, size):
+    """恢复丢失的数据负载
+    :param k: 数据包个数
+    :param shards: {index:负载},至少有k个
+    :param size: 负载长度
+    :return: {index:负载},只包含恢复的数据包
+    """
+    missing = [i for i in range(k) if i not in shards]
+    if not missing: return {}
+
+    indexes = [i for i in range(k) if i in shards]
+    indexes += [i for i in sorted(shards) if i >= k][0:k - len(indexes)]
+
+    matrix = []
+    for idx in indexes:
+        if idx < k:
+            matrix.append([int(idx == col) for col in range(k)])
+        else:
+            matrix.append([_coef(k, idx - k, col) for col in range(k)])
+        ''''''
+    inv = _invert(matrix)
+
+    avail = [_pad(shards[idx], size) for idx in indexes]
+    results = {}
+
+    for i in missing:
+        acc = 0
+        for r in range(k):
+            c = inv[i][r]
+            if c: acc ^= int.from_bytes(mul_bytes(c, avail[r]), "little")
+        results[i] = acc.to_bytes(size, "little")
+    ''''''
+
+    return results
+
+
+def is_fec_frame(frame):
+    return len(frame) > HEADER_SIZE and frame[0:4] == _MAGIC
+
+
+def parse_header(frame):
+    """
+    :return: (group_id,index,k,m,loss)
+    """
+    magic, group_id, index, k, m, loss = struct.unpack(_HDR_FMT, frame[0:HEADER_SIZE])
+    if magic != _MAGIC: raise FecErr("wrong magic")
+    if k < 1 or k + m > MAX_SHARDS or index >= k + m: raise FecErr("wrong fec header")
+
+    return (group_id, index, k, m, loss,)
+
+
+def data_packet(frame):
+    """不经过解码器取出数据帧中的数据包
+    :return: 校检帧返回None
+    """
+    group_id, index, k, m, loss = parse_header(frame)
+    if index >= k: return None
+
+    payload = frame[HEADER_SIZE:]
+    if len(payload) < 2: raise FecErr("wrong fec payload")
+    size = (payload[0] << 8) | payload[1]
+    if size + 2 > len(payload): raise FecErr("wrong fec payload")
+
+    return payload[2:2 + size]
+
+
+def choose_m(k, loss, max_m):
+    """按照丢包率选择校检包个数
+    :param loss: 丢包率,0到1
+    """
+    if loss < 0.005: return 0
+
+    return min(max_m, int(k * loss * 2) + 1)
+
+
+class encoder(object):
+    __k = None
+    __max_m = None
+    __m = 0
+    __group_id = 0
+    __shards = None
+    __group_time = 0
+
+    def __init__(self, k=8, max_m=None):
+        if k < 1 or k >= MAX_SHARDS: raise FecErr("wrong k value")
+        if max_m is None: max_m = k
+        self.__k = k
+        self.__max_m = min(max_m, MAX_SHARDS - k)
+        self.__shards = []
+
+    @property
+    def k(self):
+        return self.__k
+
+    def __frame(self, index, k, m, loss, payload):
+        return struct.pack(_HDR_FMT, _MAGIC, self.__group_id, index, k, m, loss) + payload
+
+    def encode(self, packet, loss=0, peer_loss=0.0):
+        """
+        :param packet: 需要保护的数据包
+        :param loss: 本端测量的丢包率,0到255,告知对端
+        :param peer_loss: 对端报告的丢包率,0到1,用于选择校检包个数
+        :return: [帧,...]
+        """
+        if not self.__shards:
+            self.__m = choose_m(self.__k, peer_loss, self.__max_m)
+            self.__group_time = time.monotonic()
+
+        payload = struct.pack("!H", len(packet)) + packet
+        index = len(self.__shards)
+        self.__shards.append(payload)
+
+        results = [self.__frame(index, self.__k, self.__m, loss, payload)]
+        if len(self.__shards) >= self.__k: results += self.flush(loss)
+
+        return results
+
+    def pending_time(self):
+        """还没有发送校检包的组的等待时间,没有等待的组返回0"""
+        if not self.__shards: return 0
+
+        return time.monotonic() - self.__group_time
+
+    def pending(self):
+        """是否有还没有结束的组"""
+        return bool(self.__shards)
+
+    def flush(self, loss=0):
+        """结束当前组并且生成校检包,组内的数据包可以少于k个"""
+        shards = self.__shards
+        if not shards: return []
+
+        k = len(shards)
+        m = self.__m
+        self.__shards = []
+        results = []
+
+        if m:
+            size = max([len(s) for s in shards])
+            parity = _encode_parity([_pad(s, size) for s in shards], m)
+            for j in range(m): results.append(self.__frame(k + j, k, m, loss, parity[j]))
+        ''''''
+
+        self.__group_id = (self.__group_id + 1) & 0xffffffff
+
+        return results
+
+
+class _group(object):
+    __slots__ = ("k", "m", "nominal_k", "shards", "delivered", "done",)
+
+    def __init__(self, nominal_k, m):
+        # 实际的数据包个数只有收到校检包之后才知道
+        self.k = None
+        self.m = m
+        self.nominal_k = nominal_k
+        self.shards = {}
+        self.delivered = set()
+        self.done = False
+
+    def expected(self):
+        if self.k is not None: return self.k + self.m
+        # 没有收到校检包,按照已经收到的最大序号估计
+        n = max(self.shards) + 1
+        if n >= self.nominal_k: return self.nominal_k + self.m
+
+        return n + self.m
+
+
+class decoder(object):
+    # 同时等待的最多组数
+    __MAX_GROUPS = 32
+    # 丢包率平滑因子
+    __LOSS_ALPHA = 0.1
+
+    __groups = None
+    __finished = None
+    __finished_set = None
+
+    __loss = 0.0
+    __peer_loss = 0.0
+    __peer_k = None
+
+    def __init__(self):
+        self.__groups = OrderedDict()
+        self.__finished = deque()
+        self.__finished_set = set()
+
+    @property
+    def loss(self):
+        """本端测量的丢包率,0到1"""
+        return self.__loss
+
+    @property
+    def loss_byte(self):
+        return min(255, int(self.__loss * 255 + 0.5))
+
+    @property
+    def peer_loss(self):
+        """对端报告的丢包率,0到1"""
+        return self.__peer_loss
+
+    @property
+    def peer_k(self):
+        return self.__peer_k
+
+    def __finish(self, group_id):
+        group = self.__groups.pop(group_id)
+        received = len(group.shards)
+        expected = max(received, group.expected())
+        loss = 1.0 - received / expected
+        self.__loss += self.__LOSS_ALPHA * (loss - self.__loss)
+
+        self.__finished.append(group_id)
+        self.__finished_set.add(group_id)
+        if len(self.__finished) > self.__MAX_GROUPS * 2:
+            self.__finished_set.discard(self.__finished.popleft())
+
+    def decode(self, frame):
+        """
+        :param frame:
+        :return: [数据包,...],包括直接收到的数据包与恢复的数据包
+        """
+        group_id, index, k, m, loss = parse_header(frame)
+        payload = frame[HEADER_SIZE:]
+
+        self.__peer_loss = loss / 255
+        if group_id in self.__finished_set: return []
+
+        if group_id not in self.__groups:
+            if index < k: self.__peer_k = k
+            self.__groups[group_id] = _group(k, m)
+            while len(self.__groups) > self.__MAX_GROUPS: self.__finish(next(iter(self.__groups)))
+
+        group = self.__groups[group_id]
+        if index in group.shards or index in group.delivered: return []
+        group.shards[index] = payload
+
+        results = []
+
+        if index >= k or group.k is not None:
+            if index >= k:
+                group.k = k
+                group.m = m
+            if index < group.k:
+                group.delivered.add(index)
+                results.append(payload)
+            if len(group.shards) >= group.k: results += self.__recover(group)
+        else:
+            group.delivered.add(index)
+            results.append(payload)
+
+        packets = []
+        for p in results:
+            if len(p) < 2: continue
+            size = (p[0] << 8) | p[1]
+            if size + 2 > len(p): continue
+            packets.append(p[2:2 + size])
+        ''''''
+
+        return packets
+
+    def __recover(self, group):
+        if group.done: return []
+        group.done = True
+
+        if len(group.delivered) >= group.k: return []
+
+        size = max([len(s) for s in group.shards.values()])
+        try:
+            recovered = _decode(group.k, group.shards, size)
+        except FecErr:
+            return []
+
+        results = []
+        for i, p in recovered.items():
+            group.delivered.add(i)
+            results.append(p)
+
+        return results
+
+
+class session(object):
+    """一个对端的编码与解码状态,解码器测量的丢包率通过编码的帧告知对端"""
+    # 没有填满的组在这个时间之后发送校检包
+    FLUSH_TIMEOUT = 0.02
+
+    encoder = None
+    decoder = None
+    update_time = 0
+
+    def __init__(self, k=8, max_m=None):
+        self.encoder = encoder(k=k, max_m=max_m)
+        self.decoder = decoder()
+        self.update_time = time.time()
+
+    def encode(self, packet):
+        frames = self.encoder.encode(packet, loss=self.decoder.loss_byte, peer_loss=self.decoder.peer_loss)
+        if self.encoder.pending_time() >= self.FLUSH_TIMEOUT: frames += self.flush()
+
+        return frames
+
+    def flush(self):
+        return self.encoder.flush(loss=self.decoder.loss_byte)
+
+    def need_flush(self):
+        return self.encoder.pending_time() >= self.FLUSH_TIMEOUT
+
+    def pending(self):
+        return self.encoder.pending()
+
+    def decode(self, frame):
+        self.update_time = time.time()
+
+        return self.decoder.decode(frame)
+
+
+"""
+import random, time
+
+enc = session(k=8)
+dec = session(k=8)
+# 对端报告10%的丢包率
+enc.decoder._decoder__peer_loss = 0.1
+
+pkts = [bytes([random.randrange(256) for i in range(random.randrange(40, 1400))]) for n in range(8000)]
+
+t = time.time()
+frames = []
+for pkt in pkts: frames += enc.encode(pkt)
+print("encode", time.time() - t, len(frames))
+
+t = time.time()
+out = []
+for frame in frames:
+    if random.random() < 0.05: continue
+    out += dec.decode(frame)
+print("decode", time.time() - t, len(out), len(pkts))
+"""
@@ -33,6 +33,11 @@ def __read_from_file(fpath):
     return result
 
 
+def read_lines(fpath):
+    """读取文件中的有效行,已经去除注释与空行"""
+    return __read_from_file(fpath)
+
+
 def parse_host_file(fpath):
     """解析主机文件,即域名规则文件"""
     lines = __read_from_file(fpath)
@@ -1,3 +1,4 @@
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
 #include <fcntl.h>
 #include <sys/socket.h>
@@ -49,6 +50,28 @@ static unsigned short calc_checksum(unsigned short *buffer,int size)
         return (unsigned short)(~sum);
 }
 
+/* 按照网络字节序累加16位字,奇数长度在最后补0 */
+static unsigned long csum_add_bytes(unsigned long sum,const unsigned char *p,Py_ssize_t size)
+{
+    while(size > 1){
+        sum += (p[0] << 8) | p[1];
+        p += 2;
+        size -= 2;
+    }
+
+    if(size) sum += p[0] << 8;
+
+    return sum;
+}
+
+static unsigned short csum_fold(unsigned long sum)
+{
+    while (sum >> 16)
+        sum = (sum & 0xffff) + (sum >> 16);
+
+    return (unsigned short)sum;
+}
+
 /**
  * 激活接口
  */
@@ -255,7 +278,8 @@ static PyObject *
 calc_csum(PyObject *self,PyObject *args)
 {
     const char *sts;
-    int size=0,udp_size=0;
+    Py_ssize_t size=0;
+    int udp_size=0;
     unsigned short int csum;
 
     if(!PyArg_ParseTuple(args,"y#i",&sts,&size,&udp_size)) return NULL;
@@ -265,6 +289,51 @@ calc_csum(PyObject *self,PyObject *args)
     return PyLong_FromLong(csum);
 }
 
+/* 计算反码和,没有取反,结果为网络字节序 */
+static PyObject *
+csum_partial(PyObject *self,PyObject *args)
+{
+    Py_buffer buf;
+    unsigned long sum=0;
+
+    if(!PyArg_ParseTuple(args,"y*|k",&buf,&sum)) return NULL;
+
+    sum=csum_add_bytes(csum_fold(sum),buf.buf,buf.len);
+    PyBuffer_Release(&buf);
+
+    return PyLong_FromLong(csum_fold(sum));
+}
+
+/* RFC 1624增量式校检和,一次替换多个字节 */
+static PyObject *
+csum_replace(PyObject *self,PyObject *args)
+{
+    Py_buffer old,new;
+    unsigned short csum;
+    unsigned long sum;
+    const unsigned char *p;
+    Py_ssize_t i;
+
+    if(!PyArg_ParseTuple(args,"Hy*y*",&csum,&old,&new)) return NULL;
+
+    if(old.len!=new.len || old.len % 2){
+        PyBuffer_Release(&old);
+        PyBuffer_Release(&new);
+        PyErr_SetString(PyExc_ValueError,"wrong field length");
+        return NULL;
+    }
+
+    sum=~csum & 0xffff;
+    p=old.buf;
+    for(i=0;i<old.len;i+=2) sum += ~((p[i] << 8) | p[i+1]) & 0xffff;
+    sum=csum_add_bytes(sum,new.buf,new.len);
+
+    PyBuffer_Release(&old);
+    PyBuffer_Release(&new);
+
+    return PyLong_FromLong(~csum_fold(sum) & 0xffff);
+}
+
 static PyObject *
 get_netcard_ip(PyObject *self,PyObject *args)
 {
@@ -285,6 +354,8 @@ static PyMethodDef UtilsMethods[] = {
 	{"tuntap_delete",tuntap_delete,METH_VARARGS,"delete tuntap device ,it equals close"},
 	{"calc_incre_csum",calc_incre_csum,METH_VARARGS,"calculate incremental checksum"},
 	{"calc_csum",calc_csum,METH_VARARGS,"calculate checksum"},
+	{"csum_partial",csum_partial,METH_VARARGS,"calculate ones complement sum"},
+	{"csum_replace",csum_replace,METH_VARARGS,"calculate incremental checksum for bytes"},
 	{"get_nc_ip",get_netcard_ip,METH_VARARGS,"get netcard ip address"},
 	{NULL,NULL,0,NULL}
 };
@@ -1,4 +1,75 @@
 #!/usr/bin/env python3
+"""域名规则匹配
+规则编译成后缀哈希表,键为域名后缀,值为规则标志,查找时从最长的后缀开始,只需要遍历一次域名中的点
+"*.example.com"与"example.com"都匹配example.com本身及其所有子域名
+编译结果可以使用marshal保存到磁盘,规则文件没有改变时直接加载,加快启动
+"""
+
+import os, marshal
+
+import freenet.lib.file_parser as file_parser
+
+# 缓存格式版本,编译方式改变时需要修改
+_CACHE_VERSION = 1
+
+
+def _normalize(host):
+    host = host.strip().lower()
+    if host.startswith("*."): host = host[2:]
+    if host.endswith("."): host = host[0:-1]
+
+    return host
+
+
+def compile_rules(rules):
+    """编译规则
+    :param rules: [(host,flags),...]
+    :return: {后缀:flags,...}
+    """
+    results = {}
+
+    for host, flags in rules:
+        host = _normalize(host)
+        # 只支持最前面的通配符
+        if not host or "*" in host: continue
+        results[host] = flags
+
+    return results
+
+
+def load_file(fpath, cache_path=None):
+    """加载并且编译规则文件
+    :param fpath: 规则文件
+    :param cache_path: 编译缓存文件,为None表示不使用缓存
+    :return: 编译之后的规则
+    """
+    st = os.stat(fpath)
+    key = (_CACHE_VERSION, st.st_mtime_ns, st.st_size,)
+
+    if cache_path and os.path.isfile(cache_path):
+        try:
+            with open(cache_path, "rb") as f:
+                cache_key, rules = marshal.load(f)
+            if tuple(cache_key) == key and isinstance(rules, dict): return rules
+        except (EOFError, ValueError, TypeError, OSError):
+            pass
+        ''''''
+
+    rules = compile_rules(file_parser.parse_host_file(fpath))
+
+    if not cache_path: return rules
+
+    # 先写入临时文件再重命名,防止其他进程读到不完整的缓存
+    tmp_path = "%s.%s.tmp" % (cache_path, os.getpid(),)
+    try:
+        with open(tmp_path, "wb") as f:
+            marshal.dump((key, rules,), f)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.isfile(tmp_path): os.remove(tmp_path)
+
+    return rules
+
 
 class host_match(object):
     """对域名进行匹配,以找到是否在符合的规则列表中
@@ -10,58 +81,51 @@ class host_match(object):
 
     def add_rule(self, host_rule):
         host, flags = host_rule
-        tmplist = host.split(".")
-        tmplist.reverse()
-
-        if not tmplist: return
-
-        lsize = len(tmplist)
-        n = 0
-        tmpdict = self.__rules
-
-        old_name = ""
-        old_dict = tmpdict
-        while n < lsize:
-            name = tmplist[n]
-            if name not in tmpdict:
-                if name == "*" or n == lsize - 1:
-                    old_dict[old_name] = {name: flags}
-                    break
-                old_dict = tmpdict
-                tmpdict[name] = {}
-            if name == "*":
-                n += 1
-                continue
-            old_name = name
-            tmpdict = tmpdict[name]
-            n += 1
-
-        return
+        host = _normalize(host)
+        if not host or "*" in host: return
+
+        self.__rules[host] = flags
+
+    def set_rules(self, rules):
+        """替换全部规则,只有一次赋值,替换是原子的
+        :param rules: compile_rules或者load_file的结果
+        """
+        self.__rules = rules
 
     def match(self, host):
-        tmplist = host.split(".")
-        tmplist.reverse()
-        # 加一个空数据，用以匹配 xxx.xx这样的域名
-        tmplist.append("")
-
-        is_match = False
-        flags = 0
-
-        tmpdict = self.__rules
-        for name in tmplist:
-            if "*" in tmpdict:
-                is_match = True
-                flags = tmpdict["*"]
-                break
-            if name not in tmpdict: break
-            v = tmpdict[name]
-            if type(v) != dict:
-                is_match = True
-                flags = v
-                break
-            tmpdict = v
-
-        return (is_match, flags,)
+        rules = self.__rules
+        host = host.lower()
+        if host.endswith("."): host = host[0:-1]
+
+        # 从最长的后缀开始查找
+        pos = 0
+        while 1:
+            flags = rules.get(host[pos:], None)
+            if flags is not None: return (True, flags,)
+            pos = host.find(".", pos) + 1
+            if pos == 0: break
+
+        return (False, 0,)
 
     def clear(self):
         self.__rules = {}
+
+    def size(self):
+        return len(self.__rules)
+
+
+"""
+import time, random
+
+rules = [("*.site%d.example%d.com" % (i, i % 100), 1,) for i in range(100000)]
+hosts = ["www.a.site%d.example%d.com" % (random.randrange(200000), random.randrange(100),) for i in range(100000)]
+
+t = time.time()
+m = host_match()
+m.set_rules(compile_rules(rules))
+print("compile", time.time() - t)
+
+t = time.time()
+for host in hosts: m.match(host)
+print("match", time.time() - t)
+"""
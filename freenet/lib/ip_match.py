@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""IP地址规则匹配
+CIDR规则编译成按起始地址排序的不重叠区间,嵌套的网段按最长前缀匹配展开,
+查找时使用二分查找,时间复杂度为O(log n)
+规则文件格式: 网段/前缀长度:标志,例如 1.0.1.0/24:0,标志的意义与域名规则相同
+"""
+
+import socket, bisect, array
+
+import freenet.lib.file_parser as file_parser
+
+
+class IPMatchErr(Exception): pass
+
+
+def _to_int(ip, is_ipv6):
+    if is_ipv6:
+        return int.from_bytes(socket.inet_pton(socket.AF_INET6, ip), "big")
+
+    return int.from_bytes(socket.inet_pton(socket.AF_INET, ip), "big")
+
+
+def _flatten(ranges):
+    """把嵌套或者不相交的区间展开成不重叠的区间,内层(前缀更长)的标志优先
+    :param ranges: [(start,end,flags),...]
+    :return: ([start,...],[end,...],[flags,...])
+    """
+    # 起始地址相同时外层在前
+    ranges.sort(key=lambda r: (r[0], -r[1],))
+
+    starts = []
+    ends = []
+    flags_list = []
+
+    def emit(s, e, flags):
+        if s > e: return
+        # 合并相邻并且标志相同的区间
+        if starts and ends[-1] + 1 == s and flags_list[-1] == flags:
+            ends[-1] = e
+            return
+        starts.append(s)
+        ends.append(e)
+        flags_list.append(flags)
+
+    stack = []
+    pos = 0
+
+    for s, e, flags in ranges:
+        while stack and stack[-1][1] < s:
+            top = stack.pop()
+            emit(pos, top[1], top[2])
+            pos = top[1] + 1
+        if stack: emit(pos, s - 1, stack[-1][2])
+        stack.append((s, e, flags,))
+        pos = s
+    ''''''
+
+    while stack:
+        top = stack.pop()
+        emit(pos, top[1], top[2])
+        pos = top[1] + 1
+
+    return (starts, ends, flags_list,)
+
+
+def compile_rules(rules):
+    """编译规则
+    :param rules: [(subnet,prefix,flags),...]
+    :return: 编译之后的规则,可以传递给ip_match.set_rules
+    """
+    ranges4 = []
+    ranges6 = []
+
+    for subnet, prefix, flags in rules:
+        is_ipv6 = ":" in subnet
+        if is_ipv6:
+            bits = 128
+            ranges = ranges6
+        else:
+            bits = 32
+            ranges = ranges4
+
+        if prefix < 0 or prefix > bits: raise IPMatchErr("wrong prefix %s/%s" % (subnet, prefix,))
+
+        try:
+            n = _to_int(subnet, is_ipv6)
+        except OSError:
+            raise IPMatchErr("wrong subnet %s" % subnet)
+
+        host_bits = bits - prefix
+        start = (n >> host_bits) << host_bits
+        ranges.append((start, start + (1 << host_bits) - 1, flags,))
+
+    starts, ends, flags4 = _flatten(ranges4)
+    ip4 = (array.array("L", starts), array.array("L", ends), flags4,)
+    # IPv6地址超过64位,使用列表保存
+    ip6 = _flatten(ranges6)
+
+    return (ip4, ip6,)
+
+
+def parse_rule_file(fpath):
+    """解析IP规则文件,没有标志的规则标志为1
+    :return: [(subnet,prefix,flags),...]
+    """
+    results = []
+
+    for line in file_parser.read_lines(fpath):
+        slash = line.find("/")
+        if slash < 1:
+            print("the wrong format on: %s" % line)
+            continue
+
+        flags = 1
+        pos = line.find(":", slash)
+        if pos < 0: pos = len(line)
+
+        try:
+            prefix = int(line[slash + 1:pos])
+            if pos < len(line): flags = int(line[pos + 1:])
+        except ValueError:
+            print("the wrong format on: %s" % line)
+            continue
+        results.append((line[0:slash].strip(), prefix, flags,))
+
+    return results
+
+
+def load_file(fpath):
+    return compile_rules(parse_rule_file(fpath))
+
+
+class ip_match(object):
+    __ip4 = None
+    __ip6 = None
+
+    def __init__(self):
+        self.clear()
+
+    def set_rules(self, rules):
+        """替换全部规则
+        :param rules: compile_rules或者load_file的结果
+        """
+        self.__ip4, self.__ip6 = rules
+
+    def __lookup(self, table, n):
+        starts, ends, flags_list = table
+        i = bisect.bisect_right(starts, n) - 1
+        if i < 0 or n > ends[i]: return (False, 0,)
+
+        return (True, flags_list[i],)
+
+    def match(self, ip, is_ipv6=False):
+        """匹配文本格式的地址
+        :return: (is_match,flags)
+        """
+        if is_ipv6:
+            table = self.__ip6
+        else:
+            table = self.__ip4
+        if not table[0]: return (False, 0,)
+
+        try:
+            n = _to_int(ip, is_ipv6)
+        except OSError:
+            return (False, 0,)
+
+        return self.__lookup(table, n)
+
+    def match_bytes(self, byte_ip):
+        """匹配二进制格式的地址,用于数据包的快速路径"""
+        if len(byte_ip) == 16:
+            table = self.__ip6
+        else:
+            table = self.__ip4
+        if not table[0]: return (False, 0,)
+
+        return self.__lookup(table, int.from_bytes(byte_ip, "big"))
+
+    def size(self):
+        return len(self.__ip4[0]) + len(self.__ip6[0])
+
+    def clear(self):
+        self.__ip4 = (array.array("L"), array.array("L"), [],)
+        self.__ip6 = ([], [], [],)
+
+
+"""
+import time, random
+
+rules = []
+for i in range(20000):
+    rules.append(("%s.%s.%s.0" % (random.randrange(1, 224), random.randrange(256), random.randrange(256),), 24, 1,))
+for i in range(2000):
+    rules.append(("2001:%x::" % random.randrange(0x10000), 32, 1,))
+
+t = time.time()
+m = ip_match()
+m.set_rules(compile_rules(rules))
+print("compile", time.time() - t)
+
+addrs = [bytes([random.randrange(256) for i in range(4)]) for n in range(100000)]
+t = time.time()
+for addr in addrs: m.match_bytes(addr)
+print("match", time.time() - t)
+"""
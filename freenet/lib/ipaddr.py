@@ -14,7 +14,7 @@ class IpaddrNoEnoughErr(Exception):
 
 
 class ipalloc(object):
-    __no_use_iplist = None
+    __no_use_iplist_num = None
     __subnet = None
     __subnet_num = None
     __prefix = None
@@ -54,10 +54,11 @@ class ipalloc(object):
         self.__no_use_iplist_num.append(n)
 
     def get_addr(self):
-        if self.__no_use_iplist: return self.__no_use_iplist.pop(0)
         size = 4
         if self.__is_ipv6: size = 16
 
+        if self.__no_use_iplist_num: return utils.number2bytes(self.__no_use_iplist_num.pop(0), size)
+
         self.__cur_max_ipaddr_num += 1
         byte_ip = utils.number2bytes(self.__cur_max_ipaddr_num, size)
 
@@ -65,3 +66,16 @@ class ipalloc(object):
             raise IpaddrNoEnoughErr("not enough ip address")
 
         return byte_ip
+
+    def used_count(self):
+        """已经分配的地址数目"""
+        return self.__cur_max_ipaddr_num - self.__subnet_num - len(self.__no_use_iplist_num)
+
+    def capacity(self):
+        """子网能够分配的地址数目"""
+        if self.__is_ipv6:
+            bits = 128
+        else:
+            bits = 32
+
+        return 2 ** (bits - self.__prefix) - 1
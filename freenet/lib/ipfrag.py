@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+"""IPv4与IPv6分片重组
+分片可以乱序到达,重叠的分片会导致整个数据报被丢弃(与Linux内核相同,防止分片重叠攻击),完全相同的重复分片被忽略
+所有未完成的数据报共享一个内存上限,超过时淘汰最早的数据报,每个会话也有自己的内存上限,
+超时由调用者定时调用expire统一检查,不需要为每个数据报或者每个会话设置定时器
+分片的数据在收到时不复制,全部到达之后一次复制到预先分配好大小的缓冲区中
+"""
+
+import bisect, struct, time
+from collections import OrderedDict
+import freenet.lib.checksum as checksum
+import freenet.lib.metrics as metrics
+
+_results = metrics.new_counter("ipfrag_datagrams_total", "fragmented datagrams by result", ("result",))
+
+# IPv6扩展头
+_IP6_EXT_HDRS = (0, 43, 60,)
+_IP6_FRAG_HDR = 44
+_IP6_AH = 51
+
+
+class IPFragErr(Exception): pass
+
+
+def ip6_upper_layer(ip6_pkt):
+    """跳过IPv6扩展头,找到上层协议
+    :param ip6_pkt:
+    :return: (nexthdr,offset,frag_hdr_offset,nexthdr_ptr),offset为上层协议头部的偏移,
+             frag_hdr_offset为-1表示没有分片头,nexthdr_ptr为指向分片头的nexthdr字段的偏移
+    """
+    size = len(ip6_pkt)
+    nexthdr = ip6_pkt[6]
+    ptr = 6
+    offset = 40
+    frag_hdr_offset = -1
+    frag_ptr = -1
+
+    while 1:
+        if nexthdr == _IP6_FRAG_HDR:
+            if offset + 8 > size: raise IPFragErr("wrong ipv6 fragment header")
+            frag_hdr_offset = offset
+            frag_ptr = ptr
+            ptr = offset
+            nexthdr = ip6_pkt[offset]
+            offset += 8
+            # 只有第一个分片包含上层协议头部,后面的扩展头只解析到这里
+            if (ip6_pkt[offset - 6] << 8 | ip6_pkt[offset - 5]) & 0xfff8: break
+            continue
+
+        if nexthdr in _IP6_EXT_HDRS:
+            if offset + 2 > size: raise IPFragErr("wrong ipv6 extension header")
+            ptr = offset
+            nexthdr = ip6_pkt[offset]
+            offset += (ip6_pkt[offset + 1] + 1) * 8
+            continue
+
+        if nexthdr == _IP6_AH:
+            if offset + 2 > size: raise IPFragErr("wrong ipv6 authentication header")
+            ptr = offset
+            nexthdr = ip6_pkt[offset]
+            offset += (ip6_pkt[offset + 1] + 2) * 4
+            continue
+
+        break
+    ''''''
+
+    if offset > size: raise IPFragErr("wrong ipv6 extension header")
+
+    return (nexthdr, offset, frag_hdr_offset, frag_ptr,)
+
+
+def is_fragment(ip_pkt):
+    """是否是分片,IPv4根据MF标志与偏移,IPv6根据是否有分片头"""
+    if ip_pkt[0] >> 4 == 4: return bool(((ip_pkt[6] << 8) | ip_pkt[7]) & 0x3fff)
+
+    try:
+        return ip6_upper_layer(ip_pkt)[2] >= 0
+    except IPFragErr:
+        return False
+
+
+class _datagram(object):
+    __slots__ = ("key", "session_id", "frags", "starts", "total", "size", "memory", "hdr", "nexthdr", "nexthdr_ptr",
+                 "create_time",)
+
+    def __init__(self, key, session_id):
+        self.key = key
+        self.session_id = session_id
+        # [(start,end,data),...],按照start排序
+        self.frags = []
+        self.starts = []
+        # 最后一个分片到达之前总长度未知
+        self.total = -1
+        # 已经收到的数据大小
+        self.size = 0
+        # 占用的内存大小
+        self.memory = 0
+        # 第一个分片的不可分片部分的头部
+        self.hdr = None
+        # IPv6分片头中的上层协议与指向分片头的nexthdr字段的偏移
+        self.nexthdr = 0
+        self.nexthdr_ptr = 6
+        self.create_time = time.time()
+
+
+class reassembler(object):
+    __datagrams = None
+    __session_memory = None
+
+    __memory = 0
+    __max_memory = None
+    __max_session_memory = None
+    __timeout = None
+    __max_size = None
+
+    def __init__(self, max_memory=4 * 1024 * 1024, max_session_memory=256 * 1024, timeout=5, max_size=65535):
+        """
+        :param max_memory: 所有未完成的数据报占用的内存上限
+        :param max_session_memory: 单个会话未完成的数据报占用的内存上限
+        :param timeout: 数据报所有分片到达的超时时间
+        :param max_size: 重组之后IPv4数据报的最大总长度或者IPv6数据报的最大负载长度,不能超过长度字段的65535
+        """
+        self.__datagrams = OrderedDict()
+        self.__session_memory = {}
+        self.__max_memory = max_memory
+        self.__max_session_memory = max_session_memory
+        self.__timeout = timeout
+        self.__max_size = min(max_size, 0xffff)
+
+        metrics.new_gauge("ipfrag_memory_bytes", "memory used by incomplete fragmented datagrams").set_function(
+            lambda: self.__memory
+        )
+
+    @property
+    def memory(self):
+        return self.__memory
+
+    def __len__(self):
+        return len(self.__datagrams)
+
+    def __drop(self, dg, result):
+        del self.__datagrams[dg.key]
+        self.__memory -= dg.memory
+
+        # 淘汰同一个会话的其他数据报时会话的记录可能已经删除
+        n = self.__session_memory.get(dg.session_id, 0) - dg.memory
+        if n > 0:
+            self.__session_memory[dg.session_id] = n
+        else:
+            self.__session_memory.pop(dg.session_id, None)
+
+        _results.inc(labels=(result,))
+
+    def add(self, session_id, ip_pkt):
+        """加入一个数据包
+        :param session_id:
+        :param ip_pkt: IPv4或者IPv6数据包
+        :return: 不是分片时返回原来的数据包,重组完成时返回bytearray类型的完整数据包,否则返回None
+        """
+        ip_ver = ip_pkt[0] >> 4
+
+        if ip_ver == 4:
+            hdrlen = (ip_pkt[0] & 0x0f) * 4
+            v = (ip_pkt[6] << 8) | ip_pkt[7]
+            start = (v & 0x1fff) * 8
+            more = v & 0x2000
+            if not start and not more: return ip_pkt
+
+            tot_len = (ip_pkt[2] << 8) | ip_pkt[3]
+            if tot_len > len(ip_pkt) or tot_len <= hdrlen: return None
+
+            # 源地址,目的地址,协议与包ID
+            key = (session_id, bytes(ip_pkt[12:20]), ip_pkt[9], bytes(ip_pkt[4:6]),)
+            data = memoryview(ip_pkt)[hdrlen:tot_len]
+            hdr_end = hdrlen
+            nexthdr = 0
+            nexthdr_ptr = 0
+        elif ip_ver == 6:
+            try:
+                nexthdr, _, frag_hdr_offset, nexthdr_ptr = ip6_upper_layer(ip_pkt)
+            except IPFragErr:
+                return None
+            if frag_hdr_offset < 0: return ip_pkt
+
+            v = (ip_pkt[frag_hdr_offset + 2] << 8) | ip_pkt[frag_hdr_offset + 3]
+            start = v & 0xfff8
+            more = v & 1
+            nexthdr = ip_pkt[frag_hdr_offset]
+
+            tot_len = 40 + ((ip_pkt[4] << 8) | ip_pkt[5])
+            if tot_len > len(ip_pkt) or tot_len <= frag_hdr_offset + 8: return None
+
+            # 源地址,目的地址与分片ID
+            key = (session_id, bytes(ip_pkt[8:40]), bytes(ip_pkt[frag_hdr_offset + 4:frag_hdr_offset + 8]),)
+            data = memoryview(ip_pkt)[frag_hdr_offset + 8:tot_len]
+            hdr_end = frag_hdr_offset
+        else:
+            return None
+
+        end = start + len(data)
+
+        # 除了最后一个分片,分片数据长度必须是8的倍数
+        if more and len(data) % 8: return None
+
+        dg = self.__datagrams.get(key, None)
+
+        # 头部也计算在长度字段中,否则重组之后长度字段会溢出
+        if self.__too_large(ip_ver, hdr_end, end):
+            if dg:
+                self.__drop(dg, "toolarge")
+            else:
+                _results.inc(labels=("toolarge",))
+            return None
+
+        if not dg:
+            dg = _datagram(key, session_id)
+            self.__datagrams[key] = dg
+
+        i = bisect.bisect_left(dg.starts, start)
+
+        # 重复的分片
+        if i < len(dg.starts) and dg.starts[i] == start and dg.frags[i][1] == end: return None
+
+        if i > 0 and dg.frags[i - 1][1] > start:
+            self.__drop(dg, "overlap")
+            return None
+
+        if i < len(dg.starts) and dg.starts[i] < end:
+            self.__drop(dg, "overlap")
+            return None
+
+        if not more:
+            if (dg.total >= 0 and dg.total != end) or (dg.frags and dg.frags[-1][1] > end):
+                self.__drop(dg, "overlap")
+                return None
+            dg.total = end
+        elif dg.total >= 0 and end >= dg.total:
+            self.__drop(dg, "overlap")
+            return None
+
+        memory = len(ip_pkt)
+
+        if self.__session_memory.get(session_id, 0) + memory > self.__max_session_memory:
+            self.__drop(dg, "limit")
+            return None
+
+        # 淘汰最早的数据报
+        while self.__memory + memory > self.__max_memory:
+            oldest = next(iter(self.__datagrams.values()))
+            if oldest is dg:
+                self.__drop(dg, "evicted")
+                return None
+            self.__drop(oldest, "evicted")
+        ''''''
+
+        dg.frags.insert(i, (start, end, data,))
+        dg.starts.insert(i, start)
+        dg.size += len(data)
+        dg.memory += memory
+        self.__memory += memory
+        self.__session_memory[session_id] = self.__session_memory.get(session_id, 0) + memory
+
+        if start == 0:
+            dg.hdr = memoryview(ip_pkt)[0:hdr_end]
+            dg.nexthdr = nexthdr
+            dg.nexthdr_ptr = nexthdr_ptr
+
+        if dg.total < 0 or dg.size != dg.total or dg.hdr is None: return None
+
+        return self.__join(dg, ip_ver)
+
+    def __too_large(self, ip_ver, hdrlen, end):
+        if ip_ver == 4: return hdrlen + end > self.__max_size
+
+        return hdrlen - 40 + end > self.__max_size
+
+    def __join(self, dg, ip_ver):
+        hdr = dg.hdr
+        hdrlen = len(hdr)
+
+        # 第一个分片的头部可能比其他分片的头部长
+        if self.__too_large(ip_ver, hdrlen, dg.total):
+            self.__drop(dg, "toolarge")
+            return None
+
+        buf = bytearray(hdrlen + dg.total)
+        buf[0:hdrlen] = hdr
+
+        for start, end, data in dg.frags: buf[hdrlen + start:hdrlen + end] = data
+
+        if ip_ver == 4:
+            struct.pack_into("!H", buf, 2, len(buf))
+            struct.pack_into("!HH", buf, 6, 0, 0)
+            buf[10:12] = b"\0\0"
+            struct.pack_into("!H", buf, 10, checksum.calc_csum(buf[0:hdrlen]))
+        else:
+            struct.pack_into("!H", buf, 4, len(buf) - 40)
+            buf[dg.nexthdr_ptr] = dg.nexthdr
+
+        self.__drop(dg, "complete")
+
+        return buf
+
+    def expire(self):
+        """删除超时的数据报,由调用者定时调用"""
+        t = time.time() - self.__timeout
+
+        while self.__datagrams:
+            dg = next(iter(self.__datagrams.values()))
+            if dg.create_time > t: break
+            self.__drop(dg, "timeout")
+        ''''''
+
+    def remove_session(self, session_id):
+        if session_id not in self.__session_memory: return
+
+        for dg in [dg for dg in self.__datagrams.values() if dg.session_id == session_id]:
+            self.__drop(dg, "session")
+        ''''''
+
+
+"""
+import struct
+
+def frag(ident, offset, more, payload, hdrlen=20):
+    hdr = bytearray(hdrlen)
+    hdr[0] = 0x40 | (hdrlen // 4)
+    struct.pack_into("!HHHBB", hdr, 2, hdrlen + len(payload), ident, (offset // 8) | (more << 13), 64, 17)
+    hdr[12:20] = bytes([10, 0, 0, 1, 10, 0, 0, 2])
+    return bytes(hdr) + payload
+
+r = reassembler(max_memory=1024 * 1024, max_session_memory=1024 * 1024)
+
+# 负载到达65535,加上头部之后超过长度字段
+rs = None
+for i in range(45):
+    offset = i * 1480
+    size = min(1480, 65535 - offset)
+    rs = r.add(1, frag(1, offset, offset + size < 65535, b"x" * size))
+assert rs is None and len(r) == 0 and r.memory == 0
+
+# 第一个分片有选项,头部比其他分片长,全部分片到达时才能发现
+for i in range(1, 45):
+    offset = i * 1480
+    size = min(1480, 65512 - offset)
+    assert r.add(1, frag(2, offset, offset + size < 65512, b"x" * size)) is None
+assert r.add(1, frag(2, 0, 1, b"x" * 1480, hdrlen=60)) is None
+assert len(r) == 0 and r.memory == 0
+
+# IPv6逐跳选项头在分片头之前,也计算在负载长度中
+def frag6(offset, more, payload):
+    hbh = bytes([44, 0]) + bytes(6)
+    fh = struct.pack("!BBHI", 17, 0, offset | more, 5)
+    hdr = bytearray(40)
+    hdr[0] = 0x60
+    struct.pack_into("!HBB", hdr, 4, len(hbh) + len(fh) + len(payload), 0, 64)
+    return bytes(hdr) + hbh + fh + payload
+
+for i in range(46):
+    offset = i * 1448
+    size = min(1448, 65528 - offset)
+    rs = r.add(1, frag6(offset, offset + size < 65528, b"x" * size))
+assert rs is None and len(r) == 0
+
+# 重叠的分片丢弃整个数据报
+assert r.add(1, frag(3, 0, 1, b"a" * 16)) is None
+assert r.add(1, frag(3, 8, 0, b"b" * 16)) is None
+assert r.add(1, frag(3, 16, 0, b"c" * 8)) is None
+
+# 重复的分片被忽略
+assert r.add(1, frag(4, 0, 1, b"a" * 16)) is None
+assert r.add(1, frag(4, 0, 1, b"a" * 16)) is None
+pkt = r.add(1, frag(4, 16, 0, b"b" * 8))
+assert pkt is not None and len(pkt) == 44 and bytes(pkt[20:]) == b"a" * 16 + b"b" * 8
+print("ok")
+"""
@@ -1,34 +1,23 @@
 #!/usr/bin/env python3
 """计算校检和
 """
-import freenet.lib.fn_utils as fn_utils
+import freenet.lib.checksum as checksum
+import freenet.lib.ipfrag as ipfrag
 import freenet.lib.utils as utils
-import random, socket
+import random, socket, struct
+from collections import OrderedDict
 
+_IP4_UDP_HDR = struct.Struct("!BBHHHBBH4s4sHHHH")
+_IP4_HDR = struct.Struct("!BBHHHBBH4s4s")
+_IP6_UDP_HDR = struct.Struct("!IHBB16s16sHHHH")
+_IP6_HDR = struct.Struct("!IHBB16s16s")
+_IP6_FRAG_HDR = struct.Struct("!BBHI")
+_UDP_HDR = struct.Struct("!HHHH")
 
-def __calc_udp_csum(saddr, daddr, udp_data, is_ipv6=False):
-    size = len(udp_data)
-    seq = [
-        saddr, daddr, b'\x00\x11',
-        utils.number2bytes(size, 2),
-        udp_data,
-    ]
-
-    if is_ipv6:
-        size += 24
-    else:
-        size += 12
 
-    if 0 != size % 2:
-        seq.append(b"\0")
-        size += 1
-
-    data = b"".join(seq)
-    csum = socket.htons(fn_utils.calc_csum(data, size))
-
-    # csum = __calc_checksum(data, size)
-    # import socket
-    # print(csum,socket.htons(csum_t))
+def __calc_udp_csum(saddr, daddr, udp_data, is_ipv6=False):
+    s = checksum.calc_pseudo_sum(saddr, daddr, 17, len(udp_data))
+    csum = checksum.fold_csum(checksum.calc_sum(udp_data, s))
 
     if csum == 0: return 0xffff
 
@@ -56,7 +45,11 @@ def modify_ip4address(ip_packet, mbuf, flags=0):
     csum = calc_checksum_for_ip_change(old_ip_packet, ip_packet, csum)
     mbuf.replace(utils.number2bytes(csum, 2))
 
-    if protocol in (6, 17, 132, 136,):
+    # 后续的分片没有传输层头部
+    mbuf.offset = 6
+    frag_offset = utils.bytes2number(mbuf.get_part(2)) & 0x1fff
+
+    if not frag_offset and protocol in (6, 17, 132, 136,):
         if protocol == 6:
             p = 1
         else:
@@ -83,16 +76,29 @@ def modify_ip6address(ip_packet, mbuf, flags=0):
     """
     mbuf.offset = 6
     nexthdr = mbuf.get_part(1)
+    hdr_len = 40
+    is_first_frag = True
 
-    if nexthdr == 58:
-        modify_icmp6_echo_for_change(ip_packet, mbuf, flags=flags)
-
-    if nexthdr in (6, 17, 132, 136,):
+    # 有扩展头时找到上层协议,只有第一个分片包含传输层头部
+    if nexthdr not in (6, 17, 58, 132, 136,):
+        mbuf.offset = 0
+        try:
+            nexthdr, hdr_len, frag_hdr_offset, _ = ipfrag.ip6_upper_layer(mbuf.get_data())
+        except ipfrag.IPFragErr:
+            nexthdr, frag_hdr_offset = -1, -1
+        if frag_hdr_offset >= 0:
+            mbuf.offset = frag_hdr_offset + 2
+            is_first_frag = not (utils.bytes2number(mbuf.get_part(2)) & 0xfff8)
+
+    if is_first_frag and nexthdr == 58:
+        modify_icmp6_echo_for_change(ip_packet, mbuf, flags=flags, hdr_len=hdr_len)
+
+    if is_first_frag and nexthdr in (6, 17, 132, 136,):
         if nexthdr == 6:
             p = 1
         else:
             p = 0
-        modify_tcpudp_for_change(ip_packet, mbuf, p, flags=flags)
+        modify_tcpudp_for_change(ip_packet, mbuf, p, flags=flags, is_ipv6=True, hdr_len=hdr_len)
 
     if flags == 0:
         mbuf.offset = 8
@@ -110,43 +116,23 @@ def calc_checksum_for_ip_change(old_ip_packet, new_ip_packet, old_checksum, is_i
     :param is_ipv6:是否是ipv6
     :return:
     """
-    final_checksum = old_checksum
-    a = 0
-    b = 1
-    # tmpcsum = old_checksum
-
-    if is_ipv6:
-        n = 8
-    else:
-        n = 2
+    return checksum.calc_csum_for_change(old_checksum, old_ip_packet, new_ip_packet)
 
-    i = 0
-    while i < n:
-        old_field = (old_ip_packet[a] << 8) | old_ip_packet[b]
-        new_field = (new_ip_packet[a] << 8) | new_ip_packet[b]
-        # final_checksum = checksum.calc_incre_checksum(final_checksum, old_field, new_field)
-        final_checksum = fn_utils.calc_incre_csum(final_checksum, old_field, new_field)
-        a = a + 2
-        b = b + 2
-        i += 1
 
-    return final_checksum
-
-
-def modify_tcpudp_for_change(ip_packet, mbuf, proto, flags=0, is_ipv6=False):
+def modify_tcpudp_for_change(ip_packet, mbuf, proto, flags=0, is_ipv6=False, hdr_len=None):
     """ 修改传输层(SCTP,TCP,UDP,UDPLite,)内容
     :param ip_packet:
     :param ip_packet_list:
     :param proto: 0表示计算的UDP,SCTP以及UDPLITE,1表示计算的TCP
     :param flags: 0 表示修改时的源地址,1表示修改的是目的地址
     :param is_ipv6:表示是否是否是IPV6
+    :param hdr_len: 传输层头部的偏移,IPv6有扩展头时需要提供
     :return:
     """
     if proto not in [0, 1]: return
 
-    if is_ipv6:
-        hdr_len = 40
-    else:
+    if hdr_len is None and is_ipv6: hdr_len = 40
+    if hdr_len is None:
         mbuf.offset = 0
         hdr_len = (mbuf.get_part(1) & 0x0f) * 4
 
@@ -181,52 +167,15 @@ def modify_tcpudp_for_change(ip_packet, mbuf, proto, flags=0, is_ipv6=False):
     mbuf.replace(utils.number2bytes(csum, 2))
 
 
-def _calc_incre_checksum(old_checksum, old_field, new_field):
-    """使用增量式计算校检和
-    :param old_checksum: 2 bytes的旧校检和
-    :param old_field: 2 bytes的旧的需要修改字段
-    :param new_field: 2 bytes的新的字段
-    :return:
-        """
-    chksum = (~old_checksum & 0xffff) + (~old_field & 0xffff) + new_field
-    chksum = (chksum >> 16) + (chksum & 0xffff)
-    chksum += (chksum >> 16)
-
-    return (~chksum) & 0xffff
-
-
-def __calc_checksum(pacekt, size):
-    """计算校检和
-    :param pacekt:
-    :param size:
-    :return:
-    """
-    checksum = 0
-    a = 0
-    b = 1
-    while size > 1:
-        checksum += (pacekt[a] << 8) | pacekt[b]
-        size -= 2
-        a += 2
-        b += 2
-
-    if size:
-        checksum += pacekt[a]
-
-    checksum = (checksum >> 16) + (checksum & 0xffff)
-    checksum += (checksum >> 16)
-
-    return (~checksum) & 0xffff
-
-
-def modify_icmp6_echo_for_change(byte_ip, mbuf, flags=0):
+def modify_icmp6_echo_for_change(byte_ip, mbuf, flags=0, hdr_len=40):
     """修改ICMPv6报文
     :param byte_ip:
     :param new_icmpid:
     :param flags:0表示修改请求报文,1表示表示修改响应报文
+    :param hdr_len: ICMPv6头部的偏移
     :return:
     """
-    mbuf.offset = 42
+    mbuf.offset = hdr_len + 2
     csum = utils.bytes2number(mbuf.get_part(2))
 
     if flags == 0:
@@ -238,7 +187,7 @@ def modify_icmp6_echo_for_change(byte_ip, mbuf, flags=0):
 
     csum = calc_checksum_for_ip_change(old_byte_ip, byte_ip, csum, is_ipv6=True)
 
-    mbuf.offset = 42
+    mbuf.offset = hdr_len + 2
     mbuf.replace(utils.number2bytes(csum, 2))
 
 
@@ -271,176 +220,200 @@ def build_ip_packet(pkt_len, protocol, saddr, daddr, message, pkt_id=1, flags_df
     # 修改包长度
     old_v = (L[2] << 8) | L[3]
     new_v = pkt_len
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_csum(csum, old_v, new_v)
     L[2:4] = ((pkt_len & 0xff00) >> 8, pkt_len & 0x00ff,)
 
     # 修改包ID
     old_v = (L[4] << 8) | L[5]
     new_v = pkt_id
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_csum(csum, old_v, new_v)
     L[4:6] = ((pkt_id & 0xff00) >> 8, pkt_id & 0x00ff,)
 
     # 修改flags以及offset
     old_v = (L[6] << 8) | L[7]
     new_v = (flags_df << 14) | (flags_mf << 13) | offset
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_csum(csum, old_v, new_v)
     L[6:8] = ((new_v & 0xff00) >> 8, new_v & 0x00ff,)
 
     # 修改协议
     old_v = L[9]
     new_v = protocol
-    csum = fn_utils.calc_incre_csum(csum, old_v, new_v)
+    csum = checksum.calc_incre_csum(csum, old_v, new_v)
     L[9] = protocol
 
     # 修改校检和
     # L[10:12] = (0, 0,)
-    # csum = fn_utils.calc_csum(bytes(L), 20)
     L[10:12] = ((csum & 0xff00) >> 8, csum & 0x00ff,)
 
     return b"".join((bytes(L), message,))
 
 
 def build_udp_packets(saddr, daddr, sport, dport, message, mtu=1500, is_udplite=False, is_ipv6=False):
-    """构建UDP数据包"""
+    """构建UDP数据包,同一个流的多个数据包请使用udp_template_cache"""
     if mtu > 1500 or mtu < 576: raise ValueError("the value of mtu is wrong!")
-    msg_len = 8 + len(message)
-    # 构建UDP数据头
-    udp_hdr = [
-        (sport & 0xff00) >> 8,
-        sport & 0x00ff,
-        (dport & 0xff00) >> 8,
-        dport & 0x00ff,
-    ]
-
-    if is_udplite:
-        udp_hdr += [
-            0, 8,
-            0, 0,
-        ]
-        csum = fn_utils.calc_csum(bytes(udp_hdr))
-        udp_hdr[6] = (csum & 0xff00) >> 8
-        udp_hdr[7] = csum & 0xff
-    else:
-        udp_hdr += [
-            (msg_len & 0xff00) >> 8,
-            msg_len & 0x00ff,
-            0, 0,
-        ]
-
-    if not is_udplite:
-        csum = __calc_udp_csum(saddr, daddr,
-                               b"".join([bytes(udp_hdr), message]),
-                               is_ipv6=is_ipv6)
-        udp_hdr[6] = (csum & 0xff00) >> 8
-        udp_hdr[7] = csum & 0xff
-
-    pkt_data = b"".join(
-        (bytes(udp_hdr), message,)
-    )
-
-    if not is_ipv6:
-        pkt_id = random.randint(1, 65535)
-    else:
-        pkt_id = random.randint(1, 0xffffffff)
-        flow_label = random.randint(1, 0x0fffff)
 
-    pkts = []
-    flags_df = 1
+    tpl = udp_template(saddr, daddr, sport, dport, is_udplite=is_udplite, is_ipv6=is_ipv6)
 
-    if is_udplite:
-        p = 136
-    else:
-        p = 17
+    return tpl.build(message, mtu=mtu)
 
-    if is_ipv6 and mtu - 40 <= msg_len:
-        ipv6hdr = __build_ipv6_hdr(flow_label, msg_len, p, 128, saddr, daddr)
-        ip6data = b"".join([ipv6hdr, message, ])
 
-        return [ip6data, ]
+class udp_template(object):
+    """一个(saddr,daddr,sport,dport)流的IP与UDP头部模板
+    不变字段的反码和只计算一次,每个数据包只需要计算长度,包ID与负载的校检和,然后一次打包头部
+    """
+    __saddr = None
+    __daddr = None
+    __sport = None
+    __dport = None
+    __proto = None
+    __is_udplite = False
+    __is_ipv6 = False
+
+    # IPv4头部不变字段的反码和
+    __ip_sum = 0
+    # 伪首部与端口的反码和
+    __udp_sum = 0
+
+    __pkt_id = 0
+    __flow_label = 0
+
+    def __init__(self, saddr, daddr, sport, dport, is_udplite=False, is_ipv6=False):
+        """
+        :param saddr: bytes类型的源地址
+        :param daddr: bytes类型的目的地址
+        :param sport:
+        :param dport:
+        :param is_udplite:
+        :param is_ipv6:
+        """
+        if is_udplite:
+            self.__proto = 136
+        else:
+            self.__proto = 17
 
-    if is_ipv6:
-        # IPV6分包在扩展头提供,因此要算成48
-        ip_hdr_size = 48
-    else:
-        ip_hdr_size = 20
+        self.__saddr = saddr
+        self.__daddr = daddr
+        self.__sport = sport
+        self.__dport = dport
+        self.__is_udplite = is_udplite
+        self.__is_ipv6 = is_ipv6
 
-    step = mtu - ip_hdr_size - (mtu - ip_hdr_size) % 8
+        addr_sum = checksum.calc_sum(daddr, checksum.calc_sum(saddr))
+        self.__udp_sum = (addr_sum + self.__proto + sport + dport) % 0xffff
 
-    b = 0
-    e = step
+        if is_ipv6:
+            self.__pkt_id = random.randint(1, 0xffffffff)
+            self.__flow_label = random.randint(1, 0x0fffff)
+        else:
+            self.__pkt_id = random.randint(1, 0xffff)
+            # 版本与头部长度,TTL与协议
+            self.__ip_sum = (addr_sum + 0x4500 + ((64 << 8) | self.__proto)) % 0xffff
 
-    # pkt_id = 1
-    n = 0
-    every_offset = int(step / 8)
+    def __udp_csum(self, udp_len, message):
+        # UDPLite的校检和只覆盖头部,头部中的长度字段为覆盖长度8
+        if self.__is_udplite: return checksum.fold_csum(self.__udp_sum + udp_len + 8)
 
-    while 1:
-        bdata = pkt_data[b:e]
-        slice_size = len(bdata)
+        return checksum.fold_csum(checksum.calc_sum(message, self.__udp_sum + udp_len * 2))
 
-        if e >= msg_len:
-            finish = True
-        else:
-            finish = False
+    def build(self, message, mtu=1500):
+        """
+        :param message: UDP负载
+        :param mtu:
+        :return: [ip_packet,...],超过mtu时为分片
+        """
+        udp_len = 8 + len(message)
+        csum = self.__udp_csum(udp_len, message)
 
-        if finish:
-            flags_mf = 0
+        if self.__is_udplite:
+            len_field = 8
         else:
-            flags_mf = 1
+            len_field = udp_len
+
+        if self.__is_ipv6:
+            self.__pkt_id = (self.__pkt_id + 1) & 0xffffffff
+            return self.__build6(udp_len, len_field, csum, message, mtu)
+
+        self.__pkt_id = (self.__pkt_id + 1) & 0xffff
+        pkt_id = self.__pkt_id
+        tot_len = 20 + udp_len
+
+        if tot_len <= mtu:
+            ip_csum = checksum.fold_csum(self.__ip_sum + tot_len + pkt_id + 0x4000)
+            hdr = _IP4_UDP_HDR.pack(
+                0x45, 0, tot_len, pkt_id, 0x4000, 64, self.__proto, ip_csum, self.__saddr, self.__daddr,
+                self.__sport, self.__dport, len_field, csum
+            )
+            return [b"".join((hdr, message,))]
+
+        udp_data = b"".join((_UDP_HDR.pack(self.__sport, self.__dport, len_field, csum), message,))
+        step = (mtu - 20) & ~7
+        pkts = []
+
+        for b in range(0, udp_len, step):
+            bdata = udp_data[b:b + step]
+            frag_off = b >> 3
+            if b + step < udp_len: frag_off |= 0x2000
+            tot_len = 20 + len(bdata)
+            ip_csum = checksum.fold_csum(self.__ip_sum + tot_len + pkt_id + frag_off)
+            hdr = _IP4_HDR.pack(
+                0x45, 0, tot_len, pkt_id, frag_off, 64, self.__proto, ip_csum, self.__saddr, self.__daddr
+            )
+            pkts.append(b"".join((hdr, bdata,)))
+        ''''''
+
+        return pkts
+
+    def __build6(self, udp_len, len_field, csum, message, mtu):
+        ver_flow = (6 << 28) | self.__flow_label
+
+        if 40 + udp_len <= mtu:
+            hdr = _IP6_UDP_HDR.pack(
+                ver_flow, udp_len, self.__proto, 128, self.__saddr, self.__daddr,
+                self.__sport, self.__dport, len_field, csum
+            )
+            return [b"".join((hdr, message,))]
+
+        udp_data = b"".join((_UDP_HDR.pack(self.__sport, self.__dport, len_field, csum), message,))
+        # IPV6分包在扩展头提供,因此要算成48
+        step = (mtu - 48) & ~7
+        pkts = []
+
+        for b in range(0, udp_len, step):
+            bdata = udp_data[b:b + step]
+            frag_off = b
+            if b + step < udp_len: frag_off |= 1
+            hdr = _IP6_HDR.pack(ver_flow, 8 + len(bdata), 44, 128, self.__saddr, self.__daddr)
+            frag_hdr = _IP6_FRAG_HDR.pack(self.__proto, 0, frag_off, self.__pkt_id)
+            pkts.append(b"".join((hdr, frag_hdr, bdata,)))
+        ''''''
 
-        offset = n * every_offset
+        return pkts
 
-        if not is_ipv6:
-            ippkt = build_ip_packet(slice_size + 20, p,
-                                    saddr, daddr, bdata, pkt_id=pkt_id,
-                                    flags_df=flags_df, flags_mf=flags_mf,
-                                    offset=offset
-                                    )
+
+class udp_template_cache(object):
+    """按照流缓存UDP头部模板,最近最少使用的模板会被淘汰"""
+    __templates = None
+    __max_size = None
+
+    def __init__(self, max_size=1024):
+        self.__templates = OrderedDict()
+        self.__max_size = max_size
+
+    def build_udp_packets(self, saddr, daddr, sport, dport, message, mtu=1500, is_udplite=False, is_ipv6=False):
+        key = (saddr, daddr, sport, dport, is_udplite,)
+        tpl = self.__templates.get(key, None)
+
+        if tpl:
+            self.__templates.move_to_end(key)
         else:
-            ipv6hdr = __build_ipv6_hdr(flow_label, slice_size, 44, 128, saddr, daddr)
-            frag_hdr = __build_ipv6_fragment_hdr(p, offset, flags_mf, pkt_id)
-            ippkt = b"".join([ipv6hdr, frag_hdr, bdata, ])
-
-        pkts.append(ippkt)
-        if finish: break
-        n += 1
-        b = e
-        e = b + step
-
-    return pkts
-
-
-def __build_ipv6_hdr(flow_label, payload_length, nexthdr, hop_limit, saddr, daddr):
-    """构建IPV6通用头
-    :param flow_label: 
-    :param payload_length: 
-    :param nexthdr: 
-    :param hop_limit: 
-    :param saddr: 
-    :param daddr: 
-    :return: 
-    """
-    # flow_label = random.randint(1, 0x0fffff)
-    byte_seq = [
-        utils.number2bytes(6 << 4, 1),
-        utils.number2bytes(flow_label & 0x0fffff, 3),
-        utils.number2bytes(payload_length, 2),
-        utils.number2bytes(nexthdr, 1),
-        utils.number2bytes(hop_limit, 1),
-        saddr, daddr
-    ]
-
-    return b"".join(byte_seq)
-
-
-def __build_ipv6_fragment_hdr(nexthdr, frag_off, m_flag, frag_id):
-    frag_off = (frag_off << 3) | m_flag
-    byte_seq = [
-        utils.number2bytes(nexthdr, 1),
-        b"\0", utils.number2bytes(frag_off, 2),
-        utils.number2bytes(frag_id, 4),
-    ]
-
-    return b"".join(byte_seq)
+            tpl = udp_template(saddr, daddr, sport, dport, is_udplite=is_udplite, is_ipv6=is_ipv6)
+            self.__templates[key] = tpl
+            if len(self.__templates) > self.__max_size: self.__templates.popitem(last=False)
+
+        return tpl.build(message, mtu=mtu)
+
+    def clear(self):
+        self.__templates.clear()
 
 
 """
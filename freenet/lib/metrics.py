@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""运行时指标统计,用于容量规划
+指标分为counter(只增不减)与gauge(可增可减)两种,输出格式为Prometheus文本格式
+带标签的指标以标签值元组作为键,例如:
+    c = metrics.new_counter("tunnel_packets_in", "packets received from tunnel", ("user", "tunnel",))
+    c.inc(1, ("test", "tcp",))
+"""
+
+import time
+
+METRIC_PREFIX = "fdslight_"
+
+
+class MetricErr(Exception): pass
+
+
+def _escape_label_value(v):
+    v = str(v)
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def _fmt_value(v):
+    if isinstance(v, float): return repr(v)
+    return str(v)
+
+
+class _metric(object):
+    """指标基本类"""
+    mtype = "untyped"
+
+    __name = None
+    __doc = None
+    __labelnames = None
+
+    # 标签值元组到数值的映射
+    values = None
+
+    def __init__(self, name, doc, labelnames=()):
+        self.__name = name
+        self.__doc = doc
+        self.__labelnames = tuple(labelnames)
+        self.values = {}
+
+    @property
+    def name(self):
+        return self.__name
+
+    @property
+    def labelnames(self):
+        return self.__labelnames
+
+    def remove(self, labels):
+        """删除某一组标签的数据,例如会话注销后删除会话对应的指标"""
+        if labels in self.values: del self.values[labels]
+
+    def clear(self):
+        self.values = {}
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def collect(self):
+        """获取所有的数据,重写这个方法
+        :return: [(labels,value),...]
+        """
+        return list(self.values.items())
+
+    def __fmt_labels(self, labels):
+        if not labels: return ""
+        seq = []
+        for k, v in zip(self.__labelnames, labels):
+            seq.append("%s=\"%s\"" % (k, _escape_label_value(v),))
+
+        return "{%s}" % ",".join(seq)
+
+    def render(self):
+        full_name = "%s%s" % (METRIC_PREFIX, self.__name,)
+        seq = [
+            "# HELP %s %s" % (full_name, self.__doc,),
+            "# TYPE %s %s" % (full_name, self.mtype,),
+        ]
+
+        for labels, value in self.collect():
+            if len(labels) != len(self.__labelnames): continue
+            seq.append("%s%s %s" % (full_name, self.__fmt_labels(labels), _fmt_value(value),))
+
+        return "\n".join(seq)
+
+
+class counter(_metric):
+    """只增不减的计数器"""
+    mtype = "counter"
+
+    def inc(self, value=1, labels=()):
+        values = self.values
+        values[labels] = values.get(labels, 0) + value
+
+
+class gauge(_metric):
+    """可增可减的数值
+    当设置了函数之后,数值在输出时通过函数获取,用于统计表大小等不需要每次修改都更新的数据
+    """
+    mtype = "gauge"
+    __funcs = None
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def inc(self, value=1, labels=()):
+        values = self.values
+        values[labels] = values.get(labels, 0) + value
+
+    def dec(self, value=1, labels=()):
+        values = self.values
+        values[labels] = values.get(labels, 0) - value
+
+    def set_function(self, func, key=None):
+        """设置获取数值的函数,不同的模块可以使用不同的key共用一个指标
+        :param func: 返回数值或者 [(labels,value),...]
+        :param key: 函数标识,相同的key会覆盖旧的函数
+        """
+        if self.__funcs is None: self.__funcs = {}
+        self.__funcs[key] = func
+
+    def del_function(self, key=None):
+        if not self.__funcs: return
+        if key in self.__funcs: del self.__funcs[key]
+
+    def collect(self):
+        results = super(gauge, self).collect()
+        if not self.__funcs: return results
+
+        for func in self.__funcs.values():
+            rs = func()
+            if isinstance(rs, (int, float,)):
+                results.append(((), rs,))
+            else:
+                results += list(rs)
+
+        return results
+
+
+class registry(object):
+    __metrics = None
+    __start_time = None
+
+    def __init__(self):
+        self.__metrics = {}
+        self.__start_time = time.time()
+
+    def __get_or_create(self, cls, name, doc, labelnames):
+        if name in self.__metrics:
+            m = self.__metrics[name]
+            if not isinstance(m, cls): raise MetricErr("conflict metric type:%s" % name)
+            if m.labelnames != tuple(labelnames): raise MetricErr("conflict metric labels:%s" % name)
+            return m
+
+        m = cls(name, doc, labelnames)
+        self.__metrics[name] = m
+
+        return m
+
+    def counter(self, name, doc, labelnames=()):
+        return self.__get_or_create(counter, name, doc, labelnames)
+
+    def gauge(self, name, doc, labelnames=()):
+        return self.__get_or_create(gauge, name, doc, labelnames)
+
+    def get(self, name):
+        return self.__metrics.get(name, None)
+
+    def unregister(self, name):
+        if name in self.__metrics: del self.__metrics[name]
+
+    def render(self):
+        seq = [
+            "# HELP %suptime_seconds process uptime" % METRIC_PREFIX,
+            "# TYPE %suptime_seconds gauge" % METRIC_PREFIX,
+            "%suptime_seconds %s" % (METRIC_PREFIX, int(time.time() - self.__start_time),)
+        ]
+        for name in sorted(self.__metrics):
+            seq.append(self.__metrics[name].render())
+        seq.append("")
+
+        return "\n".join(seq)
+
+
+# 默认的指标注册表,服务端和客户端的所有模块都注册到这里
+_registry = registry()
+
+
+def get_registry():
+    return _registry
+
+
+def new_counter(name, doc, labelnames=()):
+    return _registry.counter(name, doc, labelnames)
+
+
+def new_gauge(name, doc, labelnames=()):
+    return _registry.gauge(name, doc, labelnames)
+
+
+def render():
+    return _registry.render()
@@ -51,6 +51,10 @@ class _nat_base(object):
 
         return t
 
+    def mapping_count(self):
+        """当前的映射数目"""
+        return len(self.__sLan2cLan)
+
     def get_ippkt2sLan_from_cLan(self, session_id, ippkt):
         """重写这个方法
         把客户端局域网中的数据包转换成服务器虚拟局域网的包
@@ -133,6 +137,12 @@ class nat(_nat_base):
 
         return (True, rs["session_id"],)
 
+    def addr_used_count(self):
+        return self.__ip_alloc.used_count()
+
+    def addr_capacity(self):
+        return self.__ip_alloc.capacity()
+
     def recycle(self):
         names = self.__timer.get_timeout_names()
         for name in names:
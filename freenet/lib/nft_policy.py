@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""基于nftables集合的策略路由
+需要代理的目标地址加入到nftables集合中,并且由内核负责超时删除,
+命中集合的数据包被打上fwmark,再由一条策略路由转发到tun设备,
+这样不需要为每个目标地址添加一条路由
+"""
+
+import subprocess, time
+
+import freenet.lib.metrics as metrics
+
+_elements_added = metrics.new_counter("nft_elements_added_total", "addresses added to nftables sets", ("family",))
+
+
+class NftErr(Exception): pass
+
+
+class nft_policy(object):
+    __TABLE = "fdslight"
+    # 集合的最大元素个数
+    __SET_SIZE = 262144
+
+    __fwmark = None
+    __timeout = None
+    __enable_ipv6 = None
+
+    # 等待加入集合的地址 host -> (is_ipv6,timeout)
+    __pending = None
+    # 已经加入集合的地址 host -> 过期时间,用于避免重复加入
+    __added = None
+    # 还没有结束的nft进程
+    __procs = None
+
+    def __init__(self, fwmark, timeout, enable_ipv6=False):
+        """
+        :param fwmark: 数据包标记
+        :param timeout: 集合元素默认超时
+        :param enable_ipv6:
+        """
+        self.__fwmark = fwmark
+        self.__timeout = timeout
+        self.__enable_ipv6 = enable_ipv6
+        self.__pending = {}
+        self.__added = {}
+        self.__procs = []
+
+    def __rules(self):
+        seq = [
+            "add table inet %s" % self.__TABLE,
+            "delete table inet %s" % self.__TABLE,
+            "table inet %s {" % self.__TABLE,
+            "    set proxy4 { type ipv4_addr; flags dynamic,timeout; timeout %ss; size %s; }" % (
+                self.__timeout, self.__SET_SIZE,),
+        ]
+        if self.__enable_ipv6:
+            seq.append("    set proxy6 { type ipv6_addr; flags dynamic,timeout; timeout %ss; size %s; }" % (
+                self.__timeout, self.__SET_SIZE,))
+
+        # 有流量的地址由内核刷新超时
+        marks = ["        ip daddr @proxy4 update @proxy4 { ip daddr } meta mark set %s" % self.__fwmark]
+        if self.__enable_ipv6:
+            marks.append("        ip6 daddr @proxy6 update @proxy6 { ip6 daddr } meta mark set %s" % self.__fwmark)
+
+        seq.append("    chain prerouting {")
+        seq.append("        type filter hook prerouting priority mangle; policy accept;")
+        seq += marks
+        seq.append("    }")
+        seq.append("    chain output {")
+        seq.append("        type route hook output priority mangle; policy accept;")
+        seq += marks
+        seq.append("    }")
+        seq.append("}")
+
+        return "\n".join(seq) + "\n"
+
+    def __run(self, script):
+        try:
+            p = subprocess.run(["nft", "-f", "-"], input=script.encode(), stderr=subprocess.PIPE)
+        except OSError:
+            raise NftErr("cannot found nft command")
+
+        if p.returncode != 0: raise NftErr(p.stderr.decode("iso-8859-1"))
+
+    def setup(self):
+        """建立nftables表,集合与打标记规则"""
+        self.__run(self.__rules())
+
+    def cleanup(self):
+        try:
+            self.__run("delete table inet %s\n" % self.__TABLE)
+        except NftErr:
+            pass
+
+    def add(self, host, is_ipv6=False, timeout=None):
+        """加入地址到集合,在flush时批量写入内核"""
+        if is_ipv6 and not self.__enable_ipv6: return
+        if not timeout: timeout = self.__timeout
+
+        now = time.time()
+        # 内核会在有流量时刷新超时,在超时的一半时间内不需要重复加入
+        if self.__added.get(host, 0) > now: return
+
+        self.__added[host] = now + timeout / 2
+        self.__pending[host] = (is_ipv6, timeout,)
+
+    def flush(self):
+        """把等待的地址通过一个nft进程写入内核,不等待进程结束"""
+        self.__procs = [p for p in self.__procs if p.poll() is None]
+
+        if not self.__pending: return
+
+        seq = []
+        for host, (is_ipv6, timeout) in self.__pending.items():
+            if is_ipv6:
+                name = "proxy6"
+                family = "ip6"
+            else:
+                name = "proxy4"
+                family = "ip"
+            seq.append("add element inet %s %s { %s timeout %ss }" % (self.__TABLE, name, host, timeout,))
+            _elements_added.inc(1, (family,))
+        ''''''
+
+        self.__pending = {}
+        self.__expire_added()
+
+        try:
+            p = subprocess.Popen(["nft", "-f", "-"], stdin=subprocess.PIPE)
+        except OSError:
+            return
+
+        p.stdin.write(("\n".join(seq) + "\n").encode())
+        p.stdin.close()
+        self.__procs.append(p)
+
+    def __expire_added(self):
+        now = time.time()
+        if len(self.__added) < self.__SET_SIZE: return
+
+        self.__added = dict([(host, t,) for host, t in self.__added.items() if t > now])
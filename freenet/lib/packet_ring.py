@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""使用AF_PACKET TPACKET_V3内存映射环形缓冲区读取局域网的UDP数据包,用于替代fdslight_dgram内核模块
+内核把数据包按块写入共享内存,一次可读事件可以处理一个块中的全部数据包,不需要每个数据包一次系统调用
+BPF过滤器在内核中过滤出UDP代理子网发出的UDP与UDPLite数据包
+
+与内核模块不同,AF_PACKET只复制数据包,原始数据包仍然会被转发,
+因此需要forward_drop在转发链中丢弃这些数据包
+"""
+
+import socket, struct, mmap, ctypes, subprocess
+
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+
+SO_ATTACH_FILTER = 26
+
+ETH_P_ALL = 0x0003
+ETH_P_IP = 0x0800
+ETH_P_IPV6 = 0x86dd
+
+# 数据包类型,只接收发送到本机MAC地址的数据包,排除广播,多播与本机发送的数据包
+_PACKET_HOST = 0
+
+# BPF指令
+_LD_W_ABS = 0x20
+_LD_B_ABS = 0x30
+_ALU_AND_K = 0x54
+_JEQ_K = 0x15
+_RET_K = 0x06
+# 辅助数据,协议与数据包类型
+_SKF_AD_PROTOCOL = 0xfffff000
+_SKF_AD_PKTTYPE = 0xfffff000 + 4
+
+# 块描述与数据包头部,见linux/if_packet.h
+_BLOCK_STATUS_OFFSET = 8
+_BLOCK_HDR_FMT = "IIII"
+_PKT_HDR_FMT = "IIIIIIHH"
+
+
+class PacketRingErr(Exception): pass
+
+
+def _assemble(prog):
+    """把带有标签的指令转换成sock_filter数组
+    :param prog: [(code,jt,jf,k),...]或者标签名,jt与jf为数字表示相对下一条指令的偏移,为字符串表示跳转到标签,
+                 "accept"与"drop"标签在程序最后
+    """
+    prog = list(prog) + ["accept", (_RET_K, 0, 0, 0xffff,), "drop", (_RET_K, 0, 0, 0,)]
+    labels = {}
+    insns = []
+
+    for x in prog:
+        if isinstance(x, str):
+            labels[x] = len(insns)
+            continue
+        insns.append(x)
+    ''''''
+
+    results = []
+    for i in range(len(insns)):
+        code, jt, jf, k = insns[i]
+        if isinstance(jt, str): jt = labels[jt] - i - 1
+        if isinstance(jf, str): jf = labels[jf] - i - 1
+        if jt > 255 or jf > 255: raise PacketRingErr("the bpf program is too long")
+        results.append(struct.pack("HBBI", code, jt, jf, k & 0xffffffff))
+    ''''''
+
+    return results
+
+
+def _prefix_masks(prefix, bits):
+    """按照32位分割的网络掩码"""
+    mask = ((1 << bits) - 1) ^ ((1 << (bits - prefix)) - 1)
+    return [(mask >> (bits - 32 * (i + 1))) & 0xffffffff for i in range(bits // 32)]
+
+
+def _family_prog(byte_subnet, prefix, byte_tunnel_ip, is_ipv6):
+    """一个地址族的过滤程序,偏移量从网络层头部开始,最后总是跳转到accept或者drop"""
+    if is_ipv6:
+        proto_offset = 6
+        saddr_offset = 8
+        daddr_offset = 24
+        bits = 128
+    else:
+        proto_offset = 9
+        saddr_offset = 12
+        daddr_offset = 16
+        bits = 32
+
+    prog = [
+        (_LD_B_ABS, 0, 0, proto_offset,),
+        (_JEQ_K, 1, 0, 17,),
+        (_JEQ_K, 0, "drop", 136,),
+    ]
+
+    masks = _prefix_masks(prefix, bits)
+    for i in range(len(masks)):
+        if not masks[i]: break
+        net = int.from_bytes(byte_subnet[i * 4:i * 4 + 4], "big") & masks[i]
+        prog.append((_LD_W_ABS, 0, 0, saddr_offset + i * 4,))
+        prog.append((_ALU_AND_K, 0, 0, masks[i],))
+        prog.append((_JEQ_K, 0, "drop", net,))
+    ''''''
+
+    if byte_tunnel_ip and (len(byte_tunnel_ip) == 16) == is_ipv6:
+        words = len(byte_tunnel_ip) // 4
+        for i in range(words):
+            w = int.from_bytes(byte_tunnel_ip[i * 4:i * 4 + 4], "big")
+            prog.append((_LD_W_ABS, 0, 0, daddr_offset + i * 4,))
+            # 所有的字都相同才是隧道服务器地址
+            if i == words - 1:
+                prog.append((_JEQ_K, "drop", "accept", w,))
+            else:
+                prog.append((_JEQ_K, 0, "accept", w,))
+            ''''''
+        ''''''
+    else:
+        prog.append((_JEQ_K, "accept", "accept", 0,))
+
+    return prog
+
+
+def build_filter(subnet, subnet6=None, byte_tunnel_ip=None):
+    """生成BPF过滤器,只接收源地址属于子网的UDP与UDPLite数据包,发送到隧道服务器的数据包除外
+    套接字为SOCK_DGRAM,协议为ETH_P_ALL
+    :param subnet: (二进制格式的子网地址,前缀长度)
+    :param subnet6: (二进制格式的子网地址,前缀长度),None表示不接收IPv6数据包
+    :param byte_tunnel_ip: 二进制格式的隧道服务器地址,None表示没有
+    """
+    prog = [
+        (_LD_W_ABS, 0, 0, _SKF_AD_PKTTYPE,),
+        (_JEQ_K, 0, "drop", _PACKET_HOST,),
+        (_LD_W_ABS, 0, 0, _SKF_AD_PROTOCOL,),
+        (_JEQ_K, 0, "ipv6", ETH_P_IP,),
+    ]
+    prog += _family_prog(subnet[0], subnet[1], byte_tunnel_ip, False)
+    prog.append("ipv6")
+
+    if subnet6:
+        prog.append((_JEQ_K, 0, "drop", ETH_P_IPV6,))
+        prog += _family_prog(subnet6[0], subnet6[1], byte_tunnel_ip, True)
+    else:
+        prog.append((_JEQ_K, "drop", "drop", 0,))
+
+    return _assemble(prog)
+
+
+def attach_filter(s, insns):
+    buf = ctypes.create_string_buffer(b"".join(insns))
+    fprog = struct.pack("HL", len(insns), ctypes.addressof(buf))
+    s.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER, fprog)
+
+
+class rx_ring(object):
+    __socket = None
+    __mmap = None
+    __block_size = None
+    __block_nr = None
+    __cur = 0
+
+    def __init__(self, s, block_size=1 << 18, block_nr=32, frame_size=2048, retire_tov=10):
+        """
+        :param s: AF_PACKET套接字
+        :param block_size: 块大小,必须为页大小的整数倍
+        :param block_nr: 块个数
+        :param frame_size: 单个数据包的最大空间
+        :param retire_tov: 块没有写满时交给用户空间的超时,单位为毫秒
+        """
+        self.__socket = s
+        self.__block_size = block_size
+        self.__block_nr = block_nr
+
+        try:
+            s.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            req = struct.pack(
+                "IIIIIII", block_size, block_nr, frame_size, block_size // frame_size * block_nr, retire_tov, 0, 0
+            )
+            s.setsockopt(SOL_PACKET, PACKET_RX_RING, req)
+            self.__mmap = mmap.mmap(s.fileno(), block_size * block_nr, mmap.MAP_SHARED,
+                                    mmap.PROT_READ | mmap.PROT_WRITE)
+        except OSError as e:
+            raise PacketRingErr("cannot create packet ring:%s" % e)
+
+    def read(self, max_blocks=None):
+        """读取已经交给用户空间的块中的全部数据包
+        :return: [packet,...]
+        """
+        m = self.__mmap
+        results = []
+        if max_blocks is None: max_blocks = self.__block_nr
+
+        for i in range(max_blocks):
+            base = self.__cur * self.__block_size
+            status, num_pkts, first_offset, blk_len = struct.unpack_from(
+                _BLOCK_HDR_FMT, m, base + _BLOCK_STATUS_OFFSET
+            )
+            if not status & TP_STATUS_USER: break
+
+            offset = base + first_offset
+            for n in range(num_pkts):
+                next_offset, _, _, snaplen, length, _, _, net = struct.unpack_from(_PKT_HDR_FMT, m, offset)
+                # 被截断的数据包无法使用
+                if snaplen == length: results.append(m[offset + net:offset + net + snaplen])
+                offset += next_offset
+            ''''''
+
+            # 把块交还给内核
+            struct.pack_into("I", m, base + _BLOCK_STATUS_OFFSET, TP_STATUS_KERNEL)
+            self.__cur = (self.__cur + 1) % self.__block_nr
+        ''''''
+
+        return results
+
+    def close(self):
+        self.__mmap.close()
+
+
+class forward_drop(object):
+    """在转发链中丢弃被捕获的UDP数据包,发送到隧道服务器的数据包除外"""
+    __TABLE = "fdslight_dgram"
+
+    __subnet = None
+    __subnet6 = None
+
+    def __init__(self, subnet, subnet6=None):
+        """
+        :param subnet: (address,prefix)
+        :param subnet6: (address,prefix),None表示不处理IPv6
+        """
+        self.__subnet = subnet
+        self.__subnet6 = subnet6
+
+    def __run(self, script):
+        try:
+            p = subprocess.run(["nft", "-f", "-"], input=script.encode(), stderr=subprocess.PIPE)
+        except OSError:
+            raise PacketRingErr("cannot found nft command")
+
+        if p.returncode != 0: raise PacketRingErr(p.stderr.decode("iso-8859-1"))
+
+    def setup(self, tunnel_ip=None):
+        """建立或者替换规则,隧道服务器地址改变时重新调用"""
+        seq = [
+            "add table inet %s" % self.__TABLE,
+            "delete table inet %s" % self.__TABLE,
+            "table inet %s {" % self.__TABLE,
+            "    chain forward {",
+            "        type filter hook forward priority -1; policy accept;",
+        ]
+
+        rules = [("ip", self.__subnet,)]
+        if self.__subnet6: rules.append(("ip6", self.__subnet6,))
+
+        for family, (address, prefix) in rules:
+            is_ipv6 = family == "ip6"
+            exempt = ""
+            if tunnel_ip and (":" in tunnel_ip) == is_ipv6: exempt = " %s daddr != %s" % (family, tunnel_ip,)
+            seq.append("        %s saddr %s/%s meta l4proto { udp, udplite }%s drop" % (
+                family, address, prefix, exempt,))
+        ''''''
+
+        seq.append("    }")
+        seq.append("}")
+
+        self.__run("\n".join(seq) + "\n")
+
+    def cleanup(self):
+        try:
+            self.__run("delete table inet %s\n" % self.__TABLE)
+        except PacketRingErr:
+            pass
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""UDP隧道的路径MTU探测
+客户端定时同时发送一组不同大小并且设置了DF标志的探测包,服务端对收到的探测包进行确认,
+收到确认的最大探测包就是路径上能够传输的最大UDP负载,
+之后数据包按照这个大小分块,并且据此设置tun设备的MTU,使大部分数据包只需要一个UDP数据包传输
+
+消息格式(ACT_PMTU的数据):
+type:1 byte 消息类型
+probe_id:2 bytes 探测序号
+size:2 bytes 探测包的UDP负载大小,或者协商的数据包大小
+探测包在之后补0到探测的大小
+"""
+
+import socket, struct, time
+
+TYPE_PROBE = 0
+TYPE_ACK = 1
+# 客户端告知服务端协商的数据包大小
+TYPE_SET = 2
+
+_FMT = "!BHH"
+HEADER_SIZE = 5
+
+# 探测的UDP负载大小,IPv4以太网路径的最大值为1472
+_PROBE_SIZES = (1472, 1464, 1452, 1440, 1420, 1400, 1380, 1360, 1320, 1280, 1232,)
+
+# 协商的数据包大小的范围
+MIN_PKT_SIZE = 576
+MAX_PKT_SIZE = 1472
+
+# 不是所有的Python版本都有这些常量,值来自linux/in.h与linux/in6.h
+_IP_MTU_DISCOVER = getattr(socket, "IP_MTU_DISCOVER", 10)
+_IPV6_MTU_DISCOVER = getattr(socket, "IPV6_MTU_DISCOVER", 23)
+_PMTUDISC_DONT = 0
+# 设置DF标志,但是忽略内核缓存的路径MTU
+_PMTUDISC_PROBE = 3
+
+
+class PmtuErr(Exception): pass
+
+
+def build_msg(msg_type, probe_id, size, padding=0):
+    return struct.pack(_FMT, msg_type, probe_id, size) + bytes(padding)
+
+
+def parse_msg(message):
+    """
+    :return: (type,probe_id,size)
+    """
+    if len(message) < HEADER_SIZE: raise PmtuErr("wrong pmtu message")
+
+    msg_type, probe_id, size = struct.unpack(_FMT, message[0:HEADER_SIZE])
+    if msg_type not in (TYPE_PROBE, TYPE_ACK, TYPE_SET,): raise PmtuErr("wrong pmtu message type")
+
+    return (msg_type, probe_id, size,)
+
+
+def is_valid_size(size):
+    return MIN_PKT_SIZE <= size <= MAX_PKT_SIZE
+
+
+def set_df(s, enable, is_ipv6=False):
+    """设置或者取消套接字发送数据包的DF标志
+    :return: 是否设置成功,不支持的系统返回False
+    """
+    if enable:
+        v = _PMTUDISC_PROBE
+    else:
+        v = _PMTUDISC_DONT
+
+    try:
+        if is_ipv6:
+            s.setsockopt(socket.IPPROTO_IPV6, _IPV6_MTU_DISCOVER, v)
+        else:
+            s.setsockopt(socket.IPPROTO_IP, _IP_MTU_DISCOVER, v)
+    except OSError:
+        return False
+
+    return True
+
+
+class prober(object):
+    """探测状态,不发送数据,由隧道负责发送探测包与处理确认"""
+    __interval = None
+    __wait = None
+    __max_size = None
+
+    __probe_id = 0
+    __is_probing = False
+    __begin_time = 0
+    __next_time = 0
+    # 当前探测中收到确认的最大大小
+    __acked = 0
+
+    def __init__(self, is_ipv6=False, interval=600, wait=2):
+        """
+        :param is_ipv6: IPv6的头部比IPv4多20个字节
+        :param interval: 两次探测的时间间隔,路径可能改变,需要定时重新探测
+        :param wait: 等待确认的时间
+        """
+        self.__interval = interval
+        self.__wait = wait
+
+        if is_ipv6:
+            self.__max_size = MAX_PKT_SIZE - 20
+        else:
+            self.__max_size = MAX_PKT_SIZE
+
+    @property
+    def is_probing(self):
+        return self.__is_probing
+
+    def need_probe(self):
+        return not self.__is_probing and time.time() >= self.__next_time
+
+    def begin(self):
+        """开始一次探测
+        :return: (probe_id,[size,...])
+        """
+        self.__probe_id = (self.__probe_id + 1) & 0xffff
+        self.__is_probing = True
+        self.__begin_time = time.time()
+        self.__acked = 0
+
+        return (self.__probe_id, [size for size in _PROBE_SIZES if size <= self.__max_size],)
+
+    def ack(self, probe_id, size):
+        if not self.__is_probing or probe_id != self.__probe_id: return
+        if size > self.__max_size: return
+        if size > self.__acked: self.__acked = size
+
+    def finish(self):
+        """等待时间结束之后结束探测
+        :return: 探测到的大小,还在探测或者没有收到确认返回0
+        """
+        if not self.__is_probing: return 0
+        if time.time() - self.__begin_time < self.__wait: return 0
+
+        self.__is_probing = False
+        self.__next_time = time.time() + self.__interval
+
+        return self.__acked
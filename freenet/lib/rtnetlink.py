@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""rtnetlink路由消息的构建与应答解析
+只实现路由添加与删除需要的部分,多个消息可以拼接之后一次发送给内核
+"""
+
+import socket, struct
+
+NLMSG_ERROR = 2
+
+RTM_NEWROUTE = 24
+RTM_DELROUTE = 25
+
+NLM_F_REQUEST = 0x01
+NLM_F_ACK = 0x04
+NLM_F_REPLACE = 0x100
+NLM_F_CREATE = 0x400
+
+RTA_DST = 1
+RTA_OIF = 4
+RTA_GATEWAY = 5
+RTA_PRIORITY = 6
+RTA_TABLE = 15
+
+RT_TABLE_COMPAT = 252
+RT_TABLE_MAIN = 254
+
+RTPROT_BOOT = 3
+
+RT_SCOPE_UNIVERSE = 0
+RT_SCOPE_LINK = 253
+RT_SCOPE_NOWHERE = 255
+
+RTN_UNICAST = 1
+
+_NLMSG_HDR_FMT = "=LHHLL"
+_NLMSG_HDR_SIZE = 16
+_RTMSG_FMT = "=BBBBBBBBI"
+
+
+class RtnetlinkErr(Exception): pass
+
+
+def _align(n):
+    return (n + 3) & ~3
+
+
+def _rtattr(rta_type, data):
+    size = 4 + len(data)
+    pad = _align(size) - size
+
+    return b"".join([struct.pack("=HH", size, rta_type), data, b"\0" * pad])
+
+
+def build_route_msg(seq, is_add, dst, prefix, oif=0, gateway=None, table=RT_TABLE_MAIN, metric=0, is_ipv6=False):
+    """构建路由消息
+    :param seq: 消息序号,用于匹配内核应答
+    :param is_add: True为添加,False为删除
+    :param dst: 目标网络地址
+    :param prefix: 前缀长度
+    :param oif: 出口网卡索引,0表示不指定
+    :param gateway: 网关地址
+    :param table: 路由表
+    :param metric: 路由优先级,0表示不指定
+    :param is_ipv6:
+    :return: bytes
+    """
+    if is_ipv6:
+        family = socket.AF_INET6
+    else:
+        family = socket.AF_INET
+
+    if is_add:
+        msg_type = RTM_NEWROUTE
+        flags = NLM_F_REQUEST | NLM_F_ACK | NLM_F_CREATE | NLM_F_REPLACE
+        if gateway:
+            scope = RT_SCOPE_UNIVERSE
+        else:
+            scope = RT_SCOPE_LINK
+        ''''''
+    else:
+        msg_type = RTM_DELROUTE
+        flags = NLM_F_REQUEST | NLM_F_ACK
+        scope = RT_SCOPE_NOWHERE
+
+    if table > 255:
+        rtm_table = RT_TABLE_COMPAT
+    else:
+        rtm_table = table
+
+    rtmsg = struct.pack(_RTMSG_FMT, family, prefix, 0, 0, rtm_table, RTPROT_BOOT, scope, RTN_UNICAST, 0)
+    attrs = [_rtattr(RTA_TABLE, struct.pack("=I", table))]
+
+    if prefix > 0: attrs.append(_rtattr(RTA_DST, socket.inet_pton(family, dst)))
+    if oif: attrs.append(_rtattr(RTA_OIF, struct.pack("=I", oif)))
+    if gateway: attrs.append(_rtattr(RTA_GATEWAY, socket.inet_pton(family, gateway)))
+    if metric: attrs.append(_rtattr(RTA_PRIORITY, struct.pack("=I", metric)))
+
+    payload = b"".join([rtmsg] + attrs)
+    hdr = struct.pack(_NLMSG_HDR_FMT, _NLMSG_HDR_SIZE + len(payload), msg_type, flags, seq, 0)
+
+    return hdr + payload
+
+
+def parse_acks(message):
+    """解析内核应答
+    :param message:
+    :return: [(seq,errno),...],errno为0表示成功
+    """
+    results = []
+    size = len(message)
+    offset = 0
+
+    while offset + _NLMSG_HDR_SIZE <= size:
+        msg_len, msg_type, flags, seq, pid = struct.unpack(_NLMSG_HDR_FMT, message[offset:offset + _NLMSG_HDR_SIZE])
+        if msg_len < _NLMSG_HDR_SIZE: raise RtnetlinkErr("wrong netlink message length")
+
+        if msg_type == NLMSG_ERROR:
+            if msg_len < _NLMSG_HDR_SIZE + 4: raise RtnetlinkErr("wrong netlink error message")
+            err, = struct.unpack("=i", message[offset + _NLMSG_HDR_SIZE:offset + _NLMSG_HDR_SIZE + 4])
+            results.append((seq, -err,))
+
+        offset += _align(msg_len)
+
+    return results
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""使用sendmmsg一次系统调用发送多个数据包
+Python标准库没有sendmmsg,这里通过ctypes调用libc
+数据包复制到预先分配的槽位中,每个槽位有自己的目的地址,发送前只需要从IP头部复制目的地址,
+不需要把地址转换成字符串
+"""
+
+import ctypes, socket, struct, errno
+
+try:
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _sendmmsg = None
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [
+        ("iov_base", ctypes.c_void_p,),
+        ("iov_len", ctypes.c_size_t,),
+    ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_name", ctypes.c_void_p,),
+        ("msg_namelen", ctypes.c_uint32,),
+        ("msg_iov", ctypes.POINTER(_iovec),),
+        ("msg_iovlen", ctypes.c_size_t,),
+        ("msg_control", ctypes.c_void_p,),
+        ("msg_controllen", ctypes.c_size_t,),
+        ("msg_flags", ctypes.c_int,),
+    ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ("msg_hdr", _msghdr,),
+        ("msg_len", ctypes.c_uint,),
+    ]
+
+
+def is_supported():
+    return _sendmmsg is not None
+
+
+class batch_sender(object):
+    """原始套接字的批量发送,数据包必须包含IP头部"""
+    __fileno = None
+    __batch_size = None
+    __slot_size = None
+
+    __iovs = None
+    __msgs = None
+    __slots_buf = None
+    __names_buf = None
+    __slots = None
+    __names = None
+
+    # 目的地址在IP头部与sockaddr中的偏移
+    __pkt_daddr_offset = None
+    __name_daddr_offset = None
+    __addr_size = None
+    __name_size = None
+
+    def __init__(self, fileno, is_ipv6=False, batch_size=32, slot_size=2048):
+        """
+        :param fileno: 原始套接字的文件描述符
+        :param is_ipv6:
+        :param batch_size: 一次系统调用最多发送的数据包个数
+        :param slot_size: 单个数据包的最大长度,更大的数据包需要调用者单独发送
+        """
+        self.__fileno = fileno
+        self.__batch_size = batch_size
+        self.__slot_size = slot_size
+
+        if is_ipv6:
+            # sockaddr_in6
+            name = struct.pack("HHI16sI", socket.AF_INET6, 0, 0, bytes(16), 0)
+            self.__pkt_daddr_offset = 24
+            self.__name_daddr_offset = 8
+            self.__addr_size = 16
+        else:
+            # sockaddr_in
+            name = struct.pack("HH4s8x", socket.AF_INET, 0, bytes(4))
+            self.__pkt_daddr_offset = 16
+            self.__name_daddr_offset = 4
+            self.__addr_size = 4
+
+        name_size = len(name)
+        self.__name_size = name_size
+
+        self.__iovs = (_iovec * batch_size)()
+        self.__msgs = (_mmsghdr * batch_size)()
+        slots = ctypes.create_string_buffer(batch_size * slot_size)
+        names = ctypes.create_string_buffer(name * batch_size, batch_size * name_size)
+
+        for i in range(batch_size):
+            self.__iovs[i].iov_base = ctypes.addressof(slots) + i * slot_size
+            hdr = self.__msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(names) + i * name_size
+            hdr.msg_namelen = name_size
+            hdr.msg_iov = ctypes.pointer(self.__iovs[i])
+            hdr.msg_iovlen = 1
+        ''''''
+
+        # 保持引用,防止缓冲区被回收
+        self.__slots_buf = slots
+        self.__names_buf = names
+        self.__slots = memoryview(slots).cast("B")
+        self.__names = memoryview(names).cast("B")
+
+    @property
+    def batch_size(self):
+        return self.__batch_size
+
+    @property
+    def slot_size(self):
+        return self.__slot_size
+
+    def send(self, pkts):
+        """发送数据包
+        :param pkts: 数据包序列,最多发送batch_size个,遇到大于slot_size的数据包时停止
+        :return: 成功发送的数据包个数,套接字缓冲区满时返回0
+        """
+        n = 0
+        slot_size = self.__slot_size
+        name_size = self.__name_size
+        pkt_off = self.__pkt_daddr_offset
+        name_off = self.__name_daddr_offset
+        addr_size = self.__addr_size
+
+        for pkt in pkts:
+            if n == self.__batch_size: break
+            size = len(pkt)
+            if size > slot_size: break
+            b = n * slot_size
+            self.__slots[b:b + size] = pkt
+            self.__iovs[n].iov_len = size
+            b = n * name_size + name_off
+            self.__names[b:b + addr_size] = pkt[pkt_off:pkt_off + addr_size]
+            n += 1
+        ''''''
+
+        if n == 0: return 0
+
+        sent = _sendmmsg(self.__fileno, self.__msgs, n, 0)
+        if sent >= 0: return sent
+
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.ENOBUFS,): return 0
+
+        # 第一个数据包发送失败,由调用者决定是否丢弃
+        raise OSError(err, "sendmmsg failed")
+
+
+"""
+import time, os
+import freenet.lib.ippkts as ippkts
+
+s = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+pkts = [ippkts.build_udp_packets(b"\x7f\0\0\1", b"\x7f\0\0\1", 1000, 9, os.urandom(200))[0] for i in range(32)]
+sender = batch_sender(s.fileno())
+
+begin = time.time()
+for i in range(1000):
+    for pkt in pkts: s.sendto(pkt, ("127.0.0.1", 0))
+print("sendto %.2f us" % ((time.time() - begin) * 1000 / 32))
+
+begin = time.time()
+for i in range(1000): sender.send(pkts)
+print("sendmmsg %.2f us" % ((time.time() - begin) * 1000 / 32))
+"""
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""服务端UDP全锥形代理的流表
+流以(session_id,二进制源地址,源端口)为键,缓存代理套接字与本地端口,
+对端许可使用二进制地址与端口的元组,过期由服务端定时统一检查,不需要为每个流设置定时器
+"""
+
+import time
+
+
+class flow(object):
+    __slots__ = (
+        "key", "session_id", "byte_saddr", "sport", "is_udplite", "is_ipv6",
+        "fileno", "local_port", "permits", "update_time",
+    )
+
+    def __init__(self, session_id, byte_saddr, sport, is_udplite=False, is_ipv6=False):
+        """
+        :param session_id:
+        :param byte_saddr: 客户端内网的二进制源地址
+        :param sport: 客户端内网的源端口
+        :param is_udplite:
+        :param is_ipv6:
+        """
+        self.key = (session_id, byte_saddr, sport,)
+        self.session_id = session_id
+        self.byte_saddr = byte_saddr
+        self.sport = sport
+        self.is_udplite = is_udplite
+        self.is_ipv6 = is_ipv6
+
+        # 代理套接字的文件描述符与本地端口
+        self.fileno = -1
+        self.local_port = 0
+        # 允许接收数据包的对端 {(byte_addr,port),...}
+        self.permits = set()
+        self.update_time = time.time()
+
+
+class flow_table(object):
+    __flows = None
+    __timeout = None
+
+    def __init__(self, timeout=180):
+        """
+        :param timeout: 流没有数据的超时时间
+        """
+        self.__flows = {}
+        self.__timeout = timeout
+
+    def get(self, key):
+        return self.__flows.get(key, None)
+
+    def add(self, flw):
+        self.__flows[flw.key] = flw
+
+    def remove(self, flw):
+        """删除流,只有表中的流是同一个对象时才删除"""
+        if self.__flows.get(flw.key, None) is flw: del self.__flows[flw.key]
+
+    def expire(self):
+        """删除并且返回超时的流,由调用者定时调用
+        :return: [flow,...]
+        """
+        t = time.time() - self.__timeout
+        results = [flw for flw in self.__flows.values() if flw.update_time < t]
+        for flw in results: del self.__flows[flw.key]
+
+        return results
+
+    def session_flows(self, session_id):
+        return [flw for flw in self.__flows.values() if flw.session_id == session_id]
+
+    def __len__(self):
+        return len(self.__flows)
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import socket, random, hashlib
+import socket, random, hashlib, zlib
 
 
 def ip4b_2_number(ip_pkt):
@@ -177,6 +177,37 @@ def is_uint(s):
     return n >= 0
 
 
+# 带有端口的传输层协议,TCP,UDP,SCTP,UDPLite
+_PORT_PROTOCOLS = (6, 17, 132, 136,)
+
+
+def flow_hash(ip_pkt):
+    """计算数据包五元组的哈希值,同一个流两个方向的数据包哈希值相同
+    :param ip_pkt: IPv4或者IPv6数据包
+    :return: 整数
+    """
+    if ip_pkt[0] >> 4 == 4:
+        hdrlen = (ip_pkt[0] & 0x0f) * 4
+        proto = ip_pkt[9]
+        saddr = ip_pkt[12:16]
+        daddr = ip_pkt[16:20]
+        # 分片没有完整的端口信息,只使用地址
+        if (ip_pkt[6] & 0x3f) or ip_pkt[7]: proto = -1
+    else:
+        hdrlen = 40
+        proto = ip_pkt[6]
+        saddr = ip_pkt[8:24]
+        daddr = ip_pkt[24:40]
+
+    if proto in _PORT_PROTOCOLS and len(ip_pkt) >= hdrlen + 4:
+        saddr += ip_pkt[hdrlen:hdrlen + 2]
+        daddr += ip_pkt[hdrlen + 2:hdrlen + 4]
+
+    if saddr > daddr: saddr, daddr = daddr, saddr
+
+    return zlib.crc32(saddr + daddr, proto & 0xff)
+
+
 MBUF_AREA_SIZE = 1501
 
 
@@ -98,7 +98,8 @@ class tcp_handler(handler.handler):
     def evt_write(self):
         if self.__is_async_socket_client and not self.is_conn_ok():
             self.unregister(self.fileno)
-            if self.__conn_ev_flag:
+            # 对端在连接建立之后立即发送数据时也会产生读事件,需要检查套接字错误
+            if self.__conn_ev_flag and self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
                 self.error()
                 return
             ''''''